@@ -0,0 +1,304 @@
+# Copyright (c) 2019. Mount Sinai School of Medicine
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Capacity planning for a pipeline run: predicts the wall time, peak memory and peak disk use of the
+jobs a dry run schedules, at several core counts, and recommends --cores and --memory values.
+
+Each job's wall time and peak RSS come from the benchmark files of earlier runs (see
+run_report.py): those of the same job if there are any, else the mean wall time and largest RSS of
+all jobs of its rule. They are scaled by the ratio of this sample's input FASTQ size to the earlier
+sample's, and the wall time by Amdahl's law from the threads the earlier job had and the CPU load it
+reached to the threads it gets now. Jobs without history (e.g. reference indexing, which the benchmarks don't
+record the reference size for) count as instantaneous and are listed separately.
+
+The jobs are then scheduled on the given cores, memory and disk budget like Snakemake does: a job
+starts once its inputs exist and its threads, mem_mb and disk_mb fit, longest remaining path first.
+Outputs count towards the workdir's disk use from the start of the job writing them (by its disk_mb
+estimate) until the last job reading them finishes, if they're temporary, or to the end otherwise.
+Jobs after a checkpoint (chunked alignment) aren't known before the checkpoint has run.
+"""
+
+from collections import OrderedDict
+import glob
+import heapq
+import math
+from os.path import basename, exists, getsize, isfile, join
+import re
+import sys
+
+import snakemake.io
+
+from run_report import load_jobs
+
+# core counts whose wall time is within this factor of the fastest are considered as fast
+RECOMMENDATION_SLACK = 1.1
+
+
+def _staged_input_bytes(run_dir):
+    """
+    Returns the total size of the staged FASTQ inputs in a sample directory, or None if there
+    aren't any left
+    """
+    fastqs = [
+        x for x in glob.glob(join(run_dir, "*.fastq*"))
+        if re.match(r"(normal|tumor|rna)_", basename(x))]
+    total = sum(getsize(x) for x in fastqs if exists(x))
+    return total or None
+
+
+def config_input_bytes(config):
+    """
+    Returns the total size of a sample config's input FASTQs, or None if any isn't a local file
+    """
+    paths = []
+    for input_type in ["normal", "tumor", "rna"]:
+        for fragment in config["input"].get(input_type, []):
+            if fragment["type"] == "paired-end":
+                paths.extend([fragment["r1"], fragment["r2"]])
+            else:
+                paths.append(fragment["r"])
+    if not paths or not all(isfile(x) for x in paths):
+        return None
+    return sum(getsize(x) for x in paths)
+
+
+def load_history(run_dirs):
+    """
+    Returns the benchmarked jobs of earlier runs in the given sample directories, as
+    {"jobs": {job name -> records}, "rules": {rule name -> records}}
+    """
+    history = {"jobs": {}, "rules": {}}
+    for run_dir in run_dirs:
+        input_bytes = _staged_input_bytes(run_dir)
+        for job in load_jobs(run_dir):
+            if job["wall_seconds"] <= 0:
+                continue
+            record = {
+                "wall_seconds": job["wall_seconds"],
+                "cpu_seconds": job["cpu_seconds"],
+                "threads": job["threads"],
+                "max_rss_mb": job["max_rss_mb"],
+                "input_bytes": input_bytes,
+            }
+            history["jobs"].setdefault(job["job"], []).append(record)
+            history["rules"].setdefault(job["rule"], []).append(record)
+    return history
+
+
+def amdahl_wall_seconds(wall_seconds, cpu_seconds, threads_then, threads_now):
+    """
+    Returns the wall time of a job given threads_now threads, from a run with threads_then threads.
+    The parallel fraction of the job is solved from the speedup it reached then (its CPU time over
+    its wall time).
+    """
+    if threads_then <= 1 or wall_seconds <= 0:
+        return wall_seconds
+    speedup = min(float(threads_then), max(1.0, cpu_seconds / wall_seconds))
+    parallel = (1 - 1 / speedup) / (1 - 1 / threads_then)
+    return wall_seconds * ((1 - parallel) + parallel / threads_now) / (
+        (1 - parallel) + parallel / threads_then)
+
+
+def estimate_job(job, history, input_bytes):
+    """
+    Returns the predicted (wall seconds, peak RSS in MB) of a planned job, or (None, None) if there
+    are no earlier runs of its rule
+    """
+    records = history["jobs"].get(job["name"]) or history["rules"].get(job["rule"])
+    if not records:
+        return None, None
+    walls = []
+    rss = []
+    for record in records:
+        scale = 1.0
+        if input_bytes and record["input_bytes"]:
+            scale = input_bytes / record["input_bytes"]
+        walls.append(scale * amdahl_wall_seconds(
+            record["wall_seconds"], record["cpu_seconds"], record["threads"], job["threads"]))
+        # as in the resource model, RSS is only ever scaled up
+        rss.append(max(1.0, scale) * record["max_rss_mb"])
+    return sum(walls) / len(walls), max(rss)
+
+
+class JobCollector(object):
+    """
+    Snakemake log handler collecting the jobs of a dry run
+    """
+    def __init__(self):
+        self.jobs = []
+
+    def __call__(self, msg):
+        if msg["level"] != "job_info":
+            return
+        resources = msg["resources"]
+        benchmark = msg.get("benchmark")
+        self.jobs.append({
+            "jobid": msg["jobid"],
+            "rule": msg["name"],
+            # benchmark file name, by which earlier runs of the same job are found
+            "name": basename(str(benchmark))[:-len(".txt")] if benchmark else msg["name"],
+            "sample": (msg["wildcards"] or {}).get("sample"),
+            "threads": msg["threads"],
+            "mem_mb": resources.get("mem_mb", 0),
+            "disk_mb": resources.get("disk_mb", 0),
+            "input": [str(x) for x in msg["input"]],
+            "output": [str(x) for x in msg["output"]],
+            "temp_output": [
+                str(x) for x in msg["output"] if snakemake.io.is_flagged(x, "temp")],
+        })
+
+
+def _remaining_path_seconds(jobs, dependents, durations):
+    """
+    Returns jobid -> wall time of the longest chain of jobs starting with it
+    """
+    remaining = {}
+
+    def visit(jobid):
+        if jobid not in remaining:
+            remaining[jobid] = durations[jobid] + max(
+                [visit(x) for x in dependents[jobid]] or [0])
+        return remaining[jobid]
+    for jobid in jobs:
+        visit(jobid)
+    return remaining
+
+
+def simulate(jobs, estimates, cores, mem_mb, disk_mb, targets=()):
+    """
+    Schedules the jobs of a dry run. estimates is jobid -> (wall seconds, peak RSS in MB), with
+    None for unknown values. Returns the predicted wall time, the peaks of memory reserved by
+    running jobs, of their predicted RSS and of workdir disk use, and the peak number of cores busy.
+    """
+    by_id = OrderedDict((job["jobid"], job) for job in jobs)
+    producers = {}
+    for job in jobs:
+        for output in job["output"]:
+            producers[output] = job["jobid"]
+    dependencies = {jobid: set() for jobid in by_id}
+    dependents = {jobid: set() for jobid in by_id}
+    readers = {}
+    for job in jobs:
+        for path in job["input"]:
+            if path in producers and producers[path] != job["jobid"]:
+                dependencies[job["jobid"]].add(producers[path])
+                dependents[producers[path]].add(job["jobid"])
+                readers.setdefault(path, set()).add(job["jobid"])
+    durations = {jobid: estimates[jobid][0] or 0.0 for jobid in by_id}
+    priority = _remaining_path_seconds(by_id, dependents, durations)
+
+    # Snakemake scales threads down to the cores it has. mem_mb and disk_mb are capped as well, so
+    # that every job fits on an idle machine.
+    def reservation(job):
+        return (
+            min(job["threads"], cores), min(job["mem_mb"] or 0, mem_mb),
+            min(job["disk_mb"] or 0, disk_mb))
+
+    # output path -> share of its job's disk_mb
+    output_mb = {}
+    for job in jobs:
+        for output in job["output"]:
+            output_mb[output] = (job["disk_mb"] or 0) / len(job["output"])
+    deletable = {
+        x for job in jobs for x in job["temp_output"] if x in readers and x not in targets}
+    unread = {path: len(x) for path, x in readers.items()}
+
+    waiting = {jobid: len(x) for jobid, x in dependencies.items()}
+    ready = [jobid for jobid, count in waiting.items() if count == 0]
+    running = []
+    now = 0.0
+    used = [0, 0, 0]
+    workdir_mb = 0.0
+    rss_mb = 0.0
+    peaks = {"mem_mb": 0, "rss_mb": 0.0, "disk_mb": 0.0, "cores": 0}
+    while ready or running:
+        ready.sort(key=lambda x: -priority[x])
+        for jobid in list(ready):
+            job = by_id[jobid]
+            needed = reservation(job)
+            if any(used[i] + needed[i] > limit for i, limit in enumerate((cores, mem_mb, disk_mb))):
+                continue
+            ready.remove(jobid)
+            used = [used[i] + needed[i] for i in range(3)]
+            workdir_mb += sum(output_mb[x] for x in job["output"])
+            job_rss_mb = estimates[jobid][1] or needed[1]
+            rss_mb += job_rss_mb
+            heapq.heappush(running, (now + durations[jobid], jobid, needed, job_rss_mb))
+        peaks["cores"] = max(peaks["cores"], used[0])
+        peaks["mem_mb"] = max(peaks["mem_mb"], used[1])
+        peaks["rss_mb"] = max(peaks["rss_mb"], rss_mb)
+        peaks["disk_mb"] = max(peaks["disk_mb"], workdir_mb)
+        now, jobid, needed, job_rss_mb = heapq.heappop(running)
+        used = [used[i] - needed[i] for i in range(3)]
+        rss_mb -= job_rss_mb
+        for path in by_id[jobid]["input"]:
+            if path in unread:
+                unread[path] -= 1
+                if unread[path] == 0 and path in deletable:
+                    workdir_mb -= output_mb[path]
+        for dependent in dependents[jobid]:
+            waiting[dependent] -= 1
+            if waiting[dependent] == 0:
+                ready.append(dependent)
+    return {
+        "cores": cores,
+        "jobs": len(jobs),
+        "wall_seconds": now,
+        "peak_mem_mb": peaks["mem_mb"],
+        "peak_rss_mb": peaks["rss_mb"],
+        "peak_disk_mb": peaks["disk_mb"],
+        "peak_cores_busy": peaks["cores"],
+    }
+
+
+def recommend(plans, min_memory_gb):
+    """
+    Returns the smallest core count that is about as fast as the fastest planned one, and the
+    memory in GB that its schedule reserves at its peak (at least min_memory_gb)
+    """
+    fastest = min(x["wall_seconds"] for x in plans)
+    plan = min(
+        [x for x in plans if x["wall_seconds"] <= fastest * RECOMMENDATION_SLACK],
+        key=lambda x: x["cores"])
+    memory_gb = max(min_memory_gb, int(math.ceil(plan["peak_mem_mb"] / 1024.0)))
+    return {
+        "cores": plan["cores"],
+        "memory_gb": memory_gb,
+        "wall_seconds": plan["wall_seconds"],
+        "peak_disk_mb": plan["peak_disk_mb"],
+    }
+
+
+def _format_duration(seconds):
+    return "%dh%02dm" % (seconds // 3600, seconds % 3600 // 60)
+
+
+def print_plan(plans, recommendation, unestimated, input_bytes, reference_bytes, out=sys.stdout):
+    out.write("Input FASTQs: %.1f GB, reference genome: %.1f GB\n\n" % (
+        (input_bytes or 0) / 1024.0 ** 3, (reference_bytes or 0) / 1024.0 ** 3))
+    out.write("%6s %6s %10s %14s %14s %14s\n" % (
+        "cores", "jobs", "wall time", "reserved (GB)", "peak RSS (GB)", "disk (GB)"))
+    for plan in plans:
+        out.write("%6d %6d %10s %14.1f %14.1f %14.1f\n" % (
+            plan["cores"], plan["jobs"], _format_duration(plan["wall_seconds"]),
+            plan["peak_mem_mb"] / 1024.0, plan["peak_rss_mb"] / 1024.0,
+            plan["peak_disk_mb"] / 1024.0))
+    if unestimated:
+        out.write("\nNo earlier runs of these rules; counted as taking no time: %s\n" % ", ".join(
+            "%s (%d)" % (rule, count) for rule, count in sorted(unestimated.items())))
+    out.write("\nRecommended: --cores %d --memory %d (about %s, %.1f GB of workdir disk)\n" % (
+        recommendation["cores"], recommendation["memory_gb"],
+        _format_duration(recommendation["wall_seconds"]),
+        recommendation["peak_disk_mb"] / 1024.0))
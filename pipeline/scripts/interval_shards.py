@@ -0,0 +1,169 @@
+# Copyright (c) 2019. Mount Sinai School of Medicine
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Splits the reference contigs into roughly equal-size interval shards, for per-region scatter of
+GATK and variant calling jobs. Contigs are only ever cut in the middle of a run of Ns, so no read
+can overlap two shards.
+
+Output is a TSV file with one line per interval: shard name, then a GATK-style interval
+(contig:start-end, 1-based and inclusive). A shard may contain several intervals.
+"""
+
+from argparse import ArgumentParser
+import csv
+import re
+
+import sys
+
+
+parser = ArgumentParser()
+
+parser.add_argument(
+    "--reference",
+    default="",
+    help="Path to the reference FASTA file")
+
+parser.add_argument(
+    "--fai",
+    default="",
+    help="Path to the samtools faidx index of the reference FASTA file")
+
+parser.add_argument(
+    "--contigs",
+    default="",
+    help="Path to file listing the contigs to shard, one per line")
+
+parser.add_argument(
+    "--num-shards",
+    type=int,
+    default=1,
+    help="Desired number of shards; the actual number may differ slightly")
+
+parser.add_argument(
+    "--min-gap",
+    type=int,
+    default=1000,
+    help="Minimum length of an N-run at which a contig may be cut (default %(default)s)")
+
+parser.add_argument(
+    "--out",
+    default="",
+    help="Output file path for the shard intervals")
+
+
+def read_fai(path):
+    """
+    Returns a dict of contig name to (length, offset, line bases, line bytes).
+    """
+    fai = {}
+    with open(path) as f:
+        for row in csv.reader(f, delimiter='\t'):
+            fai[row[0]] = tuple(int(x) for x in row[1:5])
+    return fai
+
+
+def find_cut_points(fasta, fai_entry, min_gap):
+    """
+    Returns the 1-based midpoints of all N-runs of at least min_gap bases in one contig. The contig
+    is read one line at a time, so memory use doesn't grow with its length.
+    """
+    length, offset, _, _ = fai_entry
+    n_run_regex = re.compile(b'[Nn]+')
+    cut_points = []
+    # 0-based start and exclusive end of the last N-run seen, which may continue on the next line
+    run_start, run_end = 0, 0
+    position = 0
+    fasta.seek(offset)
+    while position < length:
+        line = fasta.readline().rstrip(b'\r\n')[:length - position]
+        if not line:
+            break
+        for match in n_run_regex.finditer(line):
+            start, end = position + match.start(), position + match.end()
+            if start != run_end:
+                if run_end - run_start >= min_gap:
+                    cut_points.append((run_start + run_end) // 2)
+                run_start = start
+            run_end = end
+        position += len(line)
+    if run_end - run_start >= min_gap:
+        cut_points.append((run_start + run_end) // 2)
+    return cut_points
+
+
+def split_contig(contig, length, cut_points):
+    """
+    Splits one contig into pieces at the given cut points; returns (contig, start, end) tuples.
+    """
+    pieces = []
+    start = 1
+    for cut in cut_points:
+        if start <= cut < length:
+            pieces.append((contig, start, cut))
+            start = cut + 1
+    pieces.append((contig, start, length))
+    return pieces
+
+
+def make_shards(pieces, num_shards):
+    """
+    Greedily packs the pieces, in genomic order, into shards of roughly total_length / num_shards
+    bases each. Adjacent pieces of the same contig that end up in one shard are merged back into a
+    single interval.
+    """
+    total_length = sum(end - start + 1 for _, start, end in pieces)
+    target_length = total_length / max(1, num_shards)
+    shards = []
+    current, current_length = [], 0
+    for contig, start, end in pieces:
+        piece_length = end - start + 1
+        # close the current shard if adding this piece takes it further from the target size
+        if current and abs(current_length + piece_length - target_length) > abs(
+                current_length - target_length):
+            shards.append(current)
+            current, current_length = [], 0
+        if current and current[-1][0] == contig and current[-1][2] + 1 == start:
+            current[-1] = (contig, current[-1][1], end)
+        else:
+            current.append((contig, start, end))
+        current_length += piece_length
+    if current:
+        shards.append(current)
+    return shards
+
+
+def main(args_list=None):
+    if args_list is None:
+        args_list = sys.argv[1:]
+    args = parser.parse_args(args_list)
+
+    fai = read_fai(args.fai)
+    with open(args.contigs) as f:
+        contigs = [x.strip() for x in f.readlines() if x.strip()]
+
+    pieces = []
+    with open(args.reference, 'rb') as fasta:
+        for contig in contigs:
+            cut_points = find_cut_points(fasta, fai[contig], args.min_gap)
+            pieces.extend(split_contig(contig, fai[contig][0], cut_points))
+
+    shards = make_shards(pieces, args.num_shards)
+    with open(args.out, 'w') as out:
+        for i, shard in enumerate(shards):
+            for contig, start, end in shard:
+                out.write('shard%04d\t%s:%d-%d\n' % (i, contig, start, end))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,191 @@
+# Copyright (c) 2019. Mount Sinai School of Medicine
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Writes a Picard MarkDuplicates-style duplication metrics file for a BAM whose duplicates were
+marked by another tool (e.g. sambamba markdup), so that QC (sequencing.py) reads it the same way.
+
+Counts come from samtools flagstat of all reads and of the duplicate-flagged reads, following
+Picard's definitions: only mapped primary reads are examined, reads whose mate is mapped as well
+count as pairs, and PERCENT_DUPLICATION is the fraction of examined reads that are duplicates.
+Optical duplicates aren't told apart, so READ_PAIR_OPTICAL_DUPLICATES is always 0.
+"""
+
+from argparse import ArgumentParser
+from math import exp
+import subprocess
+
+import sys
+
+
+parser = ArgumentParser()
+
+parser.add_argument(
+    "--bam",
+    default="",
+    help="Path to the duplicate-marked BAM")
+
+parser.add_argument(
+    "--threads",
+    default=1,
+    type=int,
+    help="Number of samtools decompression threads, for each of the two flagstat passes")
+
+parser.add_argument(
+    "--out",
+    default="",
+    help="Output metrics file path")
+
+
+METRICS_COLUMNS = [
+    "LIBRARY",
+    "UNPAIRED_READS_EXAMINED",
+    "READ_PAIRS_EXAMINED",
+    "SECONDARY_OR_SUPPLEMENTARY_RDS",
+    "UNMAPPED_READS",
+    "UNPAIRED_READ_DUPLICATES",
+    "READ_PAIR_DUPLICATES",
+    "READ_PAIR_OPTICAL_DUPLICATES",
+    "PERCENT_DUPLICATION",
+    "ESTIMATED_LIBRARY_SIZE",
+]
+
+
+def parse_flagstat(text):
+    """
+    Returns a dict of samtools flagstat category (e.g. "mapped", "with itself and mate mapped") to
+    its count of QC-passed and QC-failed reads together.
+    """
+    counts = {}
+    for line in text.splitlines():
+        if not line.strip():
+            continue
+        passed, _, failed, category = line.split(" ", 3)
+        counts[category.split(" (")[0].strip()] = int(passed) + int(failed)
+    return counts
+
+
+def _examined_reads(counts):
+    """
+    Returns the numbers of mapped primary reads with and without a mapped mate
+    """
+    primary_mapped = counts["mapped"] - counts["secondary"] - counts["supplementary"]
+    paired = counts["with itself and mate mapped"]
+    return primary_mapped - paired, paired
+
+
+def _library_size_function(x, c, n):
+    return c / x - 1 + exp(-n / x)
+
+
+def estimate_library_size(read_pairs, unique_read_pairs):
+    """
+    Estimates the number of distinct molecules in the library from the number of read pairs and
+    of distinct read pairs, as Picard's DuplicationMetrics.estimateLibrarySize does. Returns None
+    if there are no duplicates to estimate it from.
+    """
+    if read_pairs <= 0 or unique_read_pairs >= read_pairs or unique_read_pairs <= 0:
+        return None
+    c, n = unique_read_pairs, read_pairs
+    lower, upper = 1.0, 100.0
+    while _library_size_function(upper * c, c, n) > 0:
+        upper *= 10
+    for _ in range(40):
+        r = (lower + upper) / 2
+        u = _library_size_function(r * c, c, n)
+        if u == 0:
+            break
+        elif u > 0:
+            lower = r
+        else:
+            upper = r
+    return int(c * (lower + upper) / 2)
+
+
+def duplication_metrics(counts, duplicate_counts, library):
+    unpaired_examined, paired_examined = _examined_reads(counts)
+    unpaired_duplicates, paired_duplicates = _examined_reads(duplicate_counts)
+    read_pairs_examined = paired_examined // 2
+    read_pair_duplicates = paired_duplicates // 2
+    examined = unpaired_examined + 2 * read_pairs_examined
+    duplicates = unpaired_duplicates + 2 * read_pair_duplicates
+    return {
+        "LIBRARY": library,
+        "UNPAIRED_READS_EXAMINED": unpaired_examined,
+        "READ_PAIRS_EXAMINED": read_pairs_examined,
+        "SECONDARY_OR_SUPPLEMENTARY_RDS": counts["secondary"] + counts["supplementary"],
+        "UNMAPPED_READS": counts["in total"] - counts["mapped"],
+        "UNPAIRED_READ_DUPLICATES": unpaired_duplicates,
+        "READ_PAIR_DUPLICATES": read_pair_duplicates,
+        "READ_PAIR_OPTICAL_DUPLICATES": 0,
+        "PERCENT_DUPLICATION": duplicates / examined if examined else 0.0,
+        "ESTIMATED_LIBRARY_SIZE": estimate_library_size(
+            read_pairs_examined, read_pairs_examined - read_pair_duplicates),
+    }
+
+
+def write_metrics(metrics, bam, path):
+    with open(path, 'w') as f:
+        f.write("## htsjdk.samtools.metrics.StringHeader\n")
+        f.write("# markdup_metrics.py --bam %s\n" % bam)
+        f.write("\n")
+        f.write("## METRICS CLASS\tpicard.sam.DuplicationMetrics\n")
+        f.write("\t".join(METRICS_COLUMNS) + "\n")
+        f.write("\t".join(
+            "" if metrics[x] is None else str(metrics[x]) for x in METRICS_COLUMNS) + "\n")
+
+
+def read_library(bam):
+    """
+    Returns the library (LB) of the BAM's first read group, or Picard's default if it has none
+    """
+    header = subprocess.check_output(["samtools", "view", "-H", bam]).decode()
+    for line in header.splitlines():
+        if line.startswith("@RG"):
+            for field in line.split("\t")[1:]:
+                if field.startswith("LB:"):
+                    return field[3:]
+    return "Unknown Library"
+
+
+def main(args_list=None):
+    if args_list is None:
+        args_list = sys.argv[1:]
+    args = parser.parse_args(args_list)
+    if not args.bam or not args.out:
+        raise ValueError("Must specify --bam and --out")
+
+    threads = str(args.threads)
+    # the two passes over the BAM run concurrently
+    flagstat = subprocess.Popen(
+        ["samtools", "flagstat", "-@", threads, args.bam], stdout=subprocess.PIPE)
+    duplicates = subprocess.Popen(
+        ["samtools", "view", "-u", "-f", "1024", "-@", threads, args.bam],
+        stdout=subprocess.PIPE)
+    duplicates_flagstat = subprocess.Popen(
+        ["samtools", "flagstat", "-"], stdin=duplicates.stdout, stdout=subprocess.PIPE)
+    duplicates.stdout.close()
+    flagstat_out, _ = flagstat.communicate()
+    duplicates_flagstat_out, _ = duplicates_flagstat.communicate()
+    if flagstat.returncode or duplicates.wait() or duplicates_flagstat.returncode:
+        raise ValueError("samtools failed on %s" % args.bam)
+
+    metrics = duplication_metrics(
+        parse_flagstat(flagstat_out.decode()),
+        parse_flagstat(duplicates_flagstat_out.decode()),
+        read_library(args.bam))
+    write_metrics(metrics, args.bam, args.out)
+
+if __name__ == "__main__":
+    main()
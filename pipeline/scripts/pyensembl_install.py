@@ -0,0 +1,110 @@
+# Copyright (c) 2019. Mount Sinai School of Medicine
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Installs the annotation data of an Ensembl release into a PyEnsembl cache directory from local
+files, and indexes it, so that Vaxrank can annotate variants with PYENSEMBL_CACHE_DIR pointing at
+that directory without downloading or indexing anything.
+
+The files are stored under the names PyEnsembl would download them as, gzipped if they aren't
+already. They must be the release's GTF and its cDNA, ncRNA and peptide FASTAs.
+"""
+
+from argparse import ArgumentParser
+import gzip
+from os import environ
+from os.path import abspath, exists
+import shutil
+
+import sys
+
+
+parser = ArgumentParser()
+
+parser.add_argument(
+    "--release",
+    type=int,
+    required=True,
+    help="Ensembl release the files belong to, e.g. 75 for GRCh37")
+
+parser.add_argument(
+    "--species",
+    default="human",
+    help="Species the files belong to")
+
+parser.add_argument(
+    "--gtf",
+    default="",
+    help="Path to the release's GTF file; may be gzipped")
+
+parser.add_argument(
+    "--cdna-fasta",
+    default="",
+    help="Path to the release's cDNA FASTA (cdna.all.fa); may be gzipped")
+
+parser.add_argument(
+    "--ncrna-fasta",
+    default="",
+    help="Path to the release's ncRNA FASTA (ncrna.fa); may be gzipped")
+
+parser.add_argument(
+    "--protein-fasta",
+    default="",
+    help="Path to the release's peptide FASTA (pep.all.fa); may be gzipped")
+
+parser.add_argument(
+    "--cache-dir",
+    default="",
+    help="PyEnsembl cache directory to install into")
+
+
+def is_gzipped(path):
+    with open(path, 'rb') as f:
+        return f.read(2) == b'\x1f\x8b'
+
+
+def copy_gzipped(path, dest):
+    if is_gzipped(path):
+        shutil.copyfile(path, dest)
+    else:
+        with open(path, 'rb') as f, gzip.open(dest, 'wb') as out:
+            shutil.copyfileobj(f, out)
+
+
+def main(args_list=None):
+    if args_list is None:
+        args_list = sys.argv[1:]
+    args = parser.parse_args(args_list)
+    local_paths = [args.gtf, args.cdna_fasta, args.ncrna_fasta, args.protein_fasta]
+    for path in local_paths:
+        if not path or not exists(path):
+            raise ValueError(
+                "Must specify existing --gtf, --cdna-fasta, --ncrna-fasta and --protein-fasta "
+                "files, got %s" % path)
+    if not args.cache_dir:
+        raise ValueError("Must specify --cache-dir")
+
+    # PyEnsembl reads the cache directory from the environment when a genome is created
+    environ["PYENSEMBL_CACHE_DIR"] = abspath(args.cache_dir)
+    from pyensembl import EnsemblRelease
+
+    genome = EnsemblRelease(release=args.release, species=args.species)
+    # the order in which EnsemblRelease lists its files: cDNA before ncRNA
+    urls = [genome.gtf_url] + genome.transcript_fasta_urls + genome.protein_fasta_urls
+    for path, url in zip(local_paths, urls):
+        copy_gzipped(path, genome.download_cache.cached_path(url))
+    genome.index(overwrite=True)
+
+if __name__ == "__main__":
+    main()
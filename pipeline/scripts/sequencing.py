@@ -13,6 +13,8 @@
 # limitations under the License.
 
 from argparse import ArgumentParser
+import gzip
+import json
 import pandas as pd
 import yaml
 
@@ -49,7 +51,27 @@ parser.add_argument(
 parser.add_argument(
     "--out",
     default="",
-    help="Output file path for any failed tests")
+    help="Output file path for any failed tests; a JSON report when running as a --gate")
+
+parser.add_argument(
+    "--gate",
+    default="",
+    help="Metrics type (e.g. tumor_dna_duplication_metrics) to check on its own as a QC gate: "
+        "writes a JSON report to --out and exits with an error if any of its checks fail")
+
+parser.add_argument(
+    "--estimate-from-fastq",
+    nargs="*",
+    default=None,
+    help="When running as a --gate on duplication metrics, estimate them from the first reads of "
+        "these FASTQ files instead of reading Picard's output, and only warn about broken checks. "
+        "Paired-end FASTQs are given as R1,R2 path pairs.")
+
+parser.add_argument(
+    "--subsample-reads",
+    type=int,
+    default=1000000,
+    help="Number of reads (or read pairs) to estimate duplication from, across all FASTQ files")
 
 
 def get_metrics(path):
@@ -62,6 +84,107 @@ def get_coverage_metrics(path):
     return {k: metrics[k] for k in ('MEAN_TARGET_COVERAGE', 'MEAN_BAIT_COVERAGE')}
 
 
+def _open_fastq(path):
+    with open(path, 'rb') as f:
+        is_gzipped = f.read(2) == b'\x1f\x8b'
+    return gzip.open(path, 'rt') if is_gzipped else open(path)
+
+
+def _read_sequences(path, num_reads):
+    with _open_fastq(path) as f:
+        for i, line in enumerate(f):
+            if i // 4 >= num_reads:
+                break
+            if i % 4 == 1:
+                yield line.rstrip("\n")
+
+
+def estimate_duplication_metrics(fastq_args, num_reads):
+    """
+    Estimates PERCENT_DUPLICATION from the first reads of each FASTQ (or R1,R2 pair), as the
+    fraction of reads whose sequence (both ends' sequences, for pairs) was already seen. This is
+    only a rough estimate of what MarkDuplicates finds: fewer reads have fewer chances to collide,
+    but identical low-complexity or N-containing reads needn't align to the same position, and the
+    first reads of a FASTQ needn't be typical of the whole run.
+    """
+    if not fastq_args:
+        return {}
+    reads_per_fragment = max(1, num_reads // len(fastq_args))
+    seen = set()
+    total = 0
+    for fastq_arg in fastq_args:
+        sequences = zip(*[
+            _read_sequences(path, reads_per_fragment) for path in fastq_arg.split(",")])
+        for read in sequences:
+            total += 1
+            seen.add(hash(read))
+    return {
+        'PERCENT_DUPLICATION': 1 - len(seen) / total if total else 0.0,
+        'READS_SAMPLED': total,
+    }
+
+
+def check_metrics(file_type, metrics, metric_specs):
+    """
+    Returns a dict describing each metric spec that the metrics break.
+    """
+    failures = []
+    for metric_spec in metric_specs:
+        key = metric_spec['key']
+        expected_value = metric_spec['value']
+        comparator = metric_spec['comparator']
+        if comparator == 'MIN':
+            failed = metrics[key] < expected_value
+            expectation = 'at least'
+        elif comparator == 'MAX':
+            failed = metrics[key] > expected_value
+            expectation = 'at most'
+        else:
+            print('Unknown comparator, skipping: %s' % comparator)
+            continue
+        if failed:
+            failures.append({
+                'metrics_type': file_type,
+                'key': key,
+                'comparator': comparator,
+                'expected': expected_value,
+                'actual': float(metrics[key]),
+                'message': '%s: %s expected to be %s %.3f but was %.3f' % (
+                    file_type, key, expectation, expected_value, metrics[key]),
+            })
+    return failures
+
+
+def run_gate(args, metrics_file_to_path, all_metric_specs):
+    """
+    Checks a single metrics type, writing a JSON report to args.out. Returns whether all checks
+    passed. Checks of estimated metrics are advisory: they always pass, and the checks they break
+    are reported as warnings.
+    """
+    metric_specs = all_metric_specs.get(args.gate, [])
+    estimated = args.estimate_from_fastq is not None
+    if estimated:
+        metrics = estimate_duplication_metrics(args.estimate_from_fastq, args.subsample_reads)
+        metric_specs = [x for x in metric_specs if x['key'] in metrics]
+        source = args.estimate_from_fastq
+    else:
+        source = metrics_file_to_path[args.gate]
+        metrics = get_metrics(source)
+    failures = check_metrics(args.gate, metrics, metric_specs)
+    for failure in failures:
+        print(('Warning (estimated): %s' if estimated else '%s') % failure['message'])
+    with open(args.out, 'w') as report_file:
+        json.dump({
+            'metrics_type': args.gate,
+            'source': source,
+            'estimated': estimated,
+            'passed': estimated or not failures,
+            'failures': [] if estimated else failures,
+            'warnings': failures if estimated else [],
+        }, report_file, indent=2)
+    return estimated or not failures
+
+
 def main(args_list=None):
     if args_list is None:
         args_list = sys.argv[1:]
@@ -78,33 +201,21 @@ def main(args_list=None):
     with open(args.metrics_spec_file) as metrics_spec_file:
         all_metric_specs = yaml.safe_load(metrics_spec_file)
 
+    if args.gate:
+        if not run_gate(args, metrics_file_to_path, all_metric_specs):
+            sys.exit(1)
+        return
+
     with open(args.out, 'w') as error_msg_file:    
         for file_type, metric_specs in all_metric_specs.items():
             # get actual metric counts
             path = metrics_file_to_path[file_type]
-            with open(path) as metrics_file:
-                metrics = get_metrics(path)
+            metrics = get_metrics(path)
 
             # iterate through each metric rule, check that each isn't broken in the metric counts
-            for metric_spec in metric_specs:
-                key = metric_spec['key']
-                expected_value = metric_spec['value']
-                if metric_spec['comparator'] == 'MIN':
-                    if metrics[key] < expected_value:
-                        error_msg = '%s: %s expected to be at least %.3f but was %.3f' % (
-                            file_type, key, expected_value, metrics[key]
-                        )
-                        print(error_msg)
-                        error_msg_file.write(error_msg + '\n')
-                elif metric_spec['comparator'] == 'MAX':
-                    if metrics[key] > expected_value:
-                        error_msg = '%s: %s expected to be at most %.3f but was %.3f' % (
-                            file_type, key, expected_value, metrics[key]
-                        )
-                        print(error_msg)
-                        error_msg_file.write(error_msg + '\n')
-                else:
-                    print('Unknown comparator, skipping: %s' % metric_spec['comparator'])
+            for failure in check_metrics(file_type, metrics, metric_specs):
+                print(failure['message'])
+                error_msg_file.write(failure['message'] + '\n')
 
 if __name__ == "__main__":
     main()
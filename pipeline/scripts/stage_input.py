@@ -0,0 +1,140 @@
+# Copyright (c) 2019. Mount Sinai School of Medicine
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Stages one input sequencing file into the sample workdir, as cheaply as possible: a hardlink or
+reflink when the source is on the same filesystem, otherwise a copy (or gsutil for gs:// paths).
+Optionally computes an MD5 checksum in the same pass and checks it against an expected value.
+"""
+
+from argparse import ArgumentParser
+import hashlib
+import os
+import shutil
+import subprocess
+
+import sys
+
+
+parser = ArgumentParser()
+
+parser.add_argument(
+    "--source",
+    default="",
+    help="Path of the input file to stage; may be a gs:// URL")
+
+parser.add_argument(
+    "--dest",
+    default="",
+    help="Destination path in the sample workdir")
+
+parser.add_argument(
+    "--mode",
+    default="auto",
+    choices=["auto", "symlink", "copy"],
+    help="auto: hardlink or reflink if possible, else copy; symlink: always symlink; "
+        "copy: always copy (default %(default)s)")
+
+parser.add_argument(
+    "--checksum",
+    help="If this argument is present, compute the MD5 of the staged data and write it to "
+        "<dest>.md5",
+    action="store_true")
+
+parser.add_argument(
+    "--expected-md5",
+    default="",
+    help="If given, fail unless the MD5 of the staged data matches this value")
+
+
+BLOCK_SIZE = 4 * 1024 * 1024
+
+
+def md5_of(path):
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(BLOCK_SIZE), b''):
+            md5.update(block)
+    return md5.hexdigest()
+
+
+def copy_with_md5(source, dest):
+    """
+    Copies source to dest, computing the MD5 of the data on the way through.
+    """
+    md5 = hashlib.md5()
+    with open(source, 'rb') as src, open(dest, 'wb') as dst:
+        for block in iter(lambda: src.read(BLOCK_SIZE), b''):
+            md5.update(block)
+            dst.write(block)
+    shutil.copystat(source, dest)
+    return md5.hexdigest()
+
+
+def try_link(source, dest):
+    """
+    Tries a hardlink, then a reflink; returns True if either worked.
+    """
+    if os.stat(source).st_dev == os.stat(os.path.dirname(os.path.abspath(dest))).st_dev:
+        try:
+            os.link(source, dest)
+            return True
+        except OSError:
+            pass
+    # reflinks share data blocks on copy-on-write filesystems (btrfs, XFS); cp fails otherwise
+    return subprocess.call(
+        ["cp", "-p", "--reflink=always", source, dest], stderr=subprocess.DEVNULL) == 0
+
+
+def stage(source, dest, mode, checksum):
+    """
+    Stages source at dest, returns the MD5 of the data if checksum is True, else None.
+    """
+    if source.startswith("gs://"):
+        # gsutil verifies its own transfers with CRC32C checksums
+        subprocess.check_call(["gsutil", "-m", "cp", source, dest])
+        return md5_of(dest) if checksum else None
+
+    if mode == "symlink":
+        os.symlink(os.path.realpath(source), dest)
+    elif mode == "auto" and try_link(source, dest):
+        pass
+    elif checksum:
+        return copy_with_md5(source, dest)
+    else:
+        shutil.copy2(source, dest)
+    # linked (or plainly copied) data still needs a read to checksum
+    return md5_of(dest) if checksum else None
+
+
+def main(args_list=None):
+    if args_list is None:
+        args_list = sys.argv[1:]
+    args = parser.parse_args(args_list)
+
+    if os.path.lexists(args.dest):
+        os.remove(args.dest)
+    checksum = stage(
+        args.source, args.dest, args.mode, checksum=args.checksum or bool(args.expected_md5))
+
+    if args.expected_md5 and checksum != args.expected_md5.lower():
+        os.remove(args.dest)
+        raise ValueError("MD5 mismatch for %s: expected %s but was %s" % (
+            args.source, args.expected_md5, checksum))
+    if checksum is not None:
+        with open(args.dest + ".md5", 'w') as f:
+            f.write("%s  %s\n" % (checksum, os.path.basename(args.dest)))
+
+if __name__ == "__main__":
+    main()
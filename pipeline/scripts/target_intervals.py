@@ -0,0 +1,124 @@
+# Copyright (c) 2019. Mount Sinai School of Medicine
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Splits the capture target intervals of an exome over the regions that per-region GATK and
+variant calling jobs scatter over (contigs, or interval shards).
+
+Writes one GATK .intervals file per region that contains any targets, named after the region, with
+the targets clipped to the region: one contig:start-end interval (1-based and inclusive) per line.
+Regions without targets get no file, so that they can be left out of the scatter.
+"""
+
+from argparse import ArgumentParser
+from collections import OrderedDict
+from os import makedirs
+from os.path import join
+
+import sys
+
+
+parser = ArgumentParser()
+
+parser.add_argument(
+    "--interval-list",
+    default="",
+    help="Path to the Picard interval list of (padded) capture targets")
+
+parser.add_argument(
+    "--contigs",
+    default="",
+    help="Path to file listing the contigs to scatter over, one per line")
+
+parser.add_argument(
+    "--shards",
+    default="",
+    help="Path to interval shards to scatter over instead (see interval_shards.py)")
+
+parser.add_argument(
+    "--out-dir",
+    default="",
+    help="Directory to write a <region>.intervals file per region with targets to")
+
+
+def read_interval_list(path):
+    """
+    Returns a dict of contig name to its (start, end) targets, in file order.
+    """
+    targets = {}
+    with open(path) as f:
+        for line in f:
+            if line.startswith("@") or not line.strip():
+                continue
+            contig, start, end = line.split("\t")[:3]
+            targets.setdefault(contig, []).append((int(start), int(end)))
+    return targets
+
+
+def read_regions(contigs_path, shards_path):
+    """
+    Returns an ordered dict of region name to its (contig, start, end) intervals, where end is None
+    for a whole contig.
+    """
+    regions = OrderedDict()
+    if shards_path:
+        with open(shards_path) as f:
+            for line in f:
+                shard, interval = line.strip().split("\t")
+                contig, span = interval.rsplit(":", 1)
+                start, end = span.split("-")
+                regions.setdefault(shard, []).append((contig, int(start), int(end)))
+    else:
+        with open(contigs_path) as f:
+            for line in f:
+                if line.strip():
+                    regions[line.strip()] = [(line.strip(), 1, None)]
+    return regions
+
+
+def region_targets(intervals, targets):
+    """
+    Returns the targets overlapping a region's intervals, clipped to them.
+    """
+    clipped = []
+    for contig, start, end in intervals:
+        for target_start, target_end in targets.get(contig, []):
+            if target_end < start or (end is not None and target_start > end):
+                continue
+            clipped.append((
+                contig,
+                max(start, target_start),
+                target_end if end is None else min(end, target_end)))
+    return clipped
+
+
+def main(args_list=None):
+    if args_list is None:
+        args_list = sys.argv[1:]
+    args = parser.parse_args(args_list)
+    if not args.interval_list or not args.out_dir or not (args.contigs or args.shards):
+        raise ValueError("Must specify --interval-list, --out-dir and --contigs or --shards")
+
+    targets = read_interval_list(args.interval_list)
+    makedirs(args.out_dir, exist_ok=True)
+    for region, intervals in read_regions(args.contigs, args.shards).items():
+        clipped = region_targets(intervals, targets)
+        if not clipped:
+            continue
+        with open(join(args.out_dir, region + ".intervals"), 'w') as out:
+            for contig, start, end in clipped:
+                out.write("%s:%d-%d\n" % (contig, start, end))
+
+if __name__ == "__main__":
+    main()
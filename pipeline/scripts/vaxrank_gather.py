@@ -0,0 +1,127 @@
+# Copyright (c) 2019. Mount Sinai School of Medicine
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Merges the outputs of Vaxrank runs on shards of a sample's variants (see vcf_shards.py) into what a
+single run over all variants would have written: one JSON report data file, in which variants are
+ranked by their best vaccine peptide across all shards, and one passing variants CSV. The text, PDF
+and Excel reports are then made from the merged JSON file by vaxrank --input-json-file.
+
+Prints the number of ranked variants, which vaxrank --input-json-file needs as
+--max-mutations-in-report.
+"""
+
+from argparse import ArgumentParser
+
+import pandas as pd
+import serializable
+
+import sys
+
+
+parser = ArgumentParser()
+
+parser.add_argument(
+    "--input-json",
+    nargs="+",
+    default=[],
+    help="Paths of the JSON report data files written by Vaxrank for each shard")
+
+parser.add_argument(
+    "--input-passing-variants-csv",
+    nargs="+",
+    default=[],
+    help="Paths of the passing variants CSVs written by Vaxrank for each shard")
+
+parser.add_argument(
+    "--vcf",
+    nargs="+",
+    default=[],
+    help="Paths of the unsharded VCFs, to list in the merged report")
+
+parser.add_argument(
+    "--out-json",
+    default="",
+    help="Output path for the merged JSON report data")
+
+parser.add_argument(
+    "--out-passing-variants-csv",
+    default="",
+    help="Output path for the merged passing variants CSV")
+
+# counts in Vaxrank's PatientInfo that add up over disjoint sets of variants
+PATIENT_INFO_COUNTS = [
+    "num_somatic_variants",
+    "num_coding_effect_variants",
+    "num_variants_with_rna_support",
+    "num_variants_with_vaccine_peptides",
+]
+
+
+# Vaxrank's ranking (see VaxrankCoreLogic.ranked_vaccine_peptides): by the combined score of each
+# variant's best vaccine peptide
+def _ranking_key(variant_with_vaccine_peptides):
+    vaccine_peptides = variant_with_vaccine_peptides[1]
+    return vaccine_peptides[0].combined_score if len(vaccine_peptides) > 0 else 0.0
+
+
+def merge_report_data(shard_data, vcf_paths):
+    variants = [x for data in shard_data for x in data['variants']]
+    # stable, so that ties keep their shard order
+    variants.sort(key=_ranking_key, reverse=True)
+    patient_info = shard_data[0]['patient_info']._replace(
+        vcf_paths=vcf_paths,
+        **{key: sum(getattr(data['patient_info'], key) for data in shard_data)
+            for key in PATIENT_INFO_COUNTS})
+    args = dict(shard_data[0]['args'])
+    args['vcf'] = vcf_paths
+    return {
+        'variants': variants,
+        'patient_info': patient_info,
+        'args': args,
+    }
+
+
+# Rows are sorted by position, as Vaxrank writes them for a whole variant collection
+def merge_passing_variants(paths):
+    df = pd.concat([pd.read_csv(path) for path in paths], ignore_index=True)
+    if "contig" in df.columns and "start" in df.columns:
+        df = df.assign(contig_name=df["contig"].astype(str)).sort_values(
+            ["contig_name", "start"], kind="mergesort").drop(columns=["contig_name"])
+    return df
+
+
+def main(args_list=None):
+    if args_list is None:
+        args_list = sys.argv[1:]
+    args = parser.parse_args(args_list)
+    if not args.input_json:
+        raise ValueError("Must specify at least one --input-json file")
+
+    shard_data = []
+    for path in args.input_json:
+        with open(path) as f:
+            shard_data.append(serializable.from_json(f.read()))
+    data = merge_report_data(shard_data, args.vcf)
+    with open(args.out_json, 'w') as f:
+        f.write(serializable.to_json(data))
+
+    if args.input_passing_variants_csv:
+        merge_passing_variants(args.input_passing_variants_csv).to_csv(
+            args.out_passing_variants_csv, index=False)
+
+    print(len(data['variants']))
+
+if __name__ == "__main__":
+    main()
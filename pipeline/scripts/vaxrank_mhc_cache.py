@@ -0,0 +1,237 @@
+# Copyright (c) 2019. Mount Sinai School of Medicine
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Runs Vaxrank with its MHC binding predictions cached on disk, so that the peptide-allele pairs
+predicted by earlier runs (other patients sharing an allele and a recurrent mutation, or reruns of
+the same patient with other Vaxrank parameters) are not predicted again.
+
+Predictions are stored in a SQLite database keyed by (predictor, predictor version, allele,
+peptide). Concurrent Vaxrank jobs may share a database: writes are serialized by SQLite, and a job
+waits for the others' transactions to finish. Once the database holds more than --max-entries
+predictions, the least recently used ones are deleted.
+
+All arguments other than the ones below are passed on to Vaxrank. The numbers of cache hits and
+misses are written to the Vaxrank log.
+"""
+
+from argparse import ArgumentParser
+import functools
+import importlib
+import logging
+from os import makedirs
+from os.path import dirname
+import sqlite3
+import time
+
+import mhctools
+from mhctools import BindingPrediction, BindingPredictionCollection
+from mhctools.base_predictor import BasePredictor
+
+import sys
+
+
+parser = ArgumentParser()
+
+parser.add_argument(
+    "--cache-path",
+    default="",
+    help="Path to the SQLite database of cached MHC binding predictions; created if missing")
+
+parser.add_argument(
+    "--max-entries",
+    type=int,
+    default=5000000,
+    help="Number of predictions to keep in the cache, evicting the least recently used ones")
+
+# logged to the Vaxrank log file, which Vaxrank's logging config attaches to the vaxrank logger
+logger = logging.getLogger("vaxrank.mhc_prediction_cache")
+
+# predictors wrapping a Python package, whose version is part of the predictor version
+PACKAGE_PREDICTORS = {"mhcflurry"}
+
+# SQLite's default limit on the number of parameters of a statement is 999
+QUERY_BATCH_SIZE = 500
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS predictions (
+    predictor TEXT NOT NULL,
+    predictor_version TEXT NOT NULL,
+    allele TEXT NOT NULL,
+    peptide TEXT NOT NULL,
+    affinity REAL,
+    percentile_rank REAL,
+    score REAL,
+    prediction_method_name TEXT,
+    last_used REAL NOT NULL,
+    PRIMARY KEY (predictor, predictor_version, allele, peptide)
+);
+CREATE INDEX IF NOT EXISTS predictions_last_used ON predictions (last_used);
+"""
+
+
+def get_predictor_version(predictor_name):
+    """
+    Returns the version of the code behind a predictor: mhctools, plus the Python package the
+    predictor wraps if there is one. Versions of command-line predictors (e.g. netMHCpan) aren't
+    known, so the cache must be cleared after upgrading one.
+    """
+    versions = ["mhctools %s" % mhctools.__version__]
+    if predictor_name in PACKAGE_PREDICTORS:
+        package = importlib.import_module(predictor_name)
+        versions.append("%s %s" % (predictor_name, package.__version__))
+    return ", ".join(versions)
+
+
+class PredictionCache(object):
+    def __init__(self, path, max_entries):
+        if dirname(path):
+            makedirs(dirname(path), exist_ok=True)
+        # wait for concurrent jobs' transactions for as long as a prediction could take
+        self.connection = sqlite3.connect(path, timeout=3600)
+        # WAL lets jobs read the cache while another one is writing to it
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        with self.connection:
+            self.connection.executescript(SCHEMA)
+        # (predictor, predictor version), set once the predictor is known
+        self.key = None
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, allele, peptides):
+        """
+        Returns a dict of peptide to BindingPrediction for the cached predictions for an allele,
+        and marks them as used.
+        """
+        results = {}
+        now = time.time()
+        with self.connection:
+            for i in range(0, len(peptides), QUERY_BATCH_SIZE):
+                batch = peptides[i:i + QUERY_BATCH_SIZE]
+                where = "predictor = ? AND predictor_version = ? AND allele = ? AND " \
+                    "peptide IN (%s)" % ", ".join("?" * len(batch))
+                rows = self.connection.execute(
+                    "SELECT peptide, affinity, percentile_rank, score, "
+                    "prediction_method_name FROM predictions WHERE " + where,
+                    self.key + (allele,) + tuple(batch))
+                for peptide, affinity, percentile_rank, score, method_name in rows:
+                    results[peptide] = BindingPrediction(
+                        peptide=peptide,
+                        allele=allele,
+                        affinity=affinity,
+                        percentile_rank=percentile_rank,
+                        score=score,
+                        prediction_method_name=method_name)
+                self.connection.execute(
+                    "UPDATE predictions SET last_used = ? WHERE " + where,
+                    (now,) + self.key + (allele,) + tuple(batch))
+        return results
+
+    def put(self, binding_predictions):
+        now = time.time()
+        with self.connection:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO predictions VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                [self.key + (x.allele, x.peptide, x.affinity, x.percentile_rank,
+                    x.score, x.prediction_method_name, now)
+                    for x in binding_predictions])
+            self.evict()
+
+    def evict(self):
+        num_entries = self.connection.execute("SELECT COUNT(*) FROM predictions").fetchone()[0]
+        if num_entries > self.max_entries:
+            self.connection.execute(
+                "DELETE FROM predictions WHERE rowid IN "
+                "(SELECT rowid FROM predictions ORDER BY last_used LIMIT ?)",
+                (num_entries - self.max_entries,))
+            logger.info("Evicted %d MHC binding predictions from the cache",
+                num_entries - self.max_entries)
+
+    def predict_peptides(self, predict_peptides, alleles, peptides):
+        """
+        Predicts binding of peptides to alleles, only calling predict_peptides for the peptides
+        that are missing a cached prediction for one of the alleles.
+        """
+        peptides = sorted(set(peptides))
+        cached = []
+        uncached_peptides = set()
+        for allele in alleles:
+            allele_predictions = self.get(allele, peptides)
+            cached.extend(allele_predictions.values())
+            uncached_peptides.update(x for x in peptides if x not in allele_predictions)
+            self.hits += len(allele_predictions)
+            self.misses += len(peptides) - len(allele_predictions)
+        if not uncached_peptides:
+            return BindingPredictionCollection(cached)
+
+        # the predictor predicts all alleles at once, so cached predictions of these peptides are
+        # replaced by fresh ones
+        predicted = predict_peptides(sorted(uncached_peptides))
+        self.put(predicted)
+        return BindingPredictionCollection(
+            [x for x in cached if x.peptide not in uncached_peptides] + list(predicted))
+
+
+def cached_binding_predictor_from_args(cache, predictor_from_args):
+    """
+    Wraps mhctools' mhc_binding_predictor_from_args, as used by Vaxrank, so that its predictors look
+    up predictions in the cache. Vaxrank predicts the mutant epitopes with predict_subsequences,
+    which the IEDB predictors implement with whole-sequence IEDB queries that would bypass the
+    cache, so every predictor's predict_subsequences is replaced by mhctools' generic one: it splits
+    the sequences into peptides and predicts them with the cached predict_peptides.
+    """
+    def binding_predictor_from_args(args):
+        predictor = predictor_from_args(args)
+        cache.key = (args.mhc_predictor, get_predictor_version(args.mhc_predictor))
+        predictor_class = type(predictor)
+        if predictor_class.predict_subsequences is BasePredictor.predict_subsequences:
+            predict_uncached = predictor.predict_peptides
+        else:
+            # the IEDB predictors' predict_peptides calls predict_subsequences, which is replaced
+            # below, so cache misses go straight to the class's own predict_subsequences
+            def predict_uncached(peptides):
+                predictions = []
+                for length in sorted({len(x) for x in peptides}):
+                    predictions.extend(predictor_class.predict_subsequences(
+                        predictor, {x: x for x in peptides if len(x) == length},
+                        peptide_lengths=[length]))
+                return BindingPredictionCollection(predictions)
+        predictor.predict_peptides = lambda peptides: cache.predict_peptides(
+            predict_uncached, predictor.alleles, peptides)
+        predictor.predict_subsequences = functools.partial(
+            BasePredictor.predict_subsequences, predictor)
+        return predictor
+    return binding_predictor_from_args
+
+
+def main(args_list=None):
+    if args_list is None:
+        args_list = sys.argv[1:]
+    args, vaxrank_args = parser.parse_known_args(args_list)
+    if not args.cache_path:
+        raise ValueError("Must specify --cache-path")
+
+    # Vaxrank's CLI pulls in its whole stack (isovar, varcode, pyensembl), which the cache itself
+    # doesn't need
+    import vaxrank.cli
+    cache = PredictionCache(args.cache_path, args.max_entries)
+    vaxrank.cli.mhc_binding_predictor_from_args = cached_binding_predictor_from_args(
+        cache, vaxrank.cli.mhc_binding_predictor_from_args)
+    vaxrank.cli.main(vaxrank_args)
+    logger.info("MHC binding prediction cache %s: %d hits, %d misses", args.cache_path,
+        cache.hits, cache.misses)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,232 @@
+# Copyright (c) 2019. Mount Sinai School of Medicine
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Gathers sorted VCF files (e.g. the per-region outputs of a scattered variant caller) into one VCF.
+Headers are merged once; records are streamed from all inputs at the same time and written in the
+contig order of the reference sequence dictionary, holding a single record per input in memory.
+Inputs may overlap (e.g. SNV and indel calls over the same regions), but each must be sorted.
+
+Fails if the inputs have different sample columns, conflicting INFO/FORMAT/FILTER/contig
+definitions, contigs missing from the sequence dictionary, or records out of order.
+"""
+
+from argparse import ArgumentParser
+import gzip
+import heapq
+import re
+import struct
+import zlib
+
+import sys
+
+
+parser = ArgumentParser()
+
+parser.add_argument(
+    "--input",
+    nargs="+",
+    default=[],
+    help="Paths of the VCF files to gather; may be gzipped or bgzipped")
+
+parser.add_argument(
+    "--sequence-dict",
+    default="",
+    help="Path to the reference sequence dictionary (.dict), which determines the contig order")
+
+parser.add_argument(
+    "--out",
+    default="",
+    help="Output VCF file path")
+
+parser.add_argument(
+    "--bgzip",
+    help="If this argument is present, the output is written BGZF-compressed, so that it can be "
+        "indexed by tabix",
+    action="store_true")
+
+
+# header lines whose definitions must agree between inputs, if they share an ID
+STRUCTURED_HEADER_KEYS = {"INFO", "FORMAT", "FILTER", "contig"}
+
+HEADER_ID_REGEX = re.compile(r"^##([^=]+)=<ID=([^,>]+)")
+
+# largest BGZF block payload used by htslib, which leaves room for incompressible data
+BGZF_BLOCK_SIZE = 0xff00
+
+
+def read_sequence_dict(path):
+    """
+    Returns a dict of contig name to its index in the sequence dictionary.
+    """
+    contig_order = {}
+    with open(path) as f:
+        for line in f:
+            if not line.startswith("@SQ"):
+                continue
+            for field in line.rstrip("\n").split("\t")[1:]:
+                if field.startswith("SN:"):
+                    contig_order[field[3:]] = len(contig_order)
+    return contig_order
+
+
+def open_vcf(path):
+    with open(path, 'rb') as f:
+        is_gzipped = f.read(2) == b'\x1f\x8b'
+    return gzip.open(path, 'rt') if is_gzipped else open(path)
+
+
+def read_header(path, f):
+    """
+    Reads the header of an open VCF, leaving f at the first record. Returns the ## lines and the
+    #CHROM line.
+    """
+    meta_lines = []
+    for line in f:
+        if line.startswith("##"):
+            meta_lines.append(line)
+        elif line.startswith("#"):
+            return meta_lines, line
+        else:
+            break
+    raise ValueError("%s has no #CHROM header line" % path)
+
+
+def _header_key(line):
+    match = HEADER_ID_REGEX.match(line)
+    if match:
+        return match.groups()
+    return (line.split("=", 1)[0], None)
+
+
+def merge_headers(headers, paths, contig_order):
+    """
+    Returns the merged header lines of all inputs: the ## lines of the first input followed by
+    any not seen before from the others, then the shared #CHROM line. Other than INFO, FORMAT,
+    FILTER and contig definitions, the first input's value wins for a repeated header key (such as
+    the command line of the tool that produced each shard).
+    """
+    merged = {}
+    for (meta_lines, columns), path in zip(headers, paths):
+        if columns != headers[0][1]:
+            raise ValueError("%s has different columns than %s: %s" % (
+                path, paths[0], columns.strip()))
+        for line in meta_lines:
+            key = _header_key(line)
+            if key not in merged:
+                merged[key] = line
+            elif key[0] in STRUCTURED_HEADER_KEYS and merged[key] != line:
+                raise ValueError("Conflicting header definitions in %s and %s: %s vs %s" % (
+                    paths[0], path, merged[key].strip(), line.strip()))
+
+    contig_lines = [(key[1], line) for key, line in merged.items() if key[0] == "contig"]
+    for contig, _ in contig_lines:
+        if contig not in contig_order:
+            raise ValueError("Contig %s is not in the sequence dictionary" % contig)
+    # contig lines go where the first one was, in sequence dictionary order
+    contig_lines.sort(key=lambda x: contig_order[x[0]])
+    lines = []
+    for key, line in merged.items():
+        if key[0] != "contig":
+            lines.append(line)
+        elif contig_lines:
+            lines.extend(line for _, line in contig_lines)
+            contig_lines = []
+    lines.append(headers[0][1])
+    return lines
+
+
+def sorted_records(path, f, contig_order):
+    """
+    Yields ((contig index, position), record line) for every record in an open VCF, checking that
+    the records are sorted.
+    """
+    previous_key = None
+    for line in f:
+        if not line.strip():
+            continue
+        chrom, pos = line.split("\t", 2)[:2]
+        if chrom not in contig_order:
+            raise ValueError("Contig %s in %s is not in the sequence dictionary" % (chrom, path))
+        key = (contig_order[chrom], int(pos))
+        if previous_key is not None and key < previous_key:
+            raise ValueError("%s is not sorted: %s:%s comes after a later position" % (
+                path, chrom, pos))
+        previous_key = key
+        yield key, line
+
+
+class BgzfWriter(object):
+    """
+    Writes text as BGZF: a series of independently gzipped blocks, each recording its own
+    compressed size, followed by the empty end-of-file block.
+    """
+    def __init__(self, path):
+        self.f = open(path, 'wb')
+        self.buffer = bytearray()
+
+    def write(self, text):
+        self.buffer.extend(text.encode())
+        while len(self.buffer) >= BGZF_BLOCK_SIZE:
+            self._write_block(bytes(self.buffer[:BGZF_BLOCK_SIZE]))
+            del self.buffer[:BGZF_BLOCK_SIZE]
+
+    def _write_block(self, data):
+        compressor = zlib.compressobj(6, zlib.DEFLATED, -15)
+        compressed = compressor.compress(data) + compressor.flush()
+        # gzip header with the BC extra subfield, holding the total block size minus 1
+        self.f.write(struct.pack(
+            '<4BI2BH2BHH', 31, 139, 8, 4, 0, 0, 255, 6, 66, 67, 2, len(compressed) + 25))
+        self.f.write(compressed)
+        self.f.write(struct.pack('<2I', zlib.crc32(data) & 0xffffffff, len(data)))
+
+    def close(self):
+        if self.buffer:
+            self._write_block(bytes(self.buffer))
+        self._write_block(b'')
+        self.f.close()
+
+
+def gather(paths, contig_order, out):
+    files = [open_vcf(path) for path in paths]
+    try:
+        headers = [read_header(path, f) for path, f in zip(paths, files)]
+        out.write("".join(merge_headers(headers, paths, contig_order)))
+        # ties keep input order, so disjoint shards come out concatenated
+        records = heapq.merge(
+            *[sorted_records(path, f, contig_order) for path, f in zip(paths, files)],
+            key=lambda x: x[0])
+        for _, line in records:
+            out.write(line if line.endswith("\n") else line + "\n")
+    finally:
+        for f in files:
+            f.close()
+
+
+def main(args_list=None):
+    if args_list is None:
+        args_list = sys.argv[1:]
+    args = parser.parse_args(args_list)
+    if not args.input:
+        raise ValueError("Must specify at least one --input VCF")
+
+    contig_order = read_sequence_dict(args.sequence_dict)
+    out = BgzfWriter(args.out) if args.bgzip else open(args.out, 'w')
+    try:
+        gather(args.input, contig_order, out)
+    finally:
+        out.close()
+
+if __name__ == "__main__":
+    main()
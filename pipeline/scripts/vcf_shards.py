@@ -0,0 +1,103 @@
+# Copyright (c) 2019. Mount Sinai School of Medicine
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Splits the records of one or more VCF files into a number of shards, for tools that process
+variants independently of each other to run on each shard in parallel. A record's shard is picked
+by hashing its position, so calls of the same variant in different VCFs (e.g. by MuTect and
+Strelka) end up in the same shard, and shards get similar numbers of variants even where variants
+cluster.
+
+Writes <out-dir>/shard_<i>/<input VCF name> for every shard and input, each with the full header
+of its input; the outputs are plain text even if the inputs are gzipped.
+"""
+
+from argparse import ArgumentParser
+import gzip
+from os import makedirs
+from os.path import basename, join
+import zlib
+
+import sys
+
+
+parser = ArgumentParser()
+
+parser.add_argument(
+    "--input",
+    nargs="+",
+    default=[],
+    help="Paths of the VCF files to split; may be gzipped or bgzipped")
+
+parser.add_argument(
+    "--num-shards",
+    type=int,
+    default=1,
+    help="Number of shards to split into")
+
+parser.add_argument(
+    "--out-dir",
+    default="",
+    help="Directory to write the shard_<i> subdirectories to")
+
+
+def open_vcf(path):
+    with open(path, 'rb') as f:
+        is_gzipped = f.read(2) == b'\x1f\x8b'
+    return gzip.open(path, 'rt') if is_gzipped else open(path)
+
+
+def shard_path(out_dir, shard, path):
+    name = basename(path)
+    if name.endswith(".gz"):
+        name = name[:-len(".gz")]
+    return join(out_dir, "shard_%d" % shard, name)
+
+
+def get_shard(line, num_shards):
+    chrom, pos = line.split("\t", 2)[:2]
+    return zlib.crc32(("%s:%s" % (chrom, pos)).encode()) % num_shards
+
+
+def split_vcf(path, num_shards, out_dir):
+    outs = [open(shard_path(out_dir, i, path), 'w') for i in range(num_shards)]
+    try:
+        with open_vcf(path) as f:
+            for line in f:
+                if line.startswith("#"):
+                    for out in outs:
+                        out.write(line)
+                elif line.strip():
+                    outs[get_shard(line, num_shards)].write(line)
+    finally:
+        for out in outs:
+            out.close()
+
+
+def main(args_list=None):
+    if args_list is None:
+        args_list = sys.argv[1:]
+    args = parser.parse_args(args_list)
+    if not args.input:
+        raise ValueError("Must specify at least one --input VCF")
+    if args.num_shards < 1:
+        raise ValueError("Number of shards must be positive, got %d" % args.num_shards)
+
+    for i in range(args.num_shards):
+        makedirs(join(args.out_dir, "shard_%d" % i), exist_ok=True)
+    for path in args.input:
+        split_vcf(path, args.num_shards, args.out_dir)
+
+if __name__ == "__main__":
+    main()
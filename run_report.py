@@ -0,0 +1,313 @@
+# Copyright (c) 2019. Mount Sinai School of Medicine
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Performance report for one pipeline run, built from the Snakemake benchmark files in the sample's
+benchmarks directory, the rules-*.json manifests written next to them, and the stats.json files
+written by run_snakemake.py. Reports a critical-path timeline, per-rule CPU efficiency, peak RSS
+against requested memory, and I/O volume; with --baseline-dir, also diffs against another run.
+"""
+
+from argparse import ArgumentParser
+from collections import OrderedDict
+import csv
+import glob
+import json
+import logging
+from os.path import basename, dirname, exists, getmtime, join
+import re
+import sys
+
+import snakemake.io
+
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+parser = ArgumentParser()
+
+parser.add_argument(
+    "--run-dir",
+    default="",
+    help="Output directory of the sample to report on, e.g. /outputs/<sample id>")
+
+parser.add_argument(
+    "--reference-dir",
+    default="",
+    help="Reference genome directory; if given, requested resources of reference processing "
+        "jobs are read from its stats.json")
+
+parser.add_argument(
+    "--baseline-dir",
+    default="",
+    help="Output directory of an earlier run of the pipeline to compare this run against")
+
+parser.add_argument(
+    "--json",
+    default="",
+    help="If given, also write the full report to this JSON file")
+
+# a job is taken to wait on the predecessor that finished closest to (but at most this many
+# seconds after) its own start
+CRITICAL_PATH_SLACK_SECONDS = 5
+
+
+def _to_float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return 0.0
+
+
+# Returns the rule name -> {benchmark, output patterns} manifest of every Snakefile that ran
+def load_rules_manifest(benchmark_dir):
+    manifest = {}
+    for path in sorted(glob.glob(join(benchmark_dir, "rules-*.json"))):
+        with open(path) as f:
+            manifest.update(json.load(f))
+    return manifest
+
+
+# Returns output file -> requested resources, from the stats.json files of the given directories
+# and, for runs that were part of a batch, the batch_stats.json of the batch
+def load_requested_resources(dirs, batch_dir=""):
+    stats_paths = [join(d, "stats.json") for d in dirs if d]
+    if batch_dir:
+        stats_paths.append(join(batch_dir, "batch_stats.json"))
+    resources = {}
+    for stats_path in stats_paths:
+        if exists(stats_path):
+            with open(stats_path) as f:
+                for output, file_stats in json.load(f).get("files", {}).items():
+                    resources[output] = file_stats.get("resources", {})
+    return resources
+
+
+# Returns the rule a benchmark file belongs to and the job's wildcards, or (None, {}). Where
+# several rules match, the pattern with the most literal characters wins.
+def match_benchmark(filename, manifest):
+    best = (-1, None, {})
+    for rule_name, entry in manifest.items():
+        match = re.match(snakemake.io.regex(entry["benchmark"]), filename)
+        if match:
+            specificity = len(re.sub(r"\{[^}]*\}", "", entry["benchmark"]))
+            if specificity > best[0]:
+                best = (specificity, rule_name, match.groupdict())
+    return best[1], best[2]
+
+
+def _get_job_resources(rule_name, wildcards, manifest, requested_resources):
+    for pattern in manifest.get(rule_name, {}).get("output", []):
+        try:
+            output = snakemake.io.apply_wildcards(pattern, wildcards)
+        except Exception:
+            continue
+        if output in requested_resources:
+            return requested_resources[output]
+    return {}
+
+
+# Returns one dict per job that left a benchmark file. Jobs are timed by the benchmark file: it is
+# written as the job finishes, so its mtime is the end time and the recorded wall time gives the
+# start.
+def load_jobs(run_dir, reference_dir=""):
+    benchmark_dir = join(run_dir, "benchmarks")
+    manifest = load_rules_manifest(benchmark_dir)
+    requested_resources = load_requested_resources(
+        [run_dir, reference_dir], batch_dir=dirname(run_dir.rstrip("/")))
+    jobs = []
+    for path in sorted(glob.glob(join(benchmark_dir, "*.txt"))):
+        with open(path) as f:
+            rows = list(csv.DictReader(f, delimiter='\t'))
+        if not rows:
+            continue
+        # with repeated benchmarks, report the last repeat
+        row = rows[-1]
+        filename = basename(path)
+        rule_name, wildcards = match_benchmark(filename, manifest)
+        wildcards.setdefault("sample", basename(run_dir.rstrip("/")))
+        resources = _get_job_resources(rule_name, wildcards, manifest, requested_resources)
+        wall_seconds = _to_float(row.get("s"))
+        end = getmtime(path)
+        jobs.append({
+            "job": filename[:-len(".txt")],
+            "rule": rule_name or filename[:-len(".txt")],
+            "start": end - wall_seconds,
+            "end": end,
+            "wall_seconds": wall_seconds,
+            "cpu_seconds": _to_float(row.get("mean_load")) / 100 * wall_seconds,
+            "max_rss_mb": _to_float(row.get("max_rss")),
+            "io_in_mb": _to_float(row.get("io_in")),
+            "io_out_mb": _to_float(row.get("io_out")),
+            "threads": resources.get("_cores", 1),
+            "mem_mb": resources.get("mem_mb"),
+        })
+    return jobs
+
+
+# Walks back from the last job to finish, each time to the job that finished last before the
+# current one started. Without the DAG this is an approximation, but a job normally starts as soon
+# as its last dependency finishes, so it follows the chain that determined the total runtime.
+def critical_path(jobs):
+    if not jobs:
+        return []
+    job = max(jobs, key=lambda x: x["end"])
+    path = [job]
+    while True:
+        candidates = [
+            x for x in jobs
+            if x["end"] <= job["start"] + CRITICAL_PATH_SLACK_SECONDS and x["start"] < job["start"]]
+        if not candidates:
+            break
+        job = max(candidates, key=lambda x: x["end"])
+        path.append(job)
+    return list(reversed(path))
+
+
+def rule_summary(jobs):
+    summary = OrderedDict()
+    for job in sorted(jobs, key=lambda x: x["rule"]):
+        rule = summary.setdefault(job["rule"], {
+            "jobs": 0,
+            "wall_seconds": 0.0,
+            "cpu_seconds": 0.0,
+            "reserved_cpu_seconds": 0.0,
+            "max_rss_mb": 0.0,
+            "mem_mb": None,
+            "io_in_mb": 0.0,
+            "io_out_mb": 0.0,
+        })
+        rule["jobs"] += 1
+        rule["wall_seconds"] += job["wall_seconds"]
+        rule["cpu_seconds"] += job["cpu_seconds"]
+        rule["reserved_cpu_seconds"] += job["threads"] * job["wall_seconds"]
+        rule["max_rss_mb"] = max(rule["max_rss_mb"], job["max_rss_mb"])
+        if job["mem_mb"] is not None:
+            rule["mem_mb"] = max(rule["mem_mb"] or 0, job["mem_mb"])
+        rule["io_in_mb"] += job["io_in_mb"]
+        rule["io_out_mb"] += job["io_out_mb"]
+    for rule in summary.values():
+        # CPU time actually used over what the job's threads could have used in the same wall time
+        rule["cpu_efficiency"] = (
+            rule["cpu_seconds"] / rule["reserved_cpu_seconds"]
+            if rule["reserved_cpu_seconds"] else None)
+        rule["rss_over_requested"] = (
+            rule["max_rss_mb"] / rule["mem_mb"] if rule["mem_mb"] else None)
+    return summary
+
+
+def make_report(run_dir, reference_dir=""):
+    jobs = load_jobs(run_dir, reference_dir)
+    path = critical_path(jobs)
+    run_start = min(x["start"] for x in jobs) if jobs else 0
+    return {
+        "run_dir": run_dir,
+        "wall_seconds": (max(x["end"] for x in jobs) - run_start) if jobs else 0,
+        "critical_path": [{
+            "job": x["job"],
+            "rule": x["rule"],
+            "start_offset_seconds": x["start"] - run_start,
+            "wall_seconds": x["wall_seconds"],
+        } for x in path],
+        "rules": rule_summary(jobs),
+    }
+
+
+# Per-rule wall time and peak RSS of two runs, biggest wall time change first
+def diff_reports(baseline, current):
+    rows = []
+    for rule in sorted(set(baseline["rules"]) | set(current["rules"])):
+        before = baseline["rules"].get(rule, {})
+        after = current["rules"].get(rule, {})
+        wall_before = before.get("wall_seconds", 0.0)
+        wall_after = after.get("wall_seconds", 0.0)
+        rows.append({
+            "rule": rule,
+            "wall_seconds_before": wall_before,
+            "wall_seconds_after": wall_after,
+            "wall_seconds_change": wall_after - wall_before,
+            "wall_percent_change": (
+                100.0 * (wall_after - wall_before) / wall_before if wall_before else None),
+            "max_rss_mb_before": before.get("max_rss_mb", 0.0),
+            "max_rss_mb_after": after.get("max_rss_mb", 0.0),
+        })
+    rows.sort(key=lambda x: -abs(x["wall_seconds_change"]))
+    return {
+        "wall_seconds_before": baseline["wall_seconds"],
+        "wall_seconds_after": current["wall_seconds"],
+        "rules": rows,
+    }
+
+
+def _format_optional(value, fmt):
+    return fmt % value if value is not None else "-"
+
+
+def print_report(report, diff=None, out=sys.stdout):
+    out.write("Run: %s\nWall time: %.0fs\n\n" % (report["run_dir"], report["wall_seconds"]))
+
+    out.write("Critical path:\n")
+    out.write("%10s %10s  %s\n" % ("start (s)", "wall (s)", "job"))
+    for step in report["critical_path"]:
+        out.write("%10.0f %10.0f  %s (%s)\n" % (
+            step["start_offset_seconds"], step["wall_seconds"], step["job"], step["rule"]))
+
+    out.write("\nPer rule:\n")
+    out.write("%-40s %5s %10s %8s %10s %10s %6s %10s %10s\n" % (
+        "rule", "jobs", "wall (s)", "cpu eff", "rss (MB)", "req (MB)", "rss %",
+        "in (MB)", "out (MB)"))
+    for name, rule in report["rules"].items():
+        out.write("%-40s %5d %10.0f %8s %10.0f %10s %6s %10.0f %10.0f\n" % (
+            name, rule["jobs"], rule["wall_seconds"],
+            _format_optional(rule["cpu_efficiency"], "%.2f"),
+            rule["max_rss_mb"],
+            _format_optional(rule["mem_mb"], "%d"),
+            _format_optional(
+                rule["rss_over_requested"] and 100 * rule["rss_over_requested"], "%.0f"),
+            rule["io_in_mb"], rule["io_out_mb"]))
+
+    if diff:
+        out.write("\nChange from baseline: wall time %.0fs -> %.0fs\n" % (
+            diff["wall_seconds_before"], diff["wall_seconds_after"]))
+        out.write("%-40s %10s %10s %8s %10s %10s\n" % (
+            "rule", "wall before", "wall after", "change", "rss before", "rss after"))
+        for row in diff["rules"]:
+            out.write("%-40s %10.0f %10.0f %8s %10.0f %10.0f\n" % (
+                row["rule"], row["wall_seconds_before"], row["wall_seconds_after"],
+                _format_optional(row["wall_percent_change"], "%+.0f%%"),
+                row["max_rss_mb_before"], row["max_rss_mb_after"]))
+
+
+def main(args_list=None):
+    if args_list is None:
+        args_list = sys.argv[1:]
+    args = parser.parse_args(args_list)
+    if not args.run_dir:
+        raise ValueError("Must specify --run-dir")
+
+    report = make_report(args.run_dir, args.reference_dir)
+    diff = None
+    if args.baseline_dir:
+        diff = diff_reports(make_report(args.baseline_dir, args.reference_dir), report)
+    print_report(report, diff)
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"report": report, "diff": diff}, f, indent=2)
+        logger.info("Wrote report to %s" % args.json)
+
+
+if __name__ == "__main__":
+    main()
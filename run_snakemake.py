@@ -14,11 +14,17 @@
 
 from __future__ import print_function, division, absolute_import
 from argparse import ArgumentParser
+from collections import Counter
 import datetime
+import glob
+import hashlib
+import json
 import logging
+import shutil
+import subprocess
 
-from os import access, R_OK, W_OK
-from os.path import dirname, isfile, join, basename, splitext, exists
+from os import access, getpid, link, listdir, makedirs, rename, stat, symlink, R_OK, W_OK
+from os.path import dirname, isdir, isfile, join, basename, splitext, exists, getmtime, realpath
 import psutil
 import sys
 import tempfile
@@ -26,6 +32,10 @@ import tempfile
 import snakemake
 import yaml
 
+from capacity_plan import (
+    JobCollector, config_input_bytes, estimate_job, load_history, print_plan, recommend, simulate)
+from telemetry import Telemetry
+
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
@@ -42,6 +52,13 @@ parser.add_argument(
     default="",
     help="Snakemake YAML config file path")
 
+parser.add_argument(
+    "--batch-configfile",
+    action="append",
+    help="Config file of one sample in a batch; for a batch, specify --batch-configfile c1 "
+        "--batch-configfile c2 ... All samples are run by a single Snakemake invocation sharing "
+        "--cores and --memory, so the configs must be identical apart from their input sections.")
+
 parser.add_argument(
     "--cores",
     default=max(1, psutil.cpu_count() - 1),
@@ -54,11 +71,39 @@ parser.add_argument(
     type=int,
     help="Total memory (in GB) allowed for use by the Snakemake scheduler (default %(default)s)")
 
+parser.add_argument(
+    "--max-parallel-staging",
+    default=4,
+    type=int,
+    help="Maximum number of input files staged into the workdir at once (default %(default)s)")
+
+parser.add_argument(
+    "--disk-budget",
+    type=int,
+    help="Disk space (in GB) that running jobs may reserve at once, which limits how many jobs "
+        "writing large files run concurrently. Outputs of finished jobs aren't counted against "
+        "it; use --plan to predict the peak disk use of the output directory. (default: its free "
+        "space at the start of the run)")
+
 parser.add_argument(
     "--dry-run",
     help="If this argument is present, Snakemake will do a dry run of the pipeline",
     action="store_true")
 
+parser.add_argument(
+    "--plan",
+    help="If this argument is present, nothing is run: instead, predicts the wall time, peak "
+        "memory and peak disk use of the pipeline at several core counts from a dry run and the "
+        "benchmarks of earlier runs, and recommends --cores and --memory values",
+    action="store_true")
+
+parser.add_argument(
+    "--plan-cores",
+    action="append",
+    type=int,
+    help="Core count to predict the run at with --plan; can be repeated (default: 4, 8, 16, 32 "
+        "and 64, and --cores)")
+
 targets_group = parser.add_argument_group("Target arguments")
 
 targets_group.add_argument(
@@ -85,6 +130,27 @@ qc_group.add_argument(
     help="If this argument is present, will run several QC metrics",
     action="store_true")
 
+telemetry_group = parser.add_argument_group("Telemetry arguments")
+
+telemetry_group.add_argument(
+    "--telemetry-file",
+    default="",
+    help="JSON lines file to append live events of the run to: job starts and ends, and periodic "
+        "samples of each running job's CPU, memory and I/O and of the scheduler's queue and idle "
+        "cores")
+
+telemetry_group.add_argument(
+    "--telemetry-port",
+    type=int,
+    help="If given, also serve the latest samples as Prometheus metrics at "
+        "http://127.0.0.1:<port>/metrics; requires --telemetry-file")
+
+telemetry_group.add_argument(
+    "--telemetry-interval",
+    default=5,
+    type=float,
+    help="Seconds between telemetry samples (default %(default)s)")
+
 overrides_group = parser.add_argument_group("Dockerless runs: directory override options")
 
 # TODO(julia): make sure that if any of these is specified, all the others are too
@@ -144,6 +210,20 @@ def validate_config(config):
         if not (isfile(ref_file) and access(ref_file, R_OK)):
             raise ValueError("Reference genome file %s does not exist or is unreadable" % ref_file)
 
+    output_cache_dir = config.get("output_cache_dir")
+    if output_cache_dir and not (isdir(output_cache_dir) and access(output_cache_dir, W_OK)):
+        raise ValueError("Output cache directory %s does not exist or is not writable" % (
+            output_cache_dir))
+
+    if config.get("exome_mode") and "capture_kit_coverage_file" not in config["reference"]:
+        raise ValueError("exome_mode requires a capture_kit_coverage_file in the reference config")
+
+    if config.get("ensembl_release"):
+        missing_keys = [key for key in ENSEMBL_FASTA_KEYS if key not in config["reference"]]
+        if missing_keys:
+            raise ValueError("ensembl_release requires the reference files %s" % ", ".join(
+                missing_keys))
+
     # check that the workdir exists and is writable
     workdir = config["workdir"]
     if not access(workdir, W_OK):
@@ -168,6 +248,8 @@ def validate_target(target, args, config):
                 "Invalid target, vaccine peptide output must match config file specs: %s" % target)
         # if the target is a somatic VCF file, make sure it's in the config
         root, ext = splitext(basename(target))
+        if ext == ".gz":
+            root, ext = splitext(root)
         if ext == ".vcf" and not "germline" in root and not root in config["variant_callers"]:
             raise ValueError(
                 "Invalid target, somatic VCF must be part of config file "
@@ -203,13 +285,28 @@ def default_vaxrank_targets(config):
     return ['%s.%s' % (path_without_ext, ext) for ext in ('txt', 'json', 'pdf')]
 
 
+def vcf_extension(config):
+    return ".vcf.gz" if config.get("compressed_vcfs") else ".vcf"
+
+
 def somatic_vcf_targets(config):
     return [join(
         get_output_dir(config),
-        "%s.vcf" % vcf_type
+        vcf_type + vcf_extension(config)
         ) for vcf_type in config["variant_callers"]]
 
 
+def cram_targets(config, targets):
+    """
+    Returns reference-based CRAM copies of the final alignments that the given targets are computed
+    from: the recalibrated DNA BAMs, and the final RNA BAM for vaccine peptide reports.
+    """
+    prefixes = ["%s_aligned_coordinate_sorted_dups_indelreal_bqsr" % x for x in ["normal", "tumor"]]
+    if "rna" in config["input"] and any("vaccine-peptide-report" in x for x in targets):
+        prefixes.append("rna_final_sorted")
+    return [join(get_output_dir(config), x + ".cram") for x in prefixes]
+
+
 def get_and_check_targets(args, config):
     targets = args.target
     if targets is None:
@@ -219,6 +316,9 @@ def get_and_check_targets(args, config):
             targets = [config["reference"]["genome"] + ".done"]
         else:
             targets = default_vaxrank_targets(config)
+        # the cram compression policy keeps CRAM copies of the final alignments of default runs
+        if config.get("compression") == "cram" and not args.process_reference_only:
+            targets = targets + cram_targets(config, targets)
     
     if len(targets) == 0:
         raise ValueError("Must specify at least one target")
@@ -238,6 +338,344 @@ def get_and_check_targets(args, config):
     return targets
 
 
+######################################################################################
+#########################          Reference cache         ###########################
+######################################################################################
+
+# Files produced next to the reference FASTA by the reference processing rules
+REFERENCE_INDEX_SUFFIXES = [".fai", ".contigs", ".amb", ".ann", ".bwt", ".pac", ".sa"]
+
+STAR_READ_LENGTH = 124
+
+# local annotation files that pipeline/reference.rules builds Vaxrank's PyEnsembl cache from
+ENSEMBL_FASTA_KEYS = ["cdna_fasta", "ncrna_fasta", "protein_fasta"]
+
+
+# STAR genomeGenerate parameters used by pipeline/reference.rules for a given memory budget; these
+# need to stay in sync with the helper functions there.
+def star_genome_generate_params(memory_gb):
+    return {
+        'read_length': STAR_READ_LENGTH,
+        'suffix_array_sparsity': 2 if memory_gb < 31 else 1,
+        'num_junctions': 300000 if memory_gb < 31 else 1000000,
+    }
+
+
+# Returns the SHA-1 of a file's contents. Digests are remembered in the cache directory (if it's
+# writable), keyed by path, size and modification time, so large FASTAs are only read once. Runs
+# sharing the cache may update the digests file concurrently, so it's replaced by a rename rather
+# than rewritten in place; a digest lost to a concurrent update is just computed again later.
+def file_checksum(path, cache_dir):
+    checksums_path = join(cache_dir, "checksums.json")
+    checksums = {}
+    if isfile(checksums_path):
+        with open(checksums_path) as f:
+            checksums = json.load(f)
+    file_stat = stat(path)
+    memo_key = "%s:%d:%d" % (realpath(path), file_stat.st_size, int(file_stat.st_mtime))
+    if memo_key in checksums:
+        return checksums[memo_key]
+
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            sha1.update(block)
+    checksums[memo_key] = sha1.hexdigest()
+    if access(cache_dir, W_OK):
+        tmp_path = "%s.tmp-%d" % (checksums_path, getpid())
+        with open(tmp_path, 'w') as f:
+            json.dump(checksums, f, indent=2)
+        rename(tmp_path, checksums_path)
+    return checksums[memo_key]
+
+
+# Cache entries are keyed by the reference FASTA and transcripts GTF contents, and by the STAR
+# parameters, so the same reference mounted at a different path resolves to the same entry. If the
+# config has local Ensembl annotation files for Vaxrank, their contents are part of the key too.
+def reference_cache_key(parsed_config, memory_gb):
+    cache_dir = parsed_config["reference_cache_dir"]
+    reference = parsed_config["reference"]
+    key_contents = {
+        'genome': file_checksum(reference["genome"], cache_dir),
+        'transcripts': file_checksum(reference["transcripts"], cache_dir),
+        'star': star_genome_generate_params(memory_gb),
+    }
+    if parsed_config.get("ensembl_release"):
+        key_contents['ensembl'] = {
+            'release': parsed_config["ensembl_release"],
+            'species': parsed_config.get("ensembl_species", "human"),
+        }
+        for key in ENSEMBL_FASTA_KEYS:
+            key_contents['ensembl'][key] = file_checksum(reference[key], cache_dir)
+    return hashlib.sha1(json.dumps(key_contents, sort_keys=True).encode()).hexdigest()
+
+
+def _link_if_missing(source, dest):
+    try:
+        symlink(source, dest)
+    except FileExistsError:
+        pass
+
+
+# Creates a cache entry: a symlink to the reference FASTA, so that the indexes are built next to
+# it inside the cache. If the original reference directory has already been processed, its indexes
+# are linked in instead of being rebuilt.
+def populate_reference_cache_entry(parsed_config, entry_dir):
+    makedirs(entry_dir, exist_ok=True)
+    genome = parsed_config["reference"]["genome"]
+    cached_genome = join(entry_dir, basename(genome))
+    _link_if_missing(realpath(genome), cached_genome)
+
+    if not exists(genome + ".done"):
+        return
+    index_files = [genome + suffix for suffix in REFERENCE_INDEX_SUFFIXES]
+    index_files.append(splitext(genome)[0] + ".dict")
+    star_genome_dir = join(dirname(genome), "star-genome-%d" % STAR_READ_LENGTH)
+    if not (all(exists(x) for x in index_files) and exists(join(star_genome_dir, "SA"))):
+        return
+    logger.info("Seeding reference cache entry %s from %s" % (entry_dir, dirname(genome)))
+    for index_file in index_files:
+        cached_index_file = join(entry_dir, basename(index_file))
+        if index_file.endswith(".dict"):
+            cached_index_file = splitext(cached_genome)[0] + ".dict"
+        _link_if_missing(realpath(index_file), cached_index_file)
+    _link_if_missing(realpath(star_genome_dir), join(entry_dir, basename(star_genome_dir)))
+    if exists(genome + ".pyensembl"):
+        _link_if_missing(realpath(genome + ".pyensembl"), cached_genome + ".pyensembl")
+    with open(cached_genome + ".done", 'w'):
+        pass
+
+
+def resolve_reference_cache(args, parsed_config):
+    """
+    If the config specifies a reference_cache_dir, points the reference genome (and capture kit)
+    paths in parsed_config at the matching cache entry, creating the entry if necessary. If the
+    cache has no complete entry and can't be written to, the reference is processed in place.
+    """
+    cache_dir = parsed_config["reference_cache_dir"]
+    if not isdir(cache_dir):
+        raise ValueError("Reference cache directory %s does not exist" % cache_dir)
+    entry_dir = join(cache_dir, reference_cache_key(parsed_config, args.memory))
+    genome = parsed_config["reference"]["genome"]
+    cached_genome = join(entry_dir, basename(genome))
+
+    if exists(cached_genome + ".done"):
+        logger.info("Using cached reference indexes in %s" % entry_dir)
+    elif access(cache_dir, W_OK):
+        logger.info("Creating reference cache entry %s" % entry_dir)
+        populate_reference_cache_entry(parsed_config, entry_dir)
+    else:
+        logger.info(
+            "Reference cache %s has no entry for this reference and is not writable, processing "
+            "reference in place" % cache_dir)
+        return
+
+    # The capture kit BED isn't part of the cache key, so that an entry is shared by all capture
+    # kits used with its reference. Its interval lists are built next to the reference FASTA, so
+    # the BED is linked into the entry under a name that includes its checksum: BEDs with the same
+    # name but different contents get different links.
+    reference = parsed_config["reference"]
+    if "capture_kit_coverage_file" in reference:
+        capture_kit = reference["capture_kit_coverage_file"]
+        cached_capture_kit = join(entry_dir, "%s-%s" % (
+            file_checksum(capture_kit, cache_dir), basename(capture_kit)))
+        if not exists(cached_capture_kit):
+            if not access(entry_dir, W_OK):
+                logger.info(
+                    "Reference cache entry %s has no link to capture kit %s and is not writable, "
+                    "processing reference in place" % (entry_dir, capture_kit))
+                return
+            _link_if_missing(realpath(capture_kit), cached_capture_kit)
+        reference["capture_kit_coverage_file"] = cached_capture_kit
+    reference["genome"] = cached_genome
+
+
+######################################################################################
+#########################          Output cache            ###########################
+######################################################################################
+
+PIPELINE_DIR = join(dirname(realpath(__file__)), "pipeline")
+
+
+# Groups of sample outputs that the output cache stores and reuses, and what each is keyed by:
+# - normal_alignment: the normal's duplicate-marked BAM, which only depends on the normal reads, so
+#   that a normal paired with several tumors is aligned once. Its read groups name the sample it
+#   was aligned for, and are renamed when it's reused by another sample.
+# - corealignment: the recalibrated BAMs and germline calls. IndelRealigner realigns the normal
+#   jointly with the tumor (and RNA), so these depend on all of a sample's reads, and are only
+#   reused by reruns of the same sample (e.g. in a new output directory). Not cached with
+#   parallel_bqsr, see below.
+# Contents of the rule files that make the outputs are part of the key, so that changes to the
+# rules invalidate the entries.
+def output_cache_groups(config):
+    vcf_ext = vcf_extension(config)
+    germline_vcfs = ["filtered_normal_germline_snps_indels" + vcf_ext]
+    if "capture_kit_coverage_file" in config["reference"]:
+        germline_vcfs.append("filtered_covered_normal_germline_snps_indels" + vcf_ext)
+    if config.get("compressed_vcfs"):
+        germline_vcfs.extend([x + ".tbi" for x in germline_vcfs])
+    groups = {
+        'normal_alignment': {
+            'input_types': ["normal"],
+            'reference_keys': ["genome"],
+            'rule_files': ["alignment.rules", "gatk.rules"],
+            'config_keys': ["alignment_chunk_size", "markdup_engine"],
+            'sample_specific': False,
+            'outputs': [
+                "normal_aligned_coordinate_sorted_dups.bam",
+                "normal_aligned_coordinate_sorted_dups.bam.bai",
+                "normal_markdups_metrics.txt",
+            ],
+        },
+        'corealignment': {
+            'input_types': ["normal", "tumor", "rna"],
+            'reference_keys': ["genome", "dbsnp", "capture_kit_coverage_file"],
+            'rule_files': [
+                "alignment.rules", "gatk.rules", "rna.rules", "variant_calling.rules"],
+            'config_keys': [
+                "alignment_chunk_size", "markdup_engine", "parallel_indel_realigner",
+                "interval_shards", "compressed_vcfs", "exome_mode", "target_padding"],
+            'sample_specific': True,
+            'outputs': [
+                "%s_aligned_coordinate_sorted_dups_indelreal_bqsr.%s" % (x, ext)
+                for x in ["normal", "tumor"] for ext in ["bam", "bai"]] + germline_vcfs,
+        },
+    }
+    # with parallel BQSR, the variant callers read per-region recalibrated BAMs, which aren't kept,
+    # so reusing the whole-genome ones wouldn't save rerunning the steps before them
+    if config.get("parallel_bqsr"):
+        del groups['corealignment']
+    return groups
+
+
+def _input_fastqs(config, input_type):
+    paths = []
+    for fragment in config["input"].get(input_type, []):
+        if fragment["type"] == "paired-end":
+            paths.extend([fragment["r1"], fragment["r2"]])
+        else:
+            paths.append(fragment["r"])
+    return paths
+
+
+# Returns the cache key of a group of a sample's outputs, or None if they can't be cached because
+# some input isn't a local file
+def output_cache_key(config, group_name, group):
+    cache_dir = config["output_cache_dir"]
+    key_contents = {
+        'group': group_name,
+        'inputs': {},
+        'reference': {},
+        'rules': {},
+        'config': {key: config.get(key) for key in group['config_keys']},
+    }
+    for input_type in group['input_types']:
+        paths = _input_fastqs(config, input_type)
+        if not all(isfile(x) for x in paths):
+            return None
+        key_contents['inputs'][input_type] = [file_checksum(x, cache_dir) for x in paths]
+    for key in group['reference_keys']:
+        if key in config["reference"]:
+            key_contents['reference'][key] = file_checksum(config["reference"][key], cache_dir)
+    for rule_file in group['rule_files']:
+        key_contents['rules'][rule_file] = file_checksum(join(PIPELINE_DIR, rule_file), cache_dir)
+    if group['sample_specific']:
+        key_contents['sample'] = config["input"]["id"]
+    return hashlib.sha1(json.dumps(key_contents, sort_keys=True).encode()).hexdigest()
+
+
+# Renames the sample in the SM and LB fields of a SAM header's read groups (see
+# _get_read_group_header in pipeline/alignment.rules)
+def rename_read_group_sample(header, old_sample, new_sample):
+    lines = []
+    for line in header.splitlines(True):
+        if line.startswith("@RG"):
+            fields = line.rstrip("\n").split("\t")
+            for i, field in enumerate(fields):
+                if field[:3] in ("SM:", "LB:") and field[3:].startswith(old_sample + "_"):
+                    fields[i] = field[:3] + new_sample + field[3 + len(old_sample):]
+            line = "\t".join(fields) + "\n"
+        lines.append(line)
+    return "".join(lines)
+
+
+def _reheader_bam(source, dest, old_sample, new_sample):
+    header = subprocess.check_output(["samtools", "view", "-H", source]).decode()
+    with tempfile.NamedTemporaryFile(mode='w', suffix=".sam") as header_file:
+        header_file.write(rename_read_group_sample(header, old_sample, new_sample))
+        header_file.flush()
+        with open(dest, 'wb') as f:
+            subprocess.check_call(["samtools", "reheader", header_file.name, source], stdout=f)
+
+
+def link_cached_outputs(config):
+    """
+    Links the cached outputs of a sample into its output directory, for each group of outputs that
+    has a cache entry and none of whose outputs exist yet. Snakemake then only runs the jobs that
+    come after them. A BAM aligned for another sample is copied with its read groups renamed
+    instead, and its index is left for the pipeline to rebuild.
+    """
+    output_dir = get_output_dir(config)
+    makedirs(output_dir, exist_ok=True)
+    sample = config["input"]["id"]
+    for group_name, group in output_cache_groups(config).items():
+        key = output_cache_key(config, group_name, group)
+        entry_dir = join(config["output_cache_dir"], group_name, key or "")
+        if key is None or not isfile(join(entry_dir, "entry.json")):
+            continue
+        if any(exists(join(output_dir, x)) for x in group['outputs']):
+            continue
+        with open(join(entry_dir, "entry.json")) as f:
+            cached_sample = json.load(f)["sample"]
+        logger.info("Reusing cached %s outputs of sample %s from %s" % (
+            group_name, cached_sample, entry_dir))
+        # in order, so that each file is newer than the ones it's made from
+        for output in group['outputs']:
+            source = join(entry_dir, output)
+            dest = join(output_dir, output)
+            if cached_sample == sample:
+                symlink(source, dest)
+            elif output.endswith(".bam"):
+                _reheader_bam(source, dest, cached_sample, sample)
+            elif not output.endswith(".bai"):
+                symlink(source, dest)
+
+
+def _link_or_copy(source, dest):
+    try:
+        link(source, dest)
+    except OSError:
+        shutil.copy2(source, dest)
+
+
+def store_cached_outputs(config):
+    """
+    Stores each group of a sample's outputs that all exist and aren't cached yet in the output
+    cache. Entries are written to a temporary directory first, so that concurrent runs never see
+    a partial entry.
+    """
+    output_dir = get_output_dir(config)
+    for group_name, group in output_cache_groups(config).items():
+        key = output_cache_key(config, group_name, group)
+        if key is None or not all(exists(join(output_dir, x)) for x in group['outputs']):
+            continue
+        entry_dir = join(config["output_cache_dir"], group_name, key)
+        if exists(entry_dir):
+            continue
+        logger.info("Storing %s outputs in output cache entry %s" % (group_name, entry_dir))
+        tmp_dir = "%s.tmp-%d" % (entry_dir, getpid())
+        makedirs(tmp_dir)
+        for output in group['outputs']:
+            _link_or_copy(realpath(join(output_dir, output)), join(tmp_dir, output))
+        with open(join(tmp_dir, "entry.json"), 'w') as f:
+            json.dump({'sample': config["input"]["id"]}, f)
+        try:
+            rename(tmp_dir, entry_dir)
+        except OSError:
+            # another run stored the same entry first
+            shutil.rmtree(tmp_dir)
+
+
 ######################################################################################
 #########################          Execution         #################################
 ######################################################################################
@@ -247,46 +685,284 @@ def make_config_extension_dict(args, parsed_config):
     # include all relevant contigs in the pipeline config
     with open(parsed_config["reference"]["genome"] + ".contigs") as f:
         contigs = [x.strip() for x in f.readlines()]
-    return {
+    config_extension = {
         'num_threads': args.cores,
         'mem_gb': args.memory,
         'contigs': contigs,
     }
+    # if requested, per-region rules scatter over interval shards instead of whole contigs
+    if parsed_config.get("interval_shards"):
+        config_extension.update(read_interval_shards(parsed_config))
+    # in exome mode, analysis steps only scatter over the regions with capture targets, while the
+    # rules that write reads still cover all regions
+    if parsed_config.get("exome_mode"):
+        regions_with_targets = {
+            splitext(x)[0] for x in listdir(region_targets_dir(parsed_config))}
+        config_extension["target_regions"] = [
+            x for x in config_extension.get("shards", contigs) if x in regions_with_targets]
+        if not config_extension["target_regions"]:
+            raise ValueError(
+                "No capture targets of %s are in the %s regions of the reference" % (
+                    parsed_config["reference"]["capture_kit_coverage_file"],
+                    "shard" if "shards" in config_extension else "contig"))
+    return config_extension
+
+
+# Returns the shard names, in genomic order, and a matching list with the GATK intervals belonging
+# to each shard. Snakemake only accepts a flat config here, so these can't be a dict.
+def read_interval_shards(parsed_config):
+    shards_path = "%s.%d.shards" % (
+        parsed_config["reference"]["genome"], parsed_config["interval_shards"])
+    shards = []
+    shard_intervals = []
+    with open(shards_path) as f:
+        for line in f:
+            shard, interval = line.strip().split('\t')
+            if not shards or shards[-1] != shard:
+                shards.append(shard)
+                shard_intervals.append([])
+            shard_intervals[-1].append(interval)
+    return {
+        'shards': shards,
+        'shard_intervals': shard_intervals,
+    }
 
 
-def run_neoantigen_pipeline(args, parsed_config, configfile):
+# Jobs that write large files reserve disk_mb in proportion to their input size (see
+# pipeline/resources.rules); this caps the total reserved by concurrently running jobs. It is a
+# concurrency limit only: a job's reservation is released when it finishes, even though the
+# outputs it keeps still take up space.
+def get_disk_budget_mb(args, parsed_config):
+    if args.disk_budget is not None:
+        return int(1024 * args.disk_budget)
+    return int(shutil.disk_usage(parsed_config["workdir"]).free / (1024 * 1024))
+
+
+# Returns the JSON reports of the QC gates (see pipeline/qc.rules) that failed for a sample
+def failed_qc_gates(config):
+    qc_gates_dir = join(get_output_dir(config), "qc_gates")
+    failures = []
+    for filename in sorted(listdir(qc_gates_dir)) if isdir(qc_gates_dir) else []:
+        if not filename.endswith(".json"):
+            continue
+        with open(join(qc_gates_dir, filename)) as f:
+            report = json.load(f)
+        if not report["passed"]:
+            report["sample"] = config["input"]["id"]
+            failures.append(report)
+    return failures
+
+
+def start_telemetry(args, stage):
+    """
+    Returns a started Telemetry for a Snakemake invocation of the given stage, or None if
+    telemetry isn't requested or this is a dry run.
+    """
+    if not args.telemetry_file or args.dry_run:
+        return None
+    telemetry = Telemetry(
+        args.telemetry_file,
+        cores=args.cores,
+        stage=stage,
+        port=args.telemetry_port,
+        interval=args.telemetry_interval)
+    telemetry.start()
+    return telemetry
+
+
+def record_compression_policy(stats_file, parsed_config):
+    """
+    Adds the compression policy that the run's alignments were written with to its Snakemake stats.
+    A null policy means each rule used its own default.
+    """
+    if not exists(stats_file):
+        return
+    with open(stats_file) as f:
+        stats = json.load(f)
+    stats["compression"] = {
+        'policy': parsed_config.get("compression"),
+        'overrides': parsed_config.get("compression_overrides", {}),
+    }
+    with open(stats_file, 'w') as f:
+        json.dump(stats, f, indent=4)
+
+
+# Returns the targets of the main pipeline for the given sample configs, or an empty list if there
+# are no output targets
+def get_pipeline_targets(args, parsed_config, sample_configs):
+    # only run targets in the output directories (exclude reference processing)
+    targets = []
+    for sample_config in sample_configs:
+        output_dir = get_output_dir(sample_config)
+        targets.extend(
+            x for x in get_and_check_targets(args, sample_config) if x.startswith(output_dir))
+    if not targets:
+        return []
+    # reference indexes that don't exist yet are built in the same DAG, concurrently with the
+    # sample jobs that don't need them
+    targets.append(parsed_config["reference"]["genome"] + ".done")
+    return targets
+
+
+def run_neoantigen_pipeline(args, parsed_config, configfile, sample_configs=None):
+    """
+    Runs the main pipeline. For a batch, parsed_config is the merged batch config and
+    sample_configs the per-sample configs whose targets are all run in the same DAG.
+    """
     configfile.seek(0)
 
-    output_dir = get_output_dir(parsed_config)
-    stats_file = join(output_dir, "stats.json")
+    if sample_configs is None:
+        sample_configs = [parsed_config]
+        stats_file = join(get_output_dir(parsed_config), "stats.json")
+    else:
+        stats_file = join(parsed_config["workdir"], "batch_stats.json")
 
-    # only run targets in the output directory (exclude reference processing)
-    targets = [x for x in get_and_check_targets(args, parsed_config) if x.startswith(output_dir)]
+    targets = get_pipeline_targets(args, parsed_config, sample_configs)
     if not targets:
         logger.info("No output targets specified")
         return
 
     config_extension = make_config_extension_dict(args, parsed_config)
 
+    disk_budget_mb = get_disk_budget_mb(args, parsed_config)
+    # outputs of earlier runs on the same inputs are linked in before Snakemake decides what to run
+    output_cache = parsed_config.get("output_cache_dir") and not args.dry_run
+    if output_cache:
+        for sample_config in sample_configs:
+            link_cached_outputs(sample_config)
     logger.info("Running neoantigen pipeline with targets %s " % targets)
     start_time = datetime.datetime.now()
-    if not snakemake.snakemake(
-            'pipeline/Snakefile',
-            cores=args.cores,
-            resources={'mem_mb': int(1024 * args.memory)},
-            config=config_extension,
-            configfile=configfile.name,
-            printshellcmds=True,
-            dryrun=args.dry_run,
-            targets=targets,
-            workdir=parsed_config["workdir"],
-            stats=stats_file):
+    telemetry = start_telemetry(args, "pipeline")
+    success = None
+    try:
+        success = snakemake.snakemake(
+                'pipeline/Snakefile',
+                cores=args.cores,
+                resources={
+                    'mem_mb': int(1024 * args.memory),
+                    'staging_jobs': args.max_parallel_staging,
+                    'disk_mb': disk_budget_mb,
+                },
+                config=config_extension,
+                configfile=configfile.name,
+                printshellcmds=True,
+                dryrun=args.dry_run,
+                targets=targets,
+                workdir=parsed_config["workdir"],
+                stats=stats_file,
+                # a sample failing a QC gate shouldn't stop the others in its batch
+                keepgoing=bool(parsed_config.get("qc_gates")) and len(sample_configs) > 1)
+    finally:
+        if telemetry:
+            telemetry.stop(success)
+    if not success:
+        qc_gate_failures = [x for y in sample_configs for x in failed_qc_gates(y)]
+        if qc_gate_failures:
+            print(json.dumps(qc_gate_failures, indent=2))
+            raise ValueError("QC gates failed for samples %s" % ", ".join(
+                sorted(set(x["sample"] for x in qc_gate_failures))))
         raise ValueError("Pipeline failed, see Snakemake error message for details")
 
+    if not args.dry_run:
+        record_compression_policy(stats_file, parsed_config)
+
+    if output_cache:
+        for sample_config in sample_configs:
+            store_cached_outputs(sample_config)
+
     end_time = datetime.datetime.now()
     logger.info("--- Pipeline running time: %s ---" % (str(end_time - start_time)))
 
 
+def plan_neoantigen_pipeline(args, parsed_config, configfile, sample_configs=None):
+    """
+    Predicts the wall time, peak memory and peak disk use of the main pipeline at several core
+    counts, and recommends --cores and --memory values (see capacity_plan.py). The jobs are those a
+    dry run schedules, so outputs that are already up to date aren't counted.
+    """
+    sample_configs = sample_configs or [parsed_config]
+    targets = get_pipeline_targets(args, parsed_config, sample_configs)
+    if not targets:
+        logger.info("No output targets specified")
+        return
+
+    # earlier runs in the workdir, and in the directories the resource model learns from
+    history_dirs = [
+        dirname(x) for x in glob.glob(join(parsed_config["workdir"], "*", "benchmarks"))]
+    history_dirs.extend(
+        dirname(x.rstrip("/")) for x in parsed_config.get("resource_profile_dirs", []))
+    history = load_history(history_dirs)
+    input_bytes = {x["input"]["id"]: config_input_bytes(x) for x in sample_configs}
+    disk_budget_mb = get_disk_budget_mb(args, parsed_config)
+
+    plans = []
+    unestimated = Counter()
+    for cores in sorted(set(args.plan_cores or [4, 8, 16, 32, 64]) | {args.cores}):
+        configfile.seek(0)
+        config_extension = make_config_extension_dict(args, parsed_config)
+        config_extension['num_threads'] = cores
+        collector = JobCollector()
+        success = snakemake.snakemake(
+                'pipeline/Snakefile',
+                cores=cores,
+                resources={
+                    'mem_mb': int(1024 * args.memory),
+                    'staging_jobs': args.max_parallel_staging,
+                    'disk_mb': disk_budget_mb,
+                },
+                config=config_extension,
+                configfile=configfile.name,
+                dryrun=True,
+                targets=targets,
+                workdir=parsed_config["workdir"],
+                log_handler=collector)
+        if not success:
+            raise ValueError("Dry run failed, see Snakemake error message for details")
+        estimates = {
+            job["jobid"]: estimate_job(job, history, input_bytes.get(job["sample"]))
+            for job in collector.jobs}
+        plans.append(simulate(
+            collector.jobs, estimates, cores, int(1024 * args.memory), disk_budget_mb, targets))
+        unestimated = Counter(
+            job["rule"] for job in collector.jobs if estimates[job["jobid"]][0] is None)
+
+    # the same memory floors as validate_target
+    needs_32gb = any(
+        "vaccine-peptide-report" in x or basename(x).startswith("rna") for x in targets)
+    recommendation = recommend(plans, 32 if needs_32gb else 7)
+    print_plan(
+        plans, recommendation, unestimated, sum(x or 0 for x in input_bytes.values()),
+        stat(parsed_config["reference"]["genome"]).st_size)
+
+
+# Reference files that the main Snakefile needs to be parsed: the contigs (or interval shards) that
+# per-region rules scatter over, and the index they're read from. The rest of the reference is
+# built in the main pipeline's DAG.
+def reference_metadata_targets(parsed_config):
+    genome = parsed_config["reference"]["genome"]
+    targets = [genome + ".fai", genome + ".contigs"]
+    if parsed_config.get("interval_shards"):
+        targets.append("%s.%d.shards" % (genome, parsed_config["interval_shards"]))
+    if parsed_config.get("exome_mode"):
+        targets.append(region_targets_dir(parsed_config))
+    return targets
+
+
+# Directory of the padded capture targets of exome mode split over the scatter regions, one file
+# per region with targets (see region_targets_output in pipeline/common.rules)
+def region_targets_dir(parsed_config):
+    target_intervals = "%s.padded%d.interval_list" % (
+        parsed_config["reference"]["capture_kit_coverage_file"],
+        parsed_config.get("target_padding", 100))
+    if parsed_config.get("interval_shards"):
+        return "%s.%d.shards" % (target_intervals, parsed_config["interval_shards"])
+    return target_intervals + ".contigs"
+
+
+def _is_up_to_date(path, source):
+    return exists(path) and isfile(source) and getmtime(path) >= getmtime(source)
+
+
 def process_reference(args, parsed_config, configfile):
     configfile.seek(0)
 
@@ -297,33 +973,43 @@ def process_reference(args, parsed_config, configfile):
     targets = [
         x for x in get_and_check_targets(args, parsed_config) if x.startswith(reference_genome_dir)]
     if not targets:
-        targets = [parsed_config["reference"]["genome"] + '.done']
+        targets = reference_metadata_targets(parsed_config)
+        # skip starting Snakemake at all in the usual case of an already processed reference
+        if all(_is_up_to_date(x, parsed_config["reference"]["genome"]) for x in targets):
+            logger.info("Reference contigs are up to date")
+            return
     logger.info("Processing reference with targets: %s" % targets)
 
     start_time = datetime.datetime.now()
-    if not snakemake.snakemake(
-            'pipeline/reference_Snakefile',
-            cores=args.cores,
-            resources={'mem_mb': int(1024 * args.memory)},
-            config={'num_threads': args.cores, 'mem_gb': args.memory},
-            configfile=configfile.name,
-            printshellcmds=True,
-            dryrun=args.dry_run,
-            targets=targets,
-            workdir=parsed_config["workdir"],
-            stats=stats_file):
+    telemetry = start_telemetry(args, "reference")
+    success = None
+    try:
+        success = snakemake.snakemake(
+                'pipeline/reference_Snakefile',
+                cores=args.cores,
+                resources={'mem_mb': int(1024 * args.memory)},
+                config={'num_threads': args.cores, 'mem_gb': args.memory},
+                configfile=configfile.name,
+                printshellcmds=True,
+                dryrun=args.dry_run,
+                targets=targets,
+                workdir=parsed_config["workdir"],
+                stats=stats_file)
+    finally:
+        if telemetry:
+            telemetry.stop(success)
+    if not success:
         raise ValueError("Reference processing failed, see Snakemake error message for details")
     end_time = datetime.datetime.now()
     logger.info("--- Reference processing time: %s ---" % (str(end_time - start_time)))
 
 
-def main(args_list=None):
-    if args_list is None:
-        args_list = sys.argv[1:]
-    args = parser.parse_args(args_list)
-    logger.info(args)
-
-    with open(args.configfile) as configfile:
+def load_config(args, path):
+    """
+    Reads a config file, with /inputs, /outputs and /reference-genome paths replaced by the
+    Dockerless overrides if given. Returns its contents and the parsed config.
+    """
+    with open(path) as configfile:
         configfile_contents = configfile.read()
 
     # if necessary, replace paths in the configfile contents
@@ -340,28 +1026,86 @@ def main(args_list=None):
 
     parsed_config = yaml.safe_load(configfile_contents)
     validate_config(parsed_config)
+    return configfile_contents, parsed_config
+
+
+def make_batch_config(sample_configs):
+    """
+    Merges per-sample configs into one batch config, with the input sections under "samples"
+    (keyed by sample ID) and everything else shared.
+    """
+    batch_config = {k: v for k, v in sample_configs[0].items() if k != "input"}
+    samples = {}
+    for sample_config in sample_configs:
+        shared = {k: v for k, v in sample_config.items() if k != "input"}
+        if shared != batch_config:
+            raise ValueError(
+                "All configs in a batch must be identical apart from their input sections, "
+                "but %s differs from %s" % (
+                    sample_config["input"]["id"], sample_configs[0]["input"]["id"]))
+        sample_id = sample_config["input"]["id"]
+        if sample_id in samples:
+            raise ValueError("Sample ID %s appears more than once in the batch" % sample_id)
+        samples[sample_id] = sample_config["input"]
+    batch_config["samples"] = samples
+    return batch_config
+
+
+def main(args_list=None):
+    if args_list is None:
+        args_list = sys.argv[1:]
+    args = parser.parse_args(args_list)
+    logger.info(args)
+
+    if args.configfile and args.batch_configfile:
+        raise ValueError("Cannot specify both --configfile and --batch-configfile")
+    if args.telemetry_port and not args.telemetry_file:
+        raise ValueError("--telemetry-port requires --telemetry-file")
+    # planning only needs to know what would run
+    if args.plan:
+        args.dry_run = True
+    sample_configs = None
+    if args.batch_configfile:
+        sample_configs = [load_config(args, x)[1] for x in args.batch_configfile]
+        parsed_config = make_batch_config(sample_configs)
+        configfile_contents = yaml.safe_dump(parsed_config, default_flow_style=False)
+    else:
+        configfile_contents, parsed_config = load_config(args, args.configfile)
+
+    # if a shared reference cache is configured, use (or build) the indexes there instead of next
+    # to the reference FASTA
+    if parsed_config.get("reference_cache_dir"):
+        resolve_reference_cache(args, parsed_config)
+        configfile_contents = yaml.safe_dump(parsed_config, default_flow_style=False)
+        for sample_config in sample_configs or []:
+            sample_config["reference"] = parsed_config["reference"]
 
     with tempfile.NamedTemporaryFile(mode='w') as config_tmpfile:
         config_tmpfile.write(configfile_contents)
         logger.info("Processing reference, if necessary...")
-        process_reference(args, parsed_config, config_tmpfile)
+        # the reference is shared by a batch, so it only needs to be checked once
+        process_reference(args, (sample_configs or [parsed_config])[0], config_tmpfile)
         logger.info("Reference processing done.")
         if args.process_reference_only:
             if args.target is not None:
                 raise ValueError("If requesting --process-reference-only, cannot specify targets")
+        elif args.plan:
+            logger.info("Planning main pipeline...")
+            plan_neoantigen_pipeline(args, parsed_config, config_tmpfile, sample_configs)
         else:
             logger.info("Running main pipeline...")
-            run_neoantigen_pipeline(args, parsed_config, config_tmpfile)
+            run_neoantigen_pipeline(args, parsed_config, config_tmpfile, sample_configs)
             logger.info('Main pipeline done.')
 
-    # sanity-check post-processing: print any contents of QC result file
-    qc_contents_path = join(get_output_dir(parsed_config), "sequencing_qc_out.txt")
-    if args.run_qc and exists(qc_contents_path):
-        with open(qc_contents_path) as qc_contents_file:
-            qc_out_contents = qc_contents_file.read()
-            if len(qc_out_contents) > 0:
-                print('Some sequencing checks failed!')
-                print(qc_out_contents)
+    # sanity-check post-processing: print any contents of QC result files
+    for sample_config in sample_configs or [parsed_config]:
+        qc_contents_path = join(get_output_dir(sample_config), "sequencing_qc_out.txt")
+        if args.run_qc and exists(qc_contents_path):
+            with open(qc_contents_path) as qc_contents_file:
+                qc_out_contents = qc_contents_file.read()
+                if len(qc_out_contents) > 0:
+                    print('Some sequencing checks failed for %s!' % sample_config["input"]["id"])
+                    print(qc_out_contents)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,292 @@
+# Copyright (c) 2019. Mount Sinai School of Medicine
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Live telemetry of a Snakemake run, written as a stream of JSON lines while the run is in progress
+and optionally served as Prometheus metrics over HTTP on localhost.
+
+Events:
+- job_start, job_end: a job's rule, wildcards, threads and memory request; at the end, its status,
+  wall time, CPU time, peak RSS and bytes read and written.
+- job_sample: every --telemetry-interval seconds for each running job, the CPU load, RSS and I/O of
+  its process tree.
+- scheduler: at the same interval, the number of done, running and pending jobs, the cores and
+  memory reserved by running jobs, idle cores and the CPU load of the whole node.
+
+Jobs are matched to the processes Snakemake starts for them by the output and log paths on their
+command lines. CPU and I/O of processes that exit between two samples are only partly counted.
+"""
+
+from http.server import BaseHTTPRequestHandler, HTTPServer
+import json
+import threading
+import time
+
+import psutil
+import snakemake.logging
+
+MB = 1024 * 1024
+
+
+def _resources_dict(resources):
+    return {
+        name: value for name, value in resources.items()
+        if not name.startswith("_") and isinstance(value, (int, float, str))
+    }
+
+
+class Telemetry(object):
+    def __init__(self, path, cores, stage, port=None, interval=5):
+        self.path = path
+        self.cores = cores
+        self.stage = stage
+        self.port = port
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.out = None
+        self.server = None
+        self.sampler = None
+        self.stopped = threading.Event()
+        # jobid -> state of a running job
+        self.jobs = {}
+        self.done = 0
+        self.total = 0
+        # pid -> (psutil.Process, last CPU seconds, last read bytes, last write bytes)
+        self.processes = {}
+        self.last_sample_time = None
+        self.latest_scheduler = {}
+        self.latest_job_samples = []
+
+    def start(self):
+        self.out = open(self.path, 'a')
+        self.emit("run_start", cores=self.cores)
+        snakemake.logging.logger.log_handler.append(self.log_handler)
+        self.sampler = threading.Thread(target=self._sample_loop, daemon=True)
+        self.sampler.start()
+        if self.port:
+            self.server = HTTPServer(("127.0.0.1", self.port), _metrics_handler(self))
+            threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def stop(self, success=None):
+        self.stopped.set()
+        self.sampler.join()
+        if self.log_handler in snakemake.logging.logger.log_handler:
+            snakemake.logging.logger.log_handler.remove(self.log_handler)
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+        self.emit("run_end", success=success, done=self.done, total=self.total)
+        self.out.close()
+
+    def emit(self, event, **fields):
+        record = dict(time=time.time(), stage=self.stage, event=event, **fields)
+        with self.lock:
+            self.out.write(json.dumps(record, sort_keys=True, default=str) + "\n")
+            self.out.flush()
+
+    def log_handler(self, msg):
+        """
+        Snakemake log handler, called with every message Snakemake logs
+        """
+        level = msg["level"]
+        if level == "progress":
+            with self.lock:
+                self.done, self.total = msg["done"], msg["total"]
+        elif level == "job_info":
+            self._job_start(msg)
+        elif level == "job_finished":
+            self._job_end(msg["jobid"], "ok")
+        elif level == "job_error":
+            self._job_end(msg["jobid"], "error")
+
+    def _job_start(self, msg):
+        resources = _resources_dict(msg["resources"])
+        job = {
+            'jobid': msg["jobid"],
+            'rule': msg["name"],
+            'wildcards': dict(msg["wildcards"] or {}),
+            'threads': msg["threads"],
+            'mem_mb': resources.get("mem_mb"),
+            'start': time.time(),
+            # paths that the command lines of the job's processes contain
+            'paths': [str(x) for x in list(msg["output"]) + list(msg["log"])],
+            'cpu_seconds': 0.0,
+            'read_bytes': 0,
+            'write_bytes': 0,
+            'peak_rss': 0,
+        }
+        with self.lock:
+            self.jobs[msg["jobid"]] = job
+        self.emit("job_start", jobid=job['jobid'], rule=job['rule'],
+            wildcards=job['wildcards'], threads=job['threads'], resources=resources)
+
+    def _job_end(self, jobid, status):
+        with self.lock:
+            job = self.jobs.pop(jobid, None)
+        if job is None:
+            return
+        self.emit("job_end", jobid=jobid, rule=job['rule'], wildcards=job['wildcards'],
+            status=status, wall_seconds=round(time.time() - job['start'], 3),
+            cpu_seconds=round(job['cpu_seconds'], 3), peak_rss_mb=round(job['peak_rss'] / MB, 1),
+            read_bytes=job['read_bytes'], write_bytes=job['write_bytes'], threads=job['threads'],
+            mem_mb=job['mem_mb'])
+
+    def _find_job(self, cmdline):
+        for job in self.jobs.values():
+            if any(path in cmdline for path in job['paths']):
+                return job
+        return None
+
+    def _sample_process(self, process):
+        """
+        Returns the CPU seconds, read bytes and written bytes of a process since it was last
+        sampled, and its RSS
+        """
+        with process.oneshot():
+            cpu_times = process.cpu_times()
+            rss = process.memory_info().rss
+            try:
+                io_counters = process.io_counters()
+                read_bytes, write_bytes = io_counters.read_bytes, io_counters.write_bytes
+            except (AttributeError, psutil.AccessDenied):
+                read_bytes, write_bytes = 0, 0
+        cpu_seconds = cpu_times.user + cpu_times.system
+        _, last_cpu_seconds, last_read_bytes, last_write_bytes = self.processes.get(
+            process.pid, (None, 0.0, 0, 0))
+        self.processes[process.pid] = (process, cpu_seconds, read_bytes, write_bytes)
+        return (cpu_seconds - last_cpu_seconds, read_bytes - last_read_bytes,
+            write_bytes - last_write_bytes, rss)
+
+    def sample(self):
+        now = time.time()
+        elapsed = now - self.last_sample_time if self.last_sample_time else None
+        self.last_sample_time = now
+        job_samples = {}
+        seen_pids = set()
+        try:
+            children = psutil.Process().children()
+        except psutil.Error:
+            children = []
+        for child in children:
+            try:
+                job = self._find_job(" ".join(child.cmdline()))
+                if job is None:
+                    continue
+                tree = [child] + child.children(recursive=True)
+            except psutil.Error:
+                continue
+            job_sample = job_samples.setdefault(job['jobid'], {
+                'cpu_seconds': 0.0, 'read_bytes': 0, 'write_bytes': 0, 'rss': 0,
+                'num_processes': 0})
+            for process in tree:
+                try:
+                    cpu_seconds, read_bytes, write_bytes, rss = self._sample_process(process)
+                except psutil.Error:
+                    continue
+                seen_pids.add(process.pid)
+                job_sample['cpu_seconds'] += cpu_seconds
+                job_sample['read_bytes'] += read_bytes
+                job_sample['write_bytes'] += write_bytes
+                job_sample['rss'] += rss
+                job_sample['num_processes'] += 1
+        self.processes = {pid: x for pid, x in self.processes.items() if pid in seen_pids}
+
+        latest_job_samples = []
+        with self.lock:
+            for jobid, job_sample in job_samples.items():
+                job = self.jobs.get(jobid)
+                if job is None:
+                    continue
+                job['cpu_seconds'] += job_sample['cpu_seconds']
+                job['read_bytes'] += job_sample['read_bytes']
+                job['write_bytes'] += job_sample['write_bytes']
+                job['peak_rss'] = max(job['peak_rss'], job_sample['rss'])
+                latest_job_samples.append({
+                    'jobid': jobid,
+                    'rule': job['rule'],
+                    'cpu_percent': round(100 * job_sample['cpu_seconds'] / elapsed, 1)
+                        if elapsed else None,
+                    'rss_mb': round(job_sample['rss'] / MB, 1),
+                    'read_bytes': job['read_bytes'],
+                    'write_bytes': job['write_bytes'],
+                    'num_processes': job_sample['num_processes'],
+                })
+            running = len(self.jobs)
+            cores_in_use = sum(job['threads'] for job in self.jobs.values())
+            mem_mb_in_use = sum(job['mem_mb'] or 0 for job in self.jobs.values())
+            scheduler = {
+                'done': self.done,
+                'total': self.total,
+                'running': running,
+                'pending': max(0, self.total - self.done - running),
+                'cores_in_use': cores_in_use,
+                'idle_cores': max(0, self.cores - cores_in_use),
+                'mem_mb_in_use': mem_mb_in_use,
+                'node_cpu_percent': psutil.cpu_percent(),
+            }
+            self.latest_job_samples = latest_job_samples
+            self.latest_scheduler = scheduler
+        for job_sample in latest_job_samples:
+            self.emit("job_sample", **job_sample)
+        self.emit("scheduler", **scheduler)
+
+    def _sample_loop(self):
+        while not self.stopped.wait(self.interval):
+            self.sample()
+
+    def metrics_text(self):
+        """
+        Returns the latest samples in the Prometheus text format
+        """
+        with self.lock:
+            scheduler = dict(self.latest_scheduler)
+            job_samples = list(self.latest_job_samples)
+        lines = []
+        for key in ["done", "running", "pending"]:
+            if key in scheduler:
+                lines.append('neoantigen_pipeline_jobs{state="%s"} %d' % (key, scheduler[key]))
+        for key, state in [("idle_cores", "idle"), ("cores_in_use", "in_use")]:
+            if key in scheduler:
+                lines.append('neoantigen_pipeline_cores{state="%s"} %d' % (state, scheduler[key]))
+        if "mem_mb_in_use" in scheduler:
+            lines.append("neoantigen_pipeline_reserved_mem_mb %d" % scheduler["mem_mb_in_use"])
+        for job_sample in job_samples:
+            labels = '{rule="%s",jobid="%s"}' % (job_sample['rule'], job_sample['jobid'])
+            if job_sample['cpu_percent'] is not None:
+                lines.append("neoantigen_pipeline_job_cpu_percent%s %s" % (
+                    labels, job_sample['cpu_percent']))
+            lines.append("neoantigen_pipeline_job_rss_mb%s %s" % (labels, job_sample['rss_mb']))
+            lines.append("neoantigen_pipeline_job_read_bytes%s %d" % (
+                labels, job_sample['read_bytes']))
+            lines.append("neoantigen_pipeline_job_write_bytes%s %d" % (
+                labels, job_sample['write_bytes']))
+        return "\n".join(lines) + "\n"
+
+
+def _metrics_handler(telemetry):
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path != "/metrics":
+                self.send_error(404)
+                return
+            body = telemetry.metrics_text().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+    return MetricsHandler
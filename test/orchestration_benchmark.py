@@ -0,0 +1,414 @@
+# Copyright (c) 2019. Mount Sinai School of Medicine
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Benchmark of the pipeline's orchestration overhead: how Snakefile parsing, DAG construction and
+job scheduling scale with the number of fragments, contigs and interval shards, with the tools
+themselves taking no time.
+
+For each scale, generates a synthetic reference (tiny contigs with their .fai, .dict and .contigs
+files), a config in the style of test/idh1_config.yaml and tiny FASTQs made of the first reads of
+the datagen/ IDH1 FASTQs, one per fragment of each input type. The pipeline is then run end to end
+through run_snakemake.py, with stub_tool.py standing in for bwa, samtools, sambamba, Picard, GATK,
+MuTect, Strelka, STAR and vaxrank. Timings come from its telemetry file (see telemetry.py):
+
+- startup_seconds: from starting run_snakemake.py to the start of the first pipeline job
+- dag_build_seconds: from the start of the main Snakemake invocation to its first job, i.e. parsing
+  the Snakefile, evaluating input functions and building the DAG
+- seconds_per_job: wall time of the main invocation after its first job started, per job
+- overhead_per_job: the part of that time in which no stub tool was running, per job; with --cores 1
+  (the default) this is Snakemake's scheduling and job handling plus the pipeline's own scripts
+
+Run from the repository root, e.g.:
+    python test/orchestration_benchmark.py --scale single --scale fragments --out results.json
+and compare a later run against it with --baseline results.json.
+"""
+
+from argparse import ArgumentParser
+from collections import OrderedDict
+import gzip
+import json
+from os import chmod, environ, makedirs, pathsep
+from os.path import abspath, dirname, join
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import yaml
+
+REPO_DIR = dirname(dirname(abspath(__file__)))
+
+# name -> (fragments per input type, contigs, interval shards or None to scatter over contigs)
+SCALES = OrderedDict([
+    ("single", (1, 2, None)),
+    ("fragments", (200, 2, None)),
+    ("contigs", (1, 100, None)),
+    ("intervals", (1, 2000, 20)),
+])
+
+STUB_TOOLS = [
+    "bwa", "samtools", "sambamba", "picard", "gatk", "java", "STAR", "vaxrank", "fastqc",
+    "bedtools", "bgzip", "tabix", "configureStrelkaWorkflow.pl",
+]
+
+CONTIG_LENGTH = 240
+FASTA_LINE_LENGTH = 60
+READS_PER_FASTQ = 4
+
+METRICS = ["startup_seconds", "dag_build_seconds", "seconds_per_job", "overhead_per_job"]
+
+parser = ArgumentParser()
+
+parser.add_argument(
+    "--scale",
+    action="append",
+    choices=list(SCALES),
+    help="Scale to benchmark; can be repeated (default: all of %s)" % ", ".join(SCALES))
+
+parser.add_argument(
+    "--fragments",
+    type=int,
+    help="Instead of a predefined scale, benchmark this many fragments per input type, with "
+    "--contigs and --interval-shards")
+
+parser.add_argument(
+    "--contigs",
+    type=int,
+    default=2,
+    help="Number of reference contigs of a --fragments scale (default %(default)s)")
+
+parser.add_argument(
+    "--interval-shards",
+    type=int,
+    help="Number of interval shards of a --fragments scale (default: scatter over contigs)")
+
+parser.add_argument(
+    "--cores",
+    type=int,
+    default=1,
+    help="Number of cores to run the pipeline with (default %(default)s)")
+
+parser.add_argument(
+    "--somatic-variant-calling-only",
+    default=False,
+    action="store_true",
+    help="If this argument is present, leave out RNA processing and vaxrank")
+
+parser.add_argument(
+    "--out",
+    default="",
+    help="JSON file to write the results to")
+
+parser.add_argument(
+    "--baseline",
+    default="",
+    help="JSON results of an earlier benchmark to compare with; exits with an error if a metric "
+    "of a scale in both got slower by more than --max-slowdown")
+
+parser.add_argument(
+    "--max-slowdown",
+    type=float,
+    default=1.5,
+    help="Largest acceptable ratio of a metric to its --baseline value (default %(default)s)")
+
+parser.add_argument(
+    "--keep-workdir",
+    default=False,
+    action="store_true",
+    help="If this argument is present, print the path of the generated data and pipeline outputs "
+    "instead of removing them")
+
+
+def write_reference(reference_dir, num_contigs):
+    """
+    Writes a reference FASTA of num_contigs tiny contigs, with the index files that the pipeline
+    doesn't build itself before the main Snakemake invocation. Returns its path.
+    """
+    genome = join(reference_dir, "genome.fasta")
+    rng = random.Random(num_contigs)
+    contigs = [str(i + 1) for i in range(num_contigs)]
+    fai_lines = []
+    offset = 0
+    with open(genome, 'w') as f:
+        for contig in contigs:
+            header = ">%s\n" % contig
+            f.write(header)
+            offset += len(header)
+            fai_lines.append("%s\t%d\t%d\t%d\t%d\n" % (
+                contig, CONTIG_LENGTH, offset, FASTA_LINE_LENGTH, FASTA_LINE_LENGTH + 1))
+            sequence = "".join(rng.choice("ACGT") for _ in range(CONTIG_LENGTH))
+            for start in range(0, CONTIG_LENGTH, FASTA_LINE_LENGTH):
+                line = sequence[start:start + FASTA_LINE_LENGTH] + "\n"
+                f.write(line)
+                offset += len(line)
+    # written after the FASTA, so that the reference counts as processed
+    with open(genome + ".fai", 'w') as f:
+        f.writelines(fai_lines)
+    with open(join(reference_dir, "genome.dict"), 'w') as f:
+        f.write("@HD\tVN:1.5\n")
+        f.writelines("@SQ\tSN:%s\tLN:%d\n" % (x, CONTIG_LENGTH) for x in contigs)
+    with open(genome + ".contigs", 'w') as f:
+        f.writelines(x + "\n" for x in contigs)
+    for name in ["dbsnp.vcf", "cosmic.vcf"]:
+        with open(join(reference_dir, name), 'w') as f:
+            f.write("##fileformat=VCFv4.1\n#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\n")
+    with open(join(reference_dir, "transcripts.gtf"), 'w') as f:
+        f.write("")
+    return genome
+
+
+def read_fastq_records(path, num_reads):
+    with gzip.open(path, 'rt') as f:
+        return "".join(f.readline() for _ in range(4 * num_reads))
+
+
+def write_inputs(input_dir, num_fragments, rna=True):
+    """
+    Writes a tiny FASTQ for each fragment of each input type, and returns the input section of
+    the config
+    """
+    reads = {
+        x: read_fastq_records(join(REPO_DIR, "datagen", "idh1_r132h_%s.fastq.gz" % x),
+            READS_PER_FASTQ)
+        for x in ["normal", "tumor"]
+    }
+    config_input = {'id': "synthetic", 'mhc_alleles': ["HLA-A*30:01"]}
+    for input_type in ["normal", "tumor", "rna"] if rna else ["normal", "tumor"]:
+        config_input[input_type] = []
+        for i in range(num_fragments):
+            fragment_id = "L%03d" % (i + 1)
+            path = join(input_dir, "%s_%s.fastq.gz" % (input_type, fragment_id))
+            with gzip.open(path, 'wt') as f:
+                f.write(reads["normal" if input_type == "normal" else "tumor"])
+            config_input[input_type].append({
+                'fragment_id': fragment_id, 'type': "single-end", 'r': path})
+    return config_input
+
+
+# Each stub call appends its start and end time to $STUB_TOOL_TIMES (using GNU date), so that the
+# time spent in stubs can be told from the pipeline's own
+STUB_WRAPPER = """#!/bin/sh
+start=$(date +%%s.%%N)
+"%s" "%s" %s "$@"
+status=$?
+echo "$start $(date +%%s.%%N)" >> "$STUB_TOOL_TIMES"
+exit $status
+"""
+
+
+def write_stub_tools(bin_dir):
+    stub = join(REPO_DIR, "test", "stub_tool.py")
+    for tool in STUB_TOOLS:
+        path = join(bin_dir, tool)
+        with open(path, 'w') as f:
+            f.write(STUB_WRAPPER % (sys.executable, stub, tool))
+        chmod(path, 0o755)
+
+
+def generate(root, num_fragments, num_contigs, interval_shards, rna=True):
+    """
+    Writes the reference, inputs, stub tools and config of one scale under root. Returns the
+    config path.
+    """
+    dirs = {x: join(root, x) for x in ["reference", "inputs", "outputs", "bin"]}
+    for path in dirs.values():
+        makedirs(path)
+    genome = write_reference(dirs["reference"], num_contigs)
+    write_stub_tools(dirs["bin"])
+    config = {
+        'input': write_inputs(dirs["inputs"], num_fragments, rna=rna),
+        'workdir': dirs["outputs"],
+        'reference': {
+            'genome': genome,
+            'dbsnp': join(dirs["reference"], "dbsnp.vcf"),
+            'cosmic': join(dirs["reference"], "cosmic.vcf"),
+            'transcripts': join(dirs["reference"], "transcripts.gtf"),
+        },
+        'parallel_indel_realigner': True,
+        'parallel_bqsr': True,
+        'mhc_predictor': "netmhcpan-iedb",
+        'variant_callers': ["mutect", "strelka"],
+    }
+    if interval_shards:
+        config['interval_shards'] = interval_shards
+    config_path = join(root, "config.yaml")
+    with open(config_path, 'w') as f:
+        yaml.safe_dump(config, f, default_flow_style=False)
+    return config_path
+
+
+def stub_environment(root):
+    bin_dir = join(root, "bin")
+    env = dict(environ)
+    env.update({
+        'STUB_TOOL_TIMES': join(root, "stub_tool_times.txt"),
+        'PATH': bin_dir + pathsep + environ.get("PATH", ""),
+        'SCRIPTS': join(REPO_DIR, "pipeline", "scripts"),
+        'JAVA7_BIN': bin_dir,
+        'MUTECT': join(bin_dir, "mutect.jar"),
+        'GATK_JAR': join(bin_dir, "gatk.jar"),
+        'STRELKA_BIN': bin_dir,
+        'STRELKA_CONFIG': join(REPO_DIR, "pipeline", "strelka_config.txt"),
+    })
+    return env
+
+
+def _busy_seconds(intervals):
+    """
+    Returns the total length of the union of (start, end) intervals
+    """
+    busy = 0.0
+    current_start, current_end = None, None
+    for start, end in sorted(intervals):
+        if current_end is None or start > current_end:
+            if current_end is not None:
+                busy += current_end - current_start
+            current_start, current_end = start, end
+        else:
+            current_end = max(current_end, end)
+    if current_end is not None:
+        busy += current_end - current_start
+    return busy
+
+
+def summarize_run(root, launch_time):
+    """
+    Returns the benchmark metrics of a run from its telemetry events and stub tool times
+    """
+    with open(join(root, "telemetry.jsonl")) as f:
+        events = [json.loads(x) for x in f if x.strip()]
+    with open(join(root, "stub_tool_times.txt")) as f:
+        stub_times = [tuple(float(x) for x in line.split()) for line in f]
+    pipeline = [x for x in events if x["stage"] == "pipeline"]
+    run_start = next(x["time"] for x in pipeline if x["event"] == "run_start")
+    run_end = next(x["time"] for x in pipeline if x["event"] == "run_end")
+    first_job = min(x["time"] for x in pipeline if x["event"] == "job_start")
+    jobs = sum(1 for x in pipeline if x["event"] == "job_end")
+    run_seconds = run_end - first_job
+    # stubs of the reference processing before the main invocation don't count
+    stub_seconds = _busy_seconds(x for x in stub_times if x[0] >= first_job)
+    return OrderedDict([
+        ("jobs", jobs),
+        ("startup_seconds", round(first_job - launch_time, 3)),
+        ("dag_build_seconds", round(first_job - run_start, 3)),
+        ("run_seconds", round(run_seconds, 3)),
+        ("seconds_per_job", round(run_seconds / jobs, 4)),
+        ("stub_seconds", round(stub_seconds, 3)),
+        ("overhead_per_job", round((run_seconds - stub_seconds) / jobs, 4)),
+    ])
+
+
+def run_scale(root, name, num_fragments, num_contigs, interval_shards, args):
+    """
+    Generates the data of one scale and runs the pipeline on it. Returns its metrics.
+    """
+    config_path = generate(
+        root, num_fragments, num_contigs, interval_shards,
+        rna=not args.somatic_variant_calling_only)
+    command = [
+        sys.executable, join(REPO_DIR, "run_snakemake.py"),
+        "--configfile", config_path,
+        "--cores", str(args.cores),
+        "--memory", "33",
+        "--disk-budget", "1000",
+        "--telemetry-file", join(root, "telemetry.jsonl"),
+        # only job starts and ends are needed
+        "--telemetry-interval", "3600",
+    ]
+    if args.somatic_variant_calling_only:
+        command.append("--somatic-variant-calling-only")
+    print("Running scale %s: %d fragments, %d contigs, %s interval shards" % (
+        name, num_fragments, num_contigs, interval_shards or "no"), file=sys.stderr)
+    launch_time = time.time()
+    with open(join(root, "run_snakemake.log"), 'w') as log:
+        returncode = subprocess.call(
+            command, cwd=REPO_DIR, env=stub_environment(root), stdout=log,
+            stderr=subprocess.STDOUT)
+    total_seconds = time.time() - launch_time
+    if returncode != 0:
+        raise ValueError("Pipeline failed for scale %s, see %s" % (
+            name, join(root, "run_snakemake.log")))
+    result = OrderedDict([
+        ("scale", name),
+        ("fragments", num_fragments),
+        ("contigs", num_contigs),
+        ("interval_shards", interval_shards),
+        ("cores", args.cores),
+    ])
+    result.update(summarize_run(root, launch_time))
+    result["total_seconds"] = round(total_seconds, 3)
+    return result
+
+
+def compare(results, baseline, max_slowdown):
+    """
+    Prints each metric's ratio to its value in the baseline results, and returns the
+    (scale, metric) pairs that got slower by more than max_slowdown
+    """
+    baseline_by_scale = {x["scale"]: x for x in baseline}
+    regressions = []
+    for result in results:
+        before = baseline_by_scale.get(result["scale"])
+        if before is None:
+            continue
+        for metric in METRICS:
+            if not before.get(metric):
+                continue
+            ratio = result[metric] / before[metric]
+            print("%-12s %-22s %10.4f -> %10.4f  (x%.2f)" % (
+                result["scale"], metric, before[metric], result[metric], ratio))
+            if ratio > max_slowdown:
+                regressions.append((result["scale"], metric))
+    return regressions
+
+
+def main(args_list=None):
+    if args_list is None:
+        args_list = sys.argv[1:]
+    args = parser.parse_args(args_list)
+
+    if args.fragments:
+        scales = [("custom", (args.fragments, args.contigs, args.interval_shards))]
+    else:
+        scales = [(x, SCALES[x]) for x in args.scale or SCALES]
+
+    workdir = tempfile.mkdtemp(prefix="orchestration_benchmark_")
+    results = []
+    try:
+        for name, (num_fragments, num_contigs, interval_shards) in scales:
+            results.append(run_scale(
+                join(workdir, name), name, num_fragments, num_contigs, interval_shards, args))
+    finally:
+        if args.keep_workdir:
+            print("Benchmark data and outputs are in %s" % workdir, file=sys.stderr)
+        else:
+            shutil.rmtree(workdir)
+
+    print(json.dumps(results, indent=2))
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.max_slowdown)
+        if regressions:
+            raise ValueError("Orchestration overhead regressed for %s" % ", ".join(
+                "%s %s" % x for x in regressions))
+
+
+if __name__ == "__main__":
+    main()
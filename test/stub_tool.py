@@ -0,0 +1,165 @@
+# Copyright (c) 2019. Mount Sinai School of Medicine
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Stand-in for the external tools of the pipeline (bwa, samtools, sambamba, Picard, GATK, MuTect,
+Strelka, STAR, vaxrank, ...), used by orchestration_benchmark.py to run the whole pipeline in
+seconds. Called as "stub_tool.py <tool name> <tool arguments>".
+
+Nothing is computed: the stub creates the files that the tool would have written, with just enough
+content for the pipeline's own scripts that read them (header-only VCFs and SAM streams, zero
+flagstat counts). Any absolute path argument that doesn't exist yet, but whose directory does, is
+taken to be an output; tool-specific outputs that aren't named on the command line (index files,
+STAR's output prefix, IndelRealigner's --nWayOut, Strelka's Makefile) are added on top of that.
+"""
+
+from os import makedirs
+from os.path import basename, dirname, exists, isabs, isdir, join
+import sys
+
+VCF_HEADER = (
+    "##fileformat=VCFv4.1\n"
+    "#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\tnormal\ttumor\n")
+
+SAM_HEADER = "@HD\tVN:1.5\tSO:coordinate\n"
+
+FLAGSTAT = "\n".join([
+    "0 + 0 in total (QC-passed reads + QC-failed reads)",
+    "0 + 0 secondary",
+    "0 + 0 supplementary",
+    "0 + 0 duplicates",
+    "0 + 0 mapped (N/A : N/A)",
+    "0 + 0 paired in sequencing",
+    "0 + 0 read1",
+    "0 + 0 read2",
+    "0 + 0 properly paired (N/A : N/A)",
+    "0 + 0 with itself and mate mapped",
+    "0 + 0 singletons (N/A : N/A)",
+    "0 + 0 with mate mapped to a different chr",
+    "0 + 0 with mate mapped to a different chr (mapQ>=5)",
+    ""])
+
+STRELKA_MAKEFILE = (
+    "all:\n"
+    "\tmkdir -p results\n"
+    "\tcp config/header.vcf results/passed.somatic.snvs.vcf\n"
+    "\tcp config/header.vcf results/passed.somatic.indels.vcf\n")
+
+
+def _content(path):
+    if path.endswith(".vcf"):
+        return VCF_HEADER
+    if path.endswith(".json"):
+        return "{}\n"
+    return ""
+
+
+def write_output(path):
+    if exists(path):
+        return
+    if dirname(path):
+        makedirs(dirname(path), exist_ok=True)
+    with open(path, 'w') as f:
+        f.write(_content(path))
+
+
+def _option_value(args, option):
+    if option in args and args.index(option) + 1 < len(args):
+        return args[args.index(option) + 1]
+    return None
+
+
+def _path_arguments(args):
+    """
+    Yields the path-looking parts of the arguments, including the values of KEY=value and
+    --option=value arguments (Picard and GATK style).
+    """
+    for arg in args:
+        for value in [arg, arg.split("=", 1)[-1]]:
+            if isabs(value):
+                yield value
+
+
+def implied_outputs(tool, args):
+    """
+    Returns the outputs of a tool call that aren't named on its command line.
+    """
+    outputs = []
+    if tool == "bwa" and args[:1] == ["index"]:
+        outputs.extend("%s.%s" % (args[-1], x) for x in ["amb", "ann", "bwt", "pac", "sa"])
+    elif tool == "samtools" and args[:1] == ["faidx"]:
+        outputs.append(args[-1] + ".fai")
+    elif tool == "sambamba" and args[:1] == ["merge"]:
+        # indexes the merged BAM, the first path argument
+        outputs.append(next(_path_arguments(args)) + ".bai")
+    elif tool == "STAR" and "genomeGenerate" in args:
+        outputs.append(join(_option_value(args, "--genomeDir"), "SA"))
+    elif tool == "STAR":
+        outputs.append(
+            _option_value(args, "--outFileNamePrefix") + "Aligned.sortedByCoord.out.bam")
+    elif tool == "gatk" and "--nWayOut" in args:
+        # one realigned BAM and index per input, in the current directory
+        suffix = _option_value(args, "--nWayOut")
+        for i, arg in enumerate(args[:-1]):
+            if arg == "-I":
+                prefix = basename(args[i + 1])[:-len(".bam")]
+                outputs.append(prefix + suffix)
+                outputs.append(prefix + suffix[:-len(".bam")] + ".bai")
+    elif tool == "gatk" and (_option_value(args, "-o") or "").endswith(".bam"):
+        outputs.append(_option_value(args, "-o")[:-len(".bam")] + ".bai")
+    elif tool == "java" and "--vcf" in args:
+        outputs.append(_option_value(args, "--vcf") + ".idx")
+    elif tool == "tabix":
+        outputs.append(args[-1] + ".tbi")
+    return outputs
+
+
+def configure_strelka(args):
+    output_dir = _option_value(args, "--output-dir")
+    write_output(join(output_dir, "config", "header.vcf"))
+    with open(join(output_dir, "Makefile"), 'w') as f:
+        f.write(STRELKA_MAKEFILE)
+
+
+def run_tool(tool, args):
+    # tools reading from a pipe would otherwise stop their writer with SIGPIPE
+    if "-" in args:
+        sys.stdin.read()
+
+    if tool == "configureStrelkaWorkflow.pl":
+        configure_strelka(args)
+        return
+    for path in _path_arguments(args):
+        if not exists(path) and isdir(dirname(path)):
+            write_output(path)
+    for path in implied_outputs(tool, args):
+        write_output(path)
+
+    # tools whose output the pipeline reads from stdout
+    if tool == "bwa" and args[:1] == ["mem"]:
+        sys.stdout.write(SAM_HEADER)
+    elif tool == "samtools" and args[:1] == ["view"] and "-o" not in args:
+        sys.stdout.write(SAM_HEADER)
+    elif tool == "samtools" and args[:1] == ["flagstat"]:
+        sys.stdout.write(FLAGSTAT)
+
+
+def main(args_list=None):
+    if args_list is None:
+        args_list = sys.argv[1:]
+    run_tool(basename(args_list[0]), args_list[1:])
+
+
+if __name__ == "__main__":
+    main()
@@ -14,18 +14,57 @@
 #
 # NOTE: for easiest readability, run this with: "nosetests --nocapture --nologcapture"
 
+from argparse import Namespace
 import glob
-from os import chdir, listdir
-from os.path import dirname, join
+import gzip
+import io
+import json
+import math
+import os
+import subprocess
+import sys
+from os import chdir, listdir, makedirs, stat, utime
+from os.path import basename, dirname, getsize, isdir, islink, join
 from shutil import copy2
 import tempfile
 import unittest
+from unittest import mock
 
+from mhctools import BindingPrediction, BindingPredictionCollection
+from mhctools.base_predictor import BasePredictor
+from mhctools.iedb import IedbNetMHCpan
+import pandas
+from pyensembl import EnsemblRelease
 import snakemake
 import yaml
 
 from run_snakemake import main as docker_entrypoint, \
-    default_vaxrank_targets, somatic_vcf_targets
+    default_vaxrank_targets, somatic_vcf_targets, make_config_extension_dict, parser, \
+    resolve_reference_cache, output_cache_groups, link_cached_outputs, store_cached_outputs, \
+    rename_read_group_sample, region_targets_dir, cram_targets
+from run_report import diff_reports, make_report
+from capacity_plan import JobCollector, amdahl_wall_seconds, recommend, simulate
+from orchestration_benchmark import generate, main as orchestration_benchmark, stub_environment
+from telemetry import Telemetry
+from pipeline.scripts.interval_shards import find_cut_points, make_shards, split_contig
+from pipeline.scripts.pyensembl_install import main as pyensembl_install
+from pipeline.scripts.markdup_metrics import duplication_metrics, parse_flagstat, write_metrics
+from pipeline.scripts.sequencing import get_metrics, main as sequencing_qc
+from pipeline.scripts.stage_input import main as stage_input
+from pipeline.scripts.vaxrank_mhc_cache import PredictionCache, cached_binding_predictor_from_args
+from pipeline.scripts.target_intervals import main as target_intervals
+from pipeline.scripts.vcf_gather import main as vcf_gather
+from pipeline.scripts.vcf_shards import main as vcf_shards
+
+class ShellCommandCollector(JobCollector):
+    """
+    JobCollector that also records the shell command of each job, logged right after the job
+    """
+    def __call__(self, msg):
+        super().__call__(msg)
+        if msg["level"] == "shellcmd":
+            self.jobs[-1]["shellcmd"] = msg["msg"]
+
 
 class TestPipeline(unittest.TestCase):
     @classmethod
@@ -51,7 +90,7 @@ class TestPipeline(unittest.TestCase):
         # populate reference files with placeholder content
         files_to_populate = [
             'b37decoy.fasta', 'b37decoy.dict', 'b37decoy.fasta.contigs', 'b37decoy.fasta.done',
-            'transcripts.gtf', 'dbsnp.vcf', 'cosmic.vcf', 'S04380110_Covered_grch37.bed'
+            'transcripts.gtf', 'dbsnp.vcf', 'cosmic.vcf', 'S04380110_Covered_grch37_with_M.bed'
         ]
         for path in files_to_populate:
             with open(join(cls.referencedir.name, path), 'w') as f:
@@ -81,6 +120,38 @@ class TestPipeline(unittest.TestCase):
     def _get_pipeline_dir_path(cls):
         return join(cls._get_test_dir_path(), '..', 'pipeline')
 
+    # Dry-runs the pipeline on the test config with config_updates applied to it, checks that the
+    # dry run succeeds (or fails), and returns the jobs it would run, as collected by
+    # capacity_plan.JobCollector, with the shell command of each job that has one
+    def _dry_run_jobs(
+            self, config_updates=None, config_extension=None, targets=None, succeeds=True):
+        with open(self.config_tmpfile.name) as config_file:
+            config = yaml.safe_load(config_file)
+        config.update(config_updates or {})
+        if targets is None:
+            targets = [
+                join(self.workdir.name, 'idh1-test-sample',
+                     'vaccine-peptide-report_netmhcpan-iedb_mutect-strelka.txt'),
+                join(self.workdir.name, 'idh1-test-sample', 'rna_final.bam'),
+            ]
+        collector = ShellCommandCollector()
+        with tempfile.NamedTemporaryFile(mode='w', suffix='.yaml') as configfile:
+            yaml.dump(config, configfile)
+            configfile.flush()
+            extension = {'num_threads': 22, 'mem_gb': 160, 'contigs': ['2']}
+            extension.update(config_extension or {})
+            self.assertEqual(succeeds, snakemake.snakemake(
+                join(self._get_pipeline_dir_path(), 'Snakefile'),
+                cores=20,
+                resources={'mem_mb': 160000},
+                configfile=configfile.name,
+                config=extension,
+                dryrun=True,
+                targets=targets,
+                workdir=self.workdir.name,
+                log_handler=collector))
+        return collector.jobs
+
     def test_vaxrank_targets(self):
         with open(join(self._get_test_dir_path(), 'idh1_config.yaml'), 'r') as idh1_config_file:
             config = yaml.safe_load(idh1_config_file)
@@ -106,6 +177,593 @@ class TestPipeline(unittest.TestCase):
         for target in targets:
             self.assertTrue(target in expected_targets)
 
+        config["compressed_vcfs"] = True
+        self.assertEqual(
+            ['/outputs/idh1-test-sample/mutect.vcf.gz', '/outputs/idh1-test-sample/strelka.vcf.gz'],
+            sorted(somatic_vcf_targets(config)))
+
+    def test_interval_shards_config(self):
+        with open(self.config_tmpfile.name) as config_file:
+            config = yaml.safe_load(config_file)
+        config["interval_shards"] = 2
+        with open(join(self.referencedir.name, 'b37decoy.fasta.2.shards'), 'w') as f:
+            f.write('shard0000\t1:1-1000\nshard0001\t1:1001-2000\nshard0001\t2:1-500\n')
+        args = parser.parse_args(['--configfile', self.config_tmpfile.name])
+        config_extension = make_config_extension_dict(args, config)
+        self.assertEqual(['shard0000', 'shard0001'], config_extension['shards'])
+        self.assertEqual(
+            [['1:1-1000'], ['1:1001-2000', '2:1-500']], config_extension['shard_intervals'])
+
+    def test_interval_shards(self):
+        # contig 1 has an 8-base N-run across a line break, contig 2 has no Ns, and contig 3 ends
+        # in an N-run
+        fasta = io.BytesIO(
+            b'>1\nACGTNNNN\nNNNNACGT\n>2\nACGTACGT\nACGT\n>3\nACGTACGT\nACGTNNNN\n')
+        fai = {'1': (16, 3, 8, 9), '2': (12, 24, 8, 9), '3': (16, 41, 8, 9)}
+        self.assertEqual([8], find_cut_points(fasta, fai['1'], 8))
+        self.assertEqual([], find_cut_points(fasta, fai['1'], 9))
+        self.assertEqual([], find_cut_points(fasta, fai['2'], 1))
+        self.assertEqual([14], find_cut_points(fasta, fai['3'], 4))
+
+        self.assertEqual([('1', 1, 8), ('1', 9, 16)], split_contig('1', 16, [8]))
+        self.assertEqual([('2', 1, 12)], split_contig('2', 12, []))
+        # a cut at either end of a contig would leave an empty piece, so it's ignored
+        self.assertEqual([('3', 1, 16)], split_contig('3', 16, [0, 16]))
+
+        pieces = [('1', 1, 8), ('1', 9, 16), ('2', 1, 12)]
+        self.assertEqual(
+            [[('1', 1, 16)], [('2', 1, 12)]], make_shards(pieces, 2))
+        # asking for more shards than there are pieces gives one shard per piece
+        self.assertEqual([[x] for x in pieces], make_shards(pieces, 10))
+
+    def test_reference_cache(self):
+        cache_dir = tempfile.TemporaryDirectory()
+        other_referencedir = tempfile.TemporaryDirectory()
+        args = parser.parse_args(['--configfile', self.config_tmpfile.name, '--memory', '33'])
+        for path in ('b37decoy.fasta', 'transcripts.gtf'):
+            copy2(join(self.referencedir.name, path), other_referencedir.name)
+        cached_genomes = []
+        # the same reference files in two different directories should share a cache entry
+        for referencedir in (self.referencedir.name, other_referencedir.name):
+            config = {
+                'reference_cache_dir': cache_dir.name,
+                'reference': {
+                    'genome': join(referencedir, 'b37decoy.fasta'),
+                    'transcripts': join(referencedir, 'transcripts.gtf'),
+                },
+            }
+            resolve_reference_cache(args, config)
+            cached_genomes.append(config['reference']['genome'])
+        self.assertEqual(cached_genomes[0], cached_genomes[1])
+        self.assertTrue(cached_genomes[0].startswith(cache_dir.name))
+
+        # capture kits aren't part of the key, but BEDs with the same name and different contents
+        # are linked into the entry separately, and renamed BEDs are linked too
+        cached_capture_kits = []
+        for name, contents in [('kit.bed', 'a'), ('kit.bed', 'b'), ('other_kit.bed', 'a')]:
+            bed_dir = tempfile.TemporaryDirectory()
+            with open(join(bed_dir.name, name), 'w') as f:
+                f.write(contents)
+            config = {
+                'reference_cache_dir': cache_dir.name,
+                'reference': {
+                    'genome': join(other_referencedir.name, 'b37decoy.fasta'),
+                    'transcripts': join(other_referencedir.name, 'transcripts.gtf'),
+                    'capture_kit_coverage_file': join(bed_dir.name, name),
+                },
+            }
+            resolve_reference_cache(args, config)
+            self.assertEqual(cached_genomes[0], config['reference']['genome'])
+            with open(config['reference']['capture_kit_coverage_file']) as f:
+                self.assertEqual(contents, f.read())
+            cached_capture_kits.append(config['reference']['capture_kit_coverage_file'])
+            bed_dir.cleanup()
+        self.assertEqual(3, len(set(cached_capture_kits)))
+        self.assertEqual(
+            ['checksums.json'], [x for x in listdir(cache_dir.name) if x.startswith('checksums')])
+        other_referencedir.cleanup()
+        cache_dir.cleanup()
+
+    def test_output_cache(self):
+        cache_dir = tempfile.TemporaryDirectory()
+        workdir = tempfile.TemporaryDirectory()
+        other_workdir = tempfile.TemporaryDirectory()
+        with open(self.config_tmpfile.name) as config_file:
+            config = yaml.safe_load(config_file)
+        config['output_cache_dir'] = cache_dir.name
+        config['workdir'] = workdir.name
+        outputs = output_cache_groups(config)['normal_alignment']['outputs']
+        output_dir = join(config['workdir'], config['input']['id'])
+        makedirs(output_dir, exist_ok=True)
+        for output in outputs:
+            with open(join(output_dir, output), 'w') as f:
+                f.write(output)
+        store_cached_outputs(config)
+
+        # a rerun on the same inputs in another directory gets the cached outputs
+        config['workdir'] = other_workdir.name
+        link_cached_outputs(config)
+        for output in outputs:
+            with open(join(other_workdir.name, config['input']['id'], output)) as f:
+                self.assertEqual(output, f.read())
+
+        header = '@HD\tVN:1.5\n@RG\tID:normal_L001\tSM:a_normal\tLB:a_normal\tPL:Illumina\n'
+        self.assertEqual(
+            '@HD\tVN:1.5\n@RG\tID:normal_L001\tSM:b_normal\tLB:b_normal\tPL:Illumina\n',
+            rename_read_group_sample(header, 'a', 'b'))
+        other_workdir.cleanup()
+        workdir.cleanup()
+        cache_dir.cleanup()
+
+    def test_run_report(self):
+        run_dir = tempfile.TemporaryDirectory()
+        benchmark_dir = join(run_dir.name, 'benchmarks')
+        makedirs(benchmark_dir)
+        with open(join(benchmark_dir, 'rules-Snakefile.json'), 'w') as f:
+            json.dump({
+                'mark_dups': {
+                    'benchmark': '{prefix}_mark_dups.txt',
+                    'output': [join(run_dir.name, '{prefix}_aligned_coordinate_sorted_dups.bam')],
+                },
+                'mutect_per_chr': {
+                    'benchmark': 'mutect_{chr}.txt',
+                    'output': [join(run_dir.name, 'mutect_{chr}.vcf')],
+                },
+            }, f)
+        with open(join(run_dir.name, 'stats.json'), 'w') as f:
+            json.dump({'files': {
+                join(run_dir.name, 'tumor_aligned_coordinate_sorted_dups.bam'): {
+                    'resources': {'_cores': 1, 'mem_mb': 20480}},
+                join(run_dir.name, 'mutect_1.vcf'): {
+                    'resources': {'_cores': 1, 'mem_mb': 2000}},
+            }}, f)
+        # (name, wall seconds, end time, max RSS, mean load)
+        for name, seconds, end, rss, load in [
+                ('tumor_mark_dups', 100, 1100, 6000, 50),
+                ('mutect_1', 50, 1150, 1500, 100)]:
+            path = join(benchmark_dir, name + '.txt')
+            with open(path, 'w') as f:
+                f.write('s\th:m:s\tmax_rss\tmax_vms\tmax_uss\tmax_pss\tio_in\tio_out\tmean_load\n')
+                f.write('%d\t0:00:00\t%d\t0\t0\t0\t10\t20\t%d\n' % (seconds, rss, load))
+            utime(path, (end, end))
+
+        report = make_report(run_dir.name)
+        self.assertEqual(
+            ['tumor_mark_dups', 'mutect_1'], [x['job'] for x in report['critical_path']])
+        self.assertEqual(150, report['wall_seconds'])
+        self.assertAlmostEqual(0.5, report['rules']['mark_dups']['cpu_efficiency'])
+        self.assertEqual(2000, report['rules']['mutect_per_chr']['mem_mb'])
+        diff = diff_reports(report, report)
+        self.assertEqual(0, diff['rules'][0]['wall_seconds_change'])
+        run_dir.cleanup()
+
+    def test_capacity_plan(self):
+        # a job that kept 3 of its 4 threads busy speeds up, a single-threaded one doesn't
+        self.assertAlmostEqual(600, amdahl_wall_seconds(600, 1800, 4, 4))
+        self.assertLess(amdahl_wall_seconds(600, 1800, 4, 8), 600)
+        self.assertGreater(amdahl_wall_seconds(600, 1800, 4, 2), 600)
+        self.assertEqual(600, amdahl_wall_seconds(600, 600, 1, 8))
+
+        def job(jobid, threads, mem_mb, disk_mb, input, output, temp=False):
+            return {
+                'jobid': jobid, 'rule': 'r%d' % jobid, 'name': 'r%d' % jobid, 'sample': 's',
+                'threads': threads, 'mem_mb': mem_mb, 'disk_mb': disk_mb, 'input': input,
+                'output': output, 'temp_output': output if temp else []}
+        # two alignments that fit side by side on 8 cores, merged into a final BAM, after which
+        # the temporary aligned BAMs are deleted
+        jobs = [
+            job(1, 4, 1000, 100, [], ['a.bam'], temp=True),
+            job(2, 4, 1000, 100, [], ['b.bam'], temp=True),
+            job(3, 1, 500, 150, ['a.bam', 'b.bam'], ['merged.bam']),
+        ]
+        estimates = {1: (100, 800), 2: (100, 800), 3: (50, None)}
+        plans = [
+            simulate(jobs, estimates, cores, mem_mb=4000, disk_mb=1000, targets=['merged.bam'])
+            for cores in [4, 8]]
+        self.assertEqual([250, 150], [x['wall_seconds'] for x in plans])
+        self.assertEqual(2000, plans[1]['peak_mem_mb'])
+        self.assertEqual(1600, plans[1]['peak_rss_mb'])
+        self.assertEqual(350, plans[1]['peak_disk_mb'])
+        recommendation = recommend(plans, min_memory_gb=7)
+        self.assertEqual((8, 7), (recommendation['cores'], recommendation['memory_gb']))
+
+    def test_orchestration_benchmark(self):
+        # the smallest scale runs the whole pipeline, up to the vaccine peptide report, on stubs
+        results_file = join(self.workdir.name, 'orchestration_benchmark.json')
+        orchestration_benchmark(['--scale', 'single', '--out', results_file])
+        with open(results_file) as f:
+            [result] = json.load(f)
+        self.assertEqual('single', result['scale'])
+        self.assertGreater(result['jobs'], 40)
+        self.assertLess(result['stub_seconds'], result['run_seconds'])
+
+    def test_telemetry(self):
+        run_dir = tempfile.TemporaryDirectory()
+        output = join(run_dir.name, 'tumor_aligned.bam')
+        telemetry_file = join(run_dir.name, 'telemetry.jsonl')
+        telemetry = Telemetry(telemetry_file, cores=4, stage='pipeline', interval=3600)
+        telemetry.start()
+        # a job process, matched by the output path on its command line
+        job_process = subprocess.Popen(
+            [sys.executable, '-c', 'import time; time.sleep(30)', output])
+        telemetry.log_handler({'level': 'progress', 'done': 1, 'total': 3})
+        telemetry.log_handler({
+            'level': 'job_info', 'jobid': 7, 'name': 'bwa', 'wildcards': {'prefix': 'tumor'},
+            'threads': 3, 'resources': {'_cores': 3, 'mem_mb': 2000}, 'output': [output],
+            'log': []})
+        telemetry.sample()
+        self.assertIn('neoantigen_pipeline_cores{state="idle"} 1', telemetry.metrics_text())
+        job_process.kill()
+        job_process.wait()
+        telemetry.log_handler({'level': 'job_finished', 'jobid': 7})
+        telemetry.stop(True)
+
+        with open(telemetry_file) as f:
+            events = [json.loads(line) for line in f]
+        self.assertEqual(
+            ['run_start', 'job_start', 'job_sample', 'scheduler', 'job_end', 'run_end'],
+            [x['event'] for x in events])
+        self.assertEqual({'mem_mb': 2000}, events[1]['resources'])
+        self.assertEqual(1, events[2]['num_processes'])
+        self.assertEqual(
+            {'running': 1, 'pending': 1, 'cores_in_use': 3, 'idle_cores': 1},
+            {x: events[3][x] for x in ['running', 'pending', 'cores_in_use', 'idle_cores']})
+        self.assertEqual(('bwa', 'ok'), (events[4]['rule'], events[4]['status']))
+        self.assertGreater(events[4]['peak_rss_mb'], 0)
+        run_dir.cleanup()
+
+    def test_markdup_metrics(self):
+        # samtools flagstat of all reads, and of the duplicate-flagged ones
+        flagstat = (
+            '1010 + 0 in total (QC-passed reads + QC-failed reads)\n'
+            '0 + 0 secondary\n'
+            '10 + 0 supplementary\n'
+            '150 + 0 duplicates\n'
+            '1000 + 0 mapped (99.01% : N/A)\n'
+            '1000 + 0 paired in sequencing\n'
+            '900 + 0 with itself and mate mapped\n'
+            '90 + 0 singletons (9.00% : N/A)\n'
+            '5 + 0 with mate mapped to a different chr (mapQ>=5)\n')
+        duplicates_flagstat = (
+            '150 + 0 in total (QC-passed reads + QC-failed reads)\n'
+            '0 + 0 secondary\n'
+            '0 + 0 supplementary\n'
+            '150 + 0 duplicates\n'
+            '150 + 0 mapped (100.00% : N/A)\n'
+            '140 + 0 with itself and mate mapped\n')
+        metrics = duplication_metrics(
+            parse_flagstat(flagstat), parse_flagstat(duplicates_flagstat), 'normal')
+        self.assertEqual((90, 450, 10, 70), (
+            metrics['UNPAIRED_READS_EXAMINED'], metrics['READ_PAIRS_EXAMINED'],
+            metrics['UNPAIRED_READ_DUPLICATES'], metrics['READ_PAIR_DUPLICATES']))
+        metrics_dir = tempfile.TemporaryDirectory()
+        path = join(metrics_dir.name, 'normal_markdups_metrics.txt')
+        write_metrics(metrics, 'normal.bam', path)
+        # read the way QC reads Picard's metrics
+        self.assertAlmostEqual(150 / 990, get_metrics(path)['PERCENT_DUPLICATION'])
+        self.assertGreater(get_metrics(path)['ESTIMATED_LIBRARY_SIZE'], 380)
+        metrics_dir.cleanup()
+
+    def test_stage_input(self):
+        staging_dir = tempfile.TemporaryDirectory()
+        source = join(staging_dir.name, 'source.fastq.gz')
+        with open(source, 'w') as f:
+            f.write('reads')
+        md5 = '0fb9cf5f04f61bb6f1151da57ceb1ca1'
+
+        dest = join(staging_dir.name, 'linked.fastq.gz')
+        stage_input(['--source', source, '--dest', dest, '--mode', 'auto'])
+        # on the same filesystem, auto mode hardlinks instead of copying
+        self.assertEqual(stat(source).st_ino, stat(dest).st_ino)
+
+        dest = join(staging_dir.name, 'symlinked.fastq.gz')
+        stage_input(['--source', source, '--dest', dest, '--mode', 'symlink'])
+        self.assertTrue(islink(dest))
+
+        dest = join(staging_dir.name, 'copied.fastq.gz')
+        stage_input(['--source', source, '--dest', dest, '--mode', 'copy', '--checksum'])
+        with open(dest) as f:
+            self.assertEqual('reads', f.read())
+        with open(dest + '.md5') as f:
+            self.assertEqual('%s  copied.fastq.gz\n' % md5, f.read())
+        # staging again replaces the earlier file
+        stage_input(['--source', source, '--dest', dest, '--mode', 'copy', '--expected-md5', md5])
+
+        dest = join(staging_dir.name, 'corrupt.fastq.gz')
+        with self.assertRaises(ValueError):
+            stage_input(['--source', source, '--dest', dest, '--expected-md5', '0' * 32])
+        self.assertEqual(
+            ['copied.fastq.gz', 'copied.fastq.gz.md5', 'linked.fastq.gz', 'source.fastq.gz',
+             'symlinked.fastq.gz'],
+            sorted(listdir(staging_dir.name)))
+        staging_dir.cleanup()
+
+    def test_mhc_prediction_cache(self):
+        cache_dir = tempfile.TemporaryDirectory()
+        cache_path = join(cache_dir.name, 'predictions.sqlite')
+
+        # remembers the peptides it predicted
+        class FakePredictor(BasePredictor):
+            def __init__(self, alleles):
+                BasePredictor.__init__(self, alleles=alleles, default_peptide_lengths=[9])
+                self.predicted = []
+
+            def predict_peptides(self, peptides):
+                self.predicted.extend(peptides)
+                return BindingPredictionCollection([
+                    BindingPrediction(
+                        peptide=x, allele=allele, affinity=100.0 + len(self.predicted),
+                        percentile_rank=1.0, prediction_method_name='fake')
+                    for x in peptides for allele in self.alleles])
+
+        def run(sequences, alleles=['HLA-A*02:01']):
+            cache = PredictionCache(cache_path, max_entries=100)
+            predictor_from_args = cached_binding_predictor_from_args(
+                cache, lambda args: FakePredictor(alleles))
+            predictor = predictor_from_args(Namespace(mhc_predictor='netmhcpan-iedb'))
+            predictions = predictor.predict_subsequences(sequences)
+            return predictor, cache, predictions
+
+        predictor, cache, first = run({'mutant': 'SIINFEKLLA'})
+        self.assertEqual(['IINFEKLLA', 'SIINFEKLL'], sorted(predictor.predicted))
+        self.assertEqual((0, 2), (cache.hits, cache.misses))
+        # a second run only predicts the peptide it hasn't seen, and gets the same predictions for
+        # the others, with their own sequence names and offsets
+        predictor, cache, second = run({'other': 'SIINFEKLLAG'})
+        self.assertEqual(['INFEKLLAG'], predictor.predicted)
+        self.assertEqual((2, 1), (cache.hits, cache.misses))
+        self.assertEqual(
+            {(x.peptide, x.affinity) for x in first},
+            {(x.peptide, x.affinity) for x in second if x.peptide != 'INFEKLLAG'})
+        self.assertEqual(
+            [('other', 0), ('other', 1), ('other', 2)],
+            sorted((x.source_sequence_name, x.offset) for x in second))
+        # predictions are cached per allele
+        predictor, cache, _ = run({'mutant': 'SIINFEKLLA'}, alleles=['HLA-B*07:02'])
+        self.assertEqual((0, 2), (cache.hits, cache.misses))
+
+        # IEDB predictors predict whole sequences, with one query per sequence and allele, and
+        # their predict_peptides calls predict_subsequences
+        queries = []
+
+        def query_iedb(request, url):
+            queries.append(request['sequence_text'])
+            length = int(request['length'])
+            sequence = request['sequence_text']
+            return pandas.DataFrame([
+                {'allele': request['allele'], 'peptide': sequence[i:i + length], 'ic50': 50.0,
+                 'start': i + 1, 'end': i + length, 'rank': 0.5}
+                for i in range(len(sequence) - length + 1)])
+
+        predictor_from_args = cached_binding_predictor_from_args(
+            PredictionCache(join(cache_dir.name, 'iedb.sqlite'), max_entries=100),
+            lambda args: IedbNetMHCpan(alleles=['HLA-A*02:01']))
+        predictor = predictor_from_args(Namespace(mhc_predictor='netmhcpan-iedb'))
+        with mock.patch('mhctools.iedb._query_iedb', query_iedb):
+            predictions = predictor.predict_subsequences({'mutant': 'SIINFEKLLA'}, [9, 10])
+            # cache misses are queried peptide by peptide, and hits aren't queried again
+            self.assertEqual(['IINFEKLLA', 'SIINFEKLL', 'SIINFEKLLA'], sorted(queries))
+            predictor.predict_subsequences({'other': 'SIINFEKLL'}, [9])
+            self.assertEqual(3, len(queries))
+        self.assertEqual(
+            [('mutant', 0, 'SIINFEKLL'), ('mutant', 0, 'SIINFEKLLA'), ('mutant', 1, 'IINFEKLLA')],
+            sorted((x.source_sequence_name, x.offset, x.peptide) for x in predictions))
+        cache_dir.cleanup()
+
+    def test_pyensembl_install(self):
+        annotation_dir = tempfile.TemporaryDirectory()
+        attributes = (
+            'gene_id "G1"; transcript_id "T1"; exon_number "1"; exon_id "E1"; gene_name "A"; '
+            'gene_biotype "protein_coding"; transcript_name "A-001"; '
+            'transcript_biotype "protein_coding";')
+        files = {
+            'gtf': ''.join('1\tensembl\t%s\t1\t12\t.\t+\t.\t%s\n' % (x, attributes)
+                for x in ['gene', 'transcript', 'exon']),
+            'cdna-fasta': '>T1\nATGAAATTTTAA\n',
+            'ncrna-fasta': '>T2\nACGT\n',
+            'protein-fasta': '>P1 transcript:T1\nMKF\n',
+        }
+        args = ['--release', '75', '--cache-dir', join(annotation_dir.name, 'cache')]
+        for name, contents in files.items():
+            path = join(annotation_dir.name, name)
+            args.extend(['--' + name, path])
+            # gzipped files are installed as they are, others are gzipped
+            with (gzip.open(path, 'wt') if name == 'cdna-fasta' else open(path, 'w')) as f:
+                f.write(contents)
+        # the script points PyEnsembl at the cache directory through the environment
+        with mock.patch.dict(os.environ):
+            with self.assertRaises(ValueError):
+                pyensembl_install(args[:-2])
+            pyensembl_install(args)
+
+        # PyEnsembl finds the installed files without downloading anything
+        with mock.patch.dict(os.environ, PYENSEMBL_CACHE_DIR=join(annotation_dir.name, 'cache')):
+            genome = EnsemblRelease(75)
+        self.assertEqual(['T1'], genome.transcript_ids())
+        self.assertEqual('ATGAAATTTTAA', genome.transcript_by_id('T1').sequence)
+        self.assertEqual('A', genome.transcript_by_id('T1').gene_name)
+        annotation_dir.cleanup()
+
+    def test_target_intervals(self):
+        targets_dir = tempfile.TemporaryDirectory()
+        interval_list = join(targets_dir.name, 'targets.interval_list')
+        with open(interval_list, 'w') as f:
+            f.write('@HD\tVN:1.5\n@SQ\tSN:1\tLN:1000\n')
+            f.write('1\t100\t300\t+\tt1\n1\t450\t600\t+\tt2\n2\t10\t20\t+\tt3\n')
+        shards = join(targets_dir.name, 'ref.3.shards')
+        with open(shards, 'w') as f:
+            f.write('shard0000\t1:1-500\nshard0001\t1:501-1000\nshard0002\t3:1-1000\n')
+        out_dir = join(targets_dir.name, 'out')
+        target_intervals([
+            '--interval-list', interval_list, '--shards', shards, '--out-dir', out_dir])
+        # targets are clipped to their shard, and shards without targets get no file
+        self.assertEqual(['shard0000.intervals', 'shard0001.intervals'], sorted(listdir(out_dir)))
+        with open(join(out_dir, 'shard0000.intervals')) as f:
+            self.assertEqual('1:100-300\n1:450-500\n', f.read())
+        targets_dir.cleanup()
+
+    def test_exome_mode_regions(self):
+        targets_dir = tempfile.TemporaryDirectory()
+        with open(self.config_tmpfile.name) as config_file:
+            config = yaml.safe_load(config_file)
+        capture_kit = join(targets_dir.name, 'capture.bed')
+        with open(capture_kit, 'w') as f:
+            f.write('1\t100\t300\n')
+        config['exome_mode'] = True
+        config['reference']['capture_kit_coverage_file'] = capture_kit
+        genome = join(targets_dir.name, 'b37decoy.fasta')
+        with open(genome + '.contigs', 'w') as f:
+            f.write('1\n2\n')
+        target_intervals = capture_kit + '.padded100.interval_list'
+        with open(target_intervals, 'w') as f:
+            f.write('1\t1\t400\t+\t.\n')
+        region_targets = region_targets_dir(config)
+        makedirs(region_targets)
+        args = parser.parse_args(['--configfile', self.config_tmpfile.name])
+        extension_config = dict(config, reference=dict(config['reference'], genome=genome))
+        # a capture kit without targets in any region can't be analyzed
+        with self.assertRaises(ValueError):
+            make_config_extension_dict(args, extension_config)
+        with open(join(region_targets, '1.intervals'), 'w') as f:
+            f.write('1:1-400\n')
+        config_extension = make_config_extension_dict(args, extension_config)
+        self.assertEqual(['1', '2'], config_extension['contigs'])
+        self.assertEqual(['1'], config_extension['target_regions'])
+
+        jobs = self._dry_run_jobs(
+            {'exome_mode': True, 'parallel_bqsr': True, 'reference': config['reference']},
+            {'contigs': ['1', '2'], 'target_regions': ['1']})
+        rules = [x['rule'] for x in jobs]
+        # reads of the region without targets are still realigned and recalibrated...
+        self.assertEqual(2, rules.count('dna_indel_realigner_per_chr'))
+        self.assertEqual(4, rules.count('bqsr_print_reads_per_chr'))
+        for job in jobs:
+            if job['rule'] in ['parallel_dna_indel_realigner', 'bqsr_print_reads']:
+                self.assertEqual(2, len([x for x in job['input'] if x.endswith('.bam')]))
+        # ...but only the region with targets is modeled and called
+        self.assertEqual(2, rules.count('base_recalibrator_per_chr'))
+        self.assertEqual(1, rules.count('mutect_per_chr'))
+        # the targets that jobs are restricted to are inputs, so they wait for them to be written
+        for job in jobs:
+            if job['rule'] in [
+                    'base_recalibrator_per_chr', 'mutect_per_chr', 'mutect2_per_chr',
+                    'haplotype_caller_per_chr']:
+                self.assertIn(region_targets, job['input'])
+            if job['rule'] == 'indel_realigner_target_creator':
+                has_targets = job['output'][0].endswith('_1.intervals')
+                self.assertEqual(has_targets, region_targets in job['input'])
+
+        jobs = self._dry_run_jobs(
+            {'exome_mode': True, 'reference': config['reference']},
+            {'contigs': ['1', '2'], 'target_regions': ['1']})
+        base_recalibrators = [x for x in jobs if x['rule'] == 'base_recalibrator']
+        self.assertEqual(2, len(base_recalibrators))
+        self.assertTrue(all(target_intervals in x['input'] for x in base_recalibrators))
+        targets_dir.cleanup()
+
+    def test_vcf_gather(self):
+        gather_dir = tempfile.TemporaryDirectory()
+        with open(join(gather_dir.name, 'ref.dict'), 'w') as f:
+            f.write('@HD\tVN:1.5\n@SQ\tSN:2\tLN:1000\n@SQ\tSN:10\tLN:1000\n')
+        header = (
+            '##fileformat=VCFv4.1\n'
+            '##contig=<ID=10,length=1000>\n'
+            '##contig=<ID=2,length=1000>\n'
+            '#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\n')
+        records = {
+            'snps.vcf': ['2\t5\t.\tA\tC\t.\tPASS\t.\n', '10\t1\t.\tA\tC\t.\tPASS\t.\n'],
+            'indels.vcf': ['2\t7\t.\tA\tAT\t.\tPASS\t.\n'],
+        }
+        for name, lines in records.items():
+            with open(join(gather_dir.name, name), 'w') as f:
+                f.write(header + ''.join(lines))
+        out = join(gather_dir.name, 'out.vcf')
+        vcf_gather([
+            '--input', join(gather_dir.name, 'snps.vcf'), join(gather_dir.name, 'indels.vcf'),
+            '--sequence-dict', join(gather_dir.name, 'ref.dict'),
+            '--out', out])
+        with open(out) as f:
+            lines = f.readlines()
+        # contigs follow the sequence dictionary, records are merged in position order
+        self.assertEqual('##contig=<ID=2,length=1000>\n', lines[1])
+        self.assertEqual(
+            ['2\t5', '2\t7', '10\t1'], ['\t'.join(x.split('\t')[:2]) for x in lines[4:]])
+        gather_dir.cleanup()
+
+    def test_vcf_shards(self):
+        shards_dir = tempfile.TemporaryDirectory()
+        header = '##fileformat=VCFv4.1\n#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\n'
+        records = ['%d\t%d\t.\tA\tC\t.\tPASS\t.\n' % (chrom, pos)
+            for chrom in range(1, 4) for pos in range(1, 11)]
+        for name in ['mutect.vcf', 'strelka.vcf']:
+            with open(join(shards_dir.name, name), 'w') as f:
+                f.write(header + ''.join(records))
+        vcf_shards([
+            '--input', join(shards_dir.name, 'mutect.vcf'), join(shards_dir.name, 'strelka.vcf'),
+            '--num-shards', '3',
+            '--out-dir', shards_dir.name])
+        shard_records = {}
+        for name in ['mutect.vcf', 'strelka.vcf']:
+            for shard in range(3):
+                with open(join(shards_dir.name, 'shard_%d' % shard, name)) as f:
+                    lines = f.readlines()
+                self.assertEqual(header, ''.join(lines[:2]))
+                for line in lines[2:]:
+                    shard_records.setdefault(line, set()).add(shard)
+        # every record is in exactly one shard, the same one for both VCFs
+        self.assertEqual(set(records), set(shard_records))
+        self.assertTrue(all(len(x) == 1 for x in shard_records.values()))
+        shards_dir.cleanup()
+
+    def test_qc_gate(self):
+        gate_dir = tempfile.TemporaryDirectory()
+        metrics = join(gate_dir.name, 'tumor_markdups_metrics.txt')
+        with open(metrics, 'w') as f:
+            f.write(
+                '## METRICS CLASS\tpicard.sam.DuplicationMetrics\n'
+                'LIBRARY\tREAD_PAIRS_EXAMINED\tPERCENT_DUPLICATION\n'
+                'lib\t100\t0.6\n')
+        report = join(gate_dir.name, 'tumor_duplication.json')
+        with self.assertRaises(SystemExit):
+            sequencing_qc([
+                '--metrics-spec-file', join(self._get_pipeline_dir_path(), 'scripts',
+                    'qc-metrics-spec.yaml'),
+                '--gate', 'tumor_dna_duplication_metrics',
+                '--tumor-duplication-metrics', metrics,
+                '--out', report])
+        with open(report) as f:
+            failures = json.load(f)['failures']
+        self.assertEqual(['PERCENT_DUPLICATION'], [x['key'] for x in failures])
+        self.assertEqual(0.6, failures[0]['actual'])
+
+        # an estimate from the FASTQs only warns: 3 of 4 reads are repeats
+        fastq = join(gate_dir.name, 'tumor_L001.fastq')
+        with open(fastq, 'w') as f:
+            for sequence in ['ACGT', 'ACGT', 'ACGT', 'ACGT']:
+                f.write('@read\n%s\n+\nIIII\n' % sequence)
+        report = join(gate_dir.name, 'tumor_estimate.json')
+        sequencing_qc([
+            '--metrics-spec-file', join(self._get_pipeline_dir_path(), 'scripts',
+                'qc-metrics-spec.yaml'),
+            '--gate', 'tumor_dna_duplication_metrics',
+            '--estimate-from-fastq', fastq,
+            '--out', report])
+        with open(report) as f:
+            report = json.load(f)
+        self.assertTrue(report['passed'])
+        self.assertEqual([], report['failures'])
+        self.assertEqual(0.75, report['warnings'][0]['actual'])
+        gate_dir.cleanup()
+
+        # the estimate doesn't hold up alignment, but is run before the duplication gate
+        jobs = self._dry_run_jobs({'qc_gates': True, 'qc_gate_subsample_reads': 1000})
+        estimate = join(self.workdir.name, 'idh1-test-sample', 'qc_gates', 'tumor_estimate.passed')
+        self.assertIn([estimate], [x['output'] for x in jobs])
+        self.assertTrue(all(
+            estimate not in x['input'] for x in jobs if x['rule'].startswith('bwa_mem')))
+        self.assertIn(estimate, next(
+            x['input'] for x in jobs if x['output'][0].endswith('tumor_duplication.passed')))
+
     # This simulates a dry run on the test data, and mostly checks rule graph validity.
     def test_workflow_compiles(self):
         chdir(self._get_pipeline_dir_path())
@@ -129,6 +787,330 @@ class TestPipeline(unittest.TestCase):
             stats=join(self.workdir.name, 'idh1-test-sample', 'stats.json')
         ))
 
+    def test_streaming_alignment(self):
+        rules = {x['rule'] for x in self._dry_run_jobs()}
+        self.assertIn('bwa_mem_sort_single_end', rules)
+        self.assertNotIn('bwa_mem_single_end', rules)
+        self.assertNotIn('convert_alignment_to_sorted_bam', rules)
+
+        rules = {x['rule'] for x in self._dry_run_jobs({'streaming_alignment': False})}
+        self.assertNotIn('bwa_mem_sort_single_end', rules)
+        self.assertIn('bwa_mem_single_end', rules)
+        self.assertIn('convert_alignment_to_sorted_bam', rules)
+
+    def test_alignment_chunks(self):
+        input_dir = tempfile.TemporaryDirectory()
+        with open(self.config_tmpfile.name) as config_file:
+            sample_input = yaml.safe_load(config_file)['input']
+        # a sparse 100MB tumor FASTQ
+        sample_input['tumor'][0]['r'] = join(input_dir.name, 'tumor.fastq.gz')
+        with open(sample_input['tumor'][0]['r'], 'w') as f:
+            f.truncate(100 * 1024 * 1024)
+        jobs = self._dry_run_jobs({'alignment_chunk_size': 1000, 'input': sample_input})
+        rules = [x['rule'] for x in jobs]
+        # the chunks to align are only known once the fragments have been split
+        self.assertEqual(2, rules.count('split_single_end_fastq'))
+        self.assertNotIn('bwa_mem_sort_single_end', rules)
+        # chunk FASTQs are written with fast, lower compression
+        split = next(x for x in jobs if x['name'] == 'tumor_L001_split_fastq')
+        self.assertEqual(150, split['disk_mb'])
+        input_dir.cleanup()
+
+        # run on stub tools, 4 reads per FASTQ in chunks of 2, with a stale chunk of an earlier
+        # split, older than the staged FASTQs, in the way
+        root = tempfile.TemporaryDirectory()
+        config_path = generate(root.name, 1, 2, None, rna=False)
+        with open(config_path) as f:
+            config = yaml.safe_load(f)
+        config.update({'alignment_chunk_size': 2, 'retention': 'keep-final'})
+        with open(config_path, 'w') as f:
+            yaml.safe_dump(config, f)
+        sample_dir = join(config['workdir'], 'synthetic')
+        makedirs(join(sample_dir, 'tumor_L001_chunks'))
+        with open(join(sample_dir, 'tumor_L001_chunks', 'chunk_0009.fq.gz'), 'w') as f:
+            f.write('stale')
+        utime(join(sample_dir, 'tumor_L001_chunks'), (1e9, 1e9))
+        subprocess.check_call(
+            [sys.executable, join(self._get_test_dir_path(), '..', 'run_snakemake.py'),
+             '--configfile', config_path, '--cores', '4', '--memory', '33',
+             '--disk-budget', '1000', '--somatic-variant-calling-only'],
+            env=stub_environment(root.name), stdout=subprocess.DEVNULL)
+        aligned_chunks = sorted(
+            x for x in listdir(join(sample_dir, 'benchmarks')) if '_chunk_' in x)
+        self.assertEqual(
+            ['%s_L001_chunk_%s_bwa_mem_sort.txt' % (x, y)
+             for x in ['normal', 'tumor'] for y in ['0000', '0001']],
+            aligned_chunks)
+        # chunk FASTQs and BAMs are intermediate files
+        self.assertFalse(
+            [x for x in glob.glob(join(sample_dir, '*_chunk*', '*')) if not isdir(x)])
+        root.cleanup()
+
+    def test_resource_profile(self):
+        sample_dir = tempfile.TemporaryDirectory()
+        makedirs(join(sample_dir.name, 'benchmarks'))
+        with open(join(sample_dir.name, 'benchmarks', 'tumor_L001_bwa_mem_sort.txt'), 'w') as f:
+            f.write('s\tmax_rss\tmean_load\n60.0\t100.0\t250.0\n')
+        # the historical sample's inputs were smaller than the current ones
+        with open(join(sample_dir.name, 'tumor_L001.fastq.gz'), 'w') as f:
+            f.write('x' * 1000)
+        with open(self.config_tmpfile.name) as config_file:
+            sample_input = yaml.safe_load(config_file)['input']
+        input_bytes = sum(getsize(x[0]['r']) for x in [
+            sample_input['normal'], sample_input['tumor'], sample_input['rna']])
+        config_updates = {'resource_profile_dirs': [join(sample_dir.name, 'benchmarks')]}
+
+        jobs = self._dry_run_jobs(config_updates)
+        aligned = {x['name']: x for x in jobs if x['rule'] == 'bwa_mem_sort_single_end'}
+        # the normal job has no history of its own, so it's fitted to other jobs of its rule
+        for name in ['tumor_L001_bwa_mem_sort', 'normal_L001_bwa_mem_sort']:
+            self.assertEqual(3, aligned[name]['threads'])
+            self.assertEqual(
+                math.ceil(100 * input_bytes / 1000 * 1.2), aligned[name]['mem_mb'])
+        # rules without history keep their defaults, and Java heaps are 80% of the reservation
+        mark_dups = [x for x in jobs if x['rule'] == 'mark_dups']
+        self.assertEqual([20480] * 3, [x['mem_mb'] for x in mark_dups])
+        self.assertTrue(all('-Xmx16g ' in x['shellcmd'] for x in mark_dups))
+
+        # a job that used more than its default reservation doesn't get more, while the heaps of
+        # smaller reservations are rounded up
+        with open(join(sample_dir.name, 'benchmarks', 'tumor_mark_dups.txt'), 'w') as f:
+            f.write('s\tmax_rss\tmean_load\n60.0\t30000.0\t100.0\n')
+        with open(join(sample_dir.name, 'benchmarks', 'normal_mark_dups.txt'), 'w') as f:
+            f.write('s\tmax_rss\tmean_load\n60.0\t100.0\t100.0\n')
+        jobs = self._dry_run_jobs(config_updates)
+        mark_dups = {x['name']: x for x in jobs if x['rule'] == 'mark_dups'}
+        self.assertEqual(20480, mark_dups['tumor_mark_dups']['mem_mb'])
+        self.assertIn('-Xmx16g ', mark_dups['tumor_mark_dups']['shellcmd'])
+        normal_mem_mb = math.ceil(100 * input_bytes / 1000 * 1.2)
+        self.assertEqual(normal_mem_mb, mark_dups['normal_mark_dups']['mem_mb'])
+        self.assertIn(
+            '-Xmx%dg ' % math.ceil(normal_mem_mb * 0.8 / 1024),
+            mark_dups['normal_mark_dups']['shellcmd'])
+
+        config_updates['resource_profile'] = False
+        jobs = self._dry_run_jobs(config_updates)
+        aligned = [x for x in jobs if x['rule'] == 'bwa_mem_sort_single_end']
+        self.assertEqual([(11, 12288)] * 2, [(x['threads'], x['mem_mb']) for x in aligned])
+        sample_dir.cleanup()
+
+    def test_rna_cigar_split(self):
+        jobs = self._dry_run_jobs()
+        rules = [x['rule'] for x in jobs]
+        # one pass over the RNA BAM writes and indexes both halves, which aren't sorted again
+        self.assertEqual(1, rules.count('split_rna_by_cigar'))
+        split = next(x for x in jobs if x['rule'] == 'split_rna_by_cigar')
+        self.assertEqual(
+            ['rna_aligned_coordinate_sorted_dups.bam'], [basename(x) for x in split['input']])
+        self.assertEqual(4, len(split['output']))
+        sorted_bams = [x['output'][0] for x in jobs if x['rule'] == 'sort_rna_bam']
+        self.assertEqual(['rna_final_sorted.bam'], [basename(x) for x in sorted_bams])
+        indexed_bams = [x['input'][0] for x in jobs if x['rule'] == 'sambamba_index_bam']
+        self.assertFalse(any('cigar' in x for x in indexed_bams))
+
+        # run the split's command with samtools reading and writing SAM text, and sambamba
+        # creating empty indexes
+        split_dir = tempfile.TemporaryDirectory()
+        bin_dir = join(split_dir.name, 'bin')
+        makedirs(bin_dir)
+        tools = {
+            'samtools': (
+                '[ "$2" = "-h" ] && exec cat "$SAM"\n'
+                'while [ "$1" != "-o" ]; do shift; done\n'
+                'case "$2" in *"$FAIL_OUTPUT"*) cat > /dev/null; exit 1;; esac\n'
+                'cat > "$2"\n'),
+            'sambamba': 'touch "$5"\n',
+        }
+        for tool, script in tools.items():
+            with open(join(bin_dir, tool), 'w') as f:
+                f.write('#!/bin/sh\n' + script)
+            os.chmod(join(bin_dir, tool), 0o755)
+        sam = join(split_dir.name, 'rna.sam')
+        with open(sam, 'w') as f:
+            f.write('@HD\tVN:1.5\tSO:coordinate\n')
+            for name, cigar in [('spliced', '5M100N5M'), ('clipped', '2S8M'), ('unmapped', '*')]:
+                f.write('\t'.join([name, '0', '2', '1', '60', cigar] + ['*'] * 5) + '\n')
+        sample_dir = join(self.workdir.name, 'idh1-test-sample')
+        command = split['shellcmd'].replace(sample_dir, split_dir.name)
+        makedirs(join(split_dir.name, 'logs'))
+        env = dict(
+            os.environ, PATH=bin_dir + ':' + os.environ['PATH'], SAM=sam, FAIL_OUTPUT='/none')
+        subprocess.check_call(['bash', '-euo', 'pipefail', '-c', command], env=env)
+        reads = {}
+        for output in [x for x in split['output'] if x.endswith('.bam')]:
+            with open(output.replace(sample_dir, split_dir.name)) as f:
+                reads[basename(output)] = [x.split('\t')[0] for x in f if not x.startswith('@')]
+        # unmapped reads stay with the reads without Ns, as they did with sambamba's filters
+        self.assertEqual({
+            'rna_aligned_coordinate_sorted_dups_cigar_N_filtered_sorted.bam': ['spliced'],
+            'rna_aligned_coordinate_sorted_dups_cigar_0-9MIDSHPX_filtered_sorted.bam':
+                ['clipped', 'unmapped'],
+        }, reads)
+        # a failing writer fails the job, although awk itself succeeds
+        env['FAIL_OUTPUT'] = 'N_filtered'
+        self.assertNotEqual(
+            0, subprocess.call(['bash', '-euo', 'pipefail', '-c', command], env=env))
+        split_dir.cleanup()
+
+    def test_retention(self):
+        for retention, temp_rules in [
+                ('keep-all', set()),
+                ('keep-checkpoints', {'bwa_mem_sort_single_end', 'merge_tumor_aligned_fragments'}),
+                ('keep-final', {
+                    'bwa_mem_sort_single_end', 'merge_tumor_aligned_fragments', 'mark_dups'})]:
+            jobs = self._dry_run_jobs({'retention': retention})
+            for rule in ['bwa_mem_sort_single_end', 'merge_tumor_aligned_fragments', 'mark_dups']:
+                outputs = [x for x in jobs if x['rule'] == rule]
+                self.assertTrue(outputs)
+                self.assertEqual(
+                    rule in temp_rules, all(x['output'][0] in x['temp_output'] for x in outputs))
+        self._dry_run_jobs({'retention': 'keep-nothing'}, succeeds=False)
+
+    def test_compression(self):
+        rules = ['star_align_single_end', 'mark_dups', 'parallel_dna_indel_realigner',
+                 'bqsr_print_reads', 'sort_rna_bam']
+        for config_updates, args in [
+                # tools' default levels
+                ({}, ['', '', '', '', '']),
+                # final BAMs keep the default level
+                ({'compression': 'fast'},
+                 ['--outBAMcompression 1', 'COMPRESSION_LEVEL=1', '-l 1', '', '']),
+                ({'compression': 'uncompressed',
+                  'compression_overrides': {'mark_dups': 'default', 'bqsr_print_reads': 'fast'}},
+                 ['--outBAMcompression 0', '', '-l 0', '-compress 1', ''])]:
+            jobs = self._dry_run_jobs(config_updates)
+            for rule, arg in zip(rules, args):
+                commands = [x['shellcmd'] for x in jobs if x['rule'] == rule]
+                self.assertTrue(commands)
+                for command in commands:
+                    if arg:
+                        self.assertIn(' %s ' % arg, command)
+                    else:
+                        for x in ['--outBAMcompression', 'COMPRESSION_LEVEL', ' -l ', '-compress']:
+                            self.assertNotIn(x, command)
+
+        # the cram policy adds CRAM copies of the final BAMs when run_snakemake.py asks for them
+        with open(self.config_tmpfile.name) as config_file:
+            config = yaml.safe_load(config_file)
+        targets = default_vaxrank_targets(config)
+        jobs = self._dry_run_jobs(
+            {'compression': 'cram'}, targets=targets + cram_targets(config, targets))
+        self.assertEqual(
+            sorted(cram_targets(config, targets)),
+            sorted(x['output'][0] for x in jobs if x['rule'] == 'bam_to_cram'))
+
+        self._dry_run_jobs({'compression': 'zstd'}, succeeds=False)
+        # CRAM copies can't be asked of a single rule
+        self._dry_run_jobs({'compression_overrides': {'mark_dups': 'cram'}}, succeeds=False)
+
+    def test_disk_mb(self):
+        input_dir = tempfile.TemporaryDirectory()
+        with open(self.config_tmpfile.name) as config_file:
+            sample_input = yaml.safe_load(config_file)['input']
+        # a sparse 100MB tumor FASTQ
+        sample_input['tumor'][0]['r'] = join(input_dir.name, 'tumor.fastq.gz')
+        with open(sample_input['tumor'][0]['r'], 'w') as f:
+            f.truncate(100 * 1024 * 1024)
+        jobs = self._dry_run_jobs({'input': sample_input})
+        disk_mb = {x['name']: x['disk_mb'] for x in jobs}
+        # disk reservations are multiples of the FASTQs each job's outputs derive from
+        self.assertEqual(200, disk_mb['tumor_L001_bwa_mem_sort'])
+        self.assertEqual(100, disk_mb['merge_tumor_aligned_fragments'])
+        self.assertEqual(1, disk_mb['merge_normal_aligned_fragments'])
+        input_dir.cleanup()
+
+    def test_reference_jobs(self):
+        jobs = self._dry_run_jobs()
+        # reference files are built in the main DAG, each one only holding up the jobs using it
+        bwa_index = next(x for x in jobs if x['rule'] == 'bwa_index_reference')['output']
+        star_genome = next(x for x in jobs if x['rule'] == 'star_align_reference')['output']
+        for job in [x for x in jobs if x['rule'] == 'bwa_mem_sort_single_end']:
+            self.assertTrue(set(bwa_index) <= set(job['input']))
+            self.assertFalse(set(star_genome) & set(job['input']))
+        for job in [x for x in jobs if x['rule'] == 'star_align_single_end']:
+            self.assertTrue(set(star_genome) <= set(job['input']))
+
+        # a processed reference isn't built again
+        referencedir = tempfile.TemporaryDirectory()
+        reference_outputs = [
+            y for x in jobs for y in x['output'] if y.startswith(self.referencedir.name)]
+        for path in listdir(self.referencedir.name) + reference_outputs:
+            path = join(referencedir.name, path.replace(self.referencedir.name + '/', ''))
+            makedirs(dirname(path), exist_ok=True)
+            with open(path, 'w') as f:
+                f.write('placeholder')
+            # no index may be older than the FASTA it was built from
+            utime(path, (1000000000, 1000000000))
+        with open(self.config_tmpfile.name) as config_file:
+            reference = yaml.safe_load(config_file)['reference']
+        reference = {
+            k: v.replace(self.referencedir.name, referencedir.name) for k, v in reference.items()}
+        jobs = self._dry_run_jobs({'reference': reference})
+        self.assertFalse(
+            [x['rule'] for x in jobs if any(y.startswith(referencedir.name) for y in x['output'])])
+        referencedir.cleanup()
+
+    def test_vaxrank_shards(self):
+        jobs = self._dry_run_jobs({'vaxrank_shards': 3})
+        rules = [x['rule'] for x in jobs]
+        self.assertEqual(1, rules.count('split_vaxrank_variants'))
+        self.assertEqual(3, rules.count('vaxrank_shard'))
+        gather = next(x for x in jobs if x['rule'] == 'vaxrank')
+        self.assertEqual(
+            3, len([x for x in gather['input'] if x.endswith('_mutect-strelka.json')]))
+
+    def test_ensembl_release(self):
+        annotation_dir = tempfile.TemporaryDirectory()
+        with open(self.config_tmpfile.name) as config_file:
+            reference = yaml.safe_load(config_file)['reference']
+        for key in ['cdna_fasta', 'ncrna_fasta', 'protein_fasta']:
+            reference[key] = join(annotation_dir.name, key + '.fa')
+            with open(reference[key], 'w') as f:
+                f.write('placeholder')
+        jobs = self._dry_run_jobs({'reference': reference, 'ensembl_release': 75})
+        install = next(x for x in jobs if x['rule'] == 'pyensembl_install_reference')
+        vaxrank = next(x for x in jobs if x['rule'] == 'vaxrank')
+        self.assertTrue(set(install['output']) <= set(vaxrank['input']))
+        annotation_dir.cleanup()
+
+    def test_parallel_bqsr(self):
+        rules = [x['rule'] for x in self._dry_run_jobs()]
+        self.assertNotIn('base_recalibrator_per_chr', rules)
+
+        for config_updates, config_extension, regions in [
+                ({}, {'contigs': ['1', '2']}, ['1', '2']),
+                ({'interval_shards': 2},
+                 {'shards': ['shard0000', 'shard0001'],
+                  'shard_intervals': [['1:1-1000'], ['1:1001-2000', '2:1-500']]},
+                 ['shard0000', 'shard0001'])]:
+            config_updates['parallel_bqsr'] = True
+            jobs = self._dry_run_jobs(config_updates, config_extension)
+            # one job per region for each of the normal and tumor BAMs
+            for rule in ['base_recalibrator_per_chr', 'bqsr_print_reads_per_chr']:
+                self.assertEqual(2 * len(regions), len([x for x in jobs if x['rule'] == rule]))
+            # the per-region recalibration tables are gathered into one per BAM, and the
+            # per-region recalibrated BAMs merged
+            for rule, extension in [('base_recalibrator', '.table'), ('bqsr_print_reads', '.bam')]:
+                for job in [x for x in jobs if x['rule'] == rule]:
+                    self.assertEqual(
+                        len(regions), len([x for x in job['input'] if x.endswith(extension)]))
+
+    def test_batch_stage_input(self):
+        with open(self.config_tmpfile.name) as config_file:
+            sample_input = yaml.safe_load(config_file)['input']
+        other_sample_input = dict(sample_input, id='idh1-test-sample-2')
+        other_sample_input['tumor'] = sample_input['tumor'] + [
+            dict(sample_input['tumor'][0], fragment_id='L002')]
+        samples = {'samples': {x['id']: x for x in [sample_input, other_sample_input]}}
+        staged_input = 'tumor_L002.fastq.gz'
+        jobs = self._dry_run_jobs(
+            samples, targets=[join(self.workdir.name, 'idh1-test-sample-2', staged_input)])
+        self.assertEqual(['stage_input'], [x['rule'] for x in jobs])
+        # only the other sample stages this file
+        self._dry_run_jobs(
+            samples, targets=[join(self.workdir.name, 'idh1-test-sample', staged_input)],
+            succeeds=False)
+
     def test_dna_only_setup(self):
         cli_args = [
             '--configfile', self.dna_only_config_tmpfile.name,
@@ -214,6 +1196,31 @@ class TestPipeline(unittest.TestCase):
         ]
         docker_entrypoint(qc_cli_args)
 
+    def test_batch_entrypoint_script(self):
+        with open(self.config_tmpfile.name) as config_file:
+            config = yaml.safe_load(config_file)
+        second_config_tmpfile = tempfile.NamedTemporaryFile(mode='w')
+        config["input"]["id"] = "idh1-test-sample-2"
+        yaml.safe_dump(config, second_config_tmpfile)
+        second_config_tmpfile.flush()
+        batch_cli_args = [
+            '--batch-configfile', self.config_tmpfile.name,
+            '--batch-configfile', second_config_tmpfile.name,
+            '--dry-run',
+            '--memory', '33',
+        ]
+        docker_entrypoint(batch_cli_args)
+
+        # configs in a batch must share everything but their inputs
+        config["variant_callers"] = ["mutect"]
+        second_config_tmpfile.seek(0)
+        second_config_tmpfile.truncate()
+        yaml.safe_dump(config, second_config_tmpfile)
+        second_config_tmpfile.flush()
+        with self.assertRaises(ValueError):
+            docker_entrypoint(batch_cli_args)
+        second_config_tmpfile.close()
+
     def test_docker_entrypoint_script_failures(self):
         # check that invalid targets fail
         fake_target_cli_args = [